@@ -312,6 +312,9 @@ async def async_remove_entry(
     # Clean device list
     await miot_storage.remove_async(
         domain='miot_devices', name=f'{uid}_{cloud_server}', type_=dict)
+    # Clean last known property values
+    await miot_storage.remove_async(
+        domain='miot_props', name=f'{uid}_{cloud_server}', type_=dict)
     # Clean user configuration
     await miot_storage.update_user_config_async(
         uid=uid, cloud_server=cloud_server, config=None)
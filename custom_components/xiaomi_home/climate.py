@@ -307,10 +307,9 @@ class FeatureSwingMode(MIoTServiceEntity, ClimateEntity):
     async def async_set_swing_mode(self, swing_mode):
         """Set the target swing operation."""
         if swing_mode == SWING_BOTH:
-            await self.set_property_async(prop=self._prop_horizontal_swing,
-                                          value=True)
-            await self.set_property_async(prop=self._prop_vertical_swing,
-                                          value=True)
+            await self.set_properties_async(props={
+                self._prop_horizontal_swing: True,
+                self._prop_vertical_swing: True})
         elif swing_mode == SWING_HORIZONTAL:
             await self.set_property_async(prop=self._prop_horizontal_swing,
                                           value=True)
@@ -318,12 +317,12 @@ class FeatureSwingMode(MIoTServiceEntity, ClimateEntity):
             await self.set_property_async(prop=self._prop_vertical_swing,
                                           value=True)
         elif swing_mode == SWING_OFF:
+            props: dict = {}
             if self._prop_horizontal_swing:
-                await self.set_property_async(prop=self._prop_horizontal_swing,
-                                              value=False)
+                props[self._prop_horizontal_swing] = False
             if self._prop_vertical_swing:
-                await self.set_property_async(prop=self._prop_vertical_swing,
-                                              value=False)
+                props[self._prop_vertical_swing] = False
+            await self.set_properties_async(props=props)
         else:
             raise RuntimeError(
                 f'unknown swing_mode, {swing_mode}, {self.entity_id}')
@@ -523,17 +522,18 @@ class AirConditioner(FeatureOnOff, FeatureTargetTemperature,
                 raise RuntimeError(f'set climate prop.on failed, {hvac_mode}, '
                                    f'{self.entity_id}')
             return
-        # set the device on
+        # set the device on and the mode with one request
+        props: dict = {}
         if self.get_prop_value(prop=self._prop_on) is False:
-            await self.set_property_async(prop=self._prop_on,
-                                          value=True,
-                                          write_ha_state=False)
-        # set mode
-        if self._prop_mode is None:
-            return
-        mode_value = self.get_map_key(map_=self._hvac_mode_map, value=hvac_mode)
-        if mode_value is None or not await self.set_property_async(
-                prop=self._prop_mode, value=mode_value):
+            props[self._prop_on] = True
+        mode_value = None
+        if self._prop_mode:
+            mode_value = self.get_map_key(
+                map_=self._hvac_mode_map, value=hvac_mode)
+            if mode_value is not None:
+                props[self._prop_mode] = mode_value
+        await self.set_properties_async(props=props)
+        if self._prop_mode and mode_value is None:
             raise RuntimeError(
                 f'set climate prop.mode failed, {hvac_mode}, {self.entity_id}')
 
@@ -716,15 +716,18 @@ class Thermostat(FeatureOnOff, FeatureTargetTemperature, FeatureTemperature,
                 raise RuntimeError(f'set climate prop.on failed, {hvac_mode}, '
                                    f'{self.entity_id}')
             return
-        # set the device on
-        elif self.get_prop_value(prop=self._prop_on) is False:
-            await self.set_property_async(prop=self._prop_on, value=True)
-        # set mode
-        if self._prop_mode is None:
-            return
-        mode_value = self.get_map_key(map_=self._hvac_mode_map, value=hvac_mode)
-        if mode_value is None or not await self.set_property_async(
-                prop=self._prop_mode, value=mode_value):
+        # set the device on and the mode with one request
+        props: dict = {}
+        if self.get_prop_value(prop=self._prop_on) is False:
+            props[self._prop_on] = True
+        mode_value = None
+        if self._prop_mode:
+            mode_value = self.get_map_key(
+                map_=self._hvac_mode_map, value=hvac_mode)
+            if mode_value is not None:
+                props[self._prop_mode] = mode_value
+        await self.set_properties_async(props=props)
+        if self._prop_mode and mode_value is None:
             raise RuntimeError(
                 f'set climate prop.mode failed, {hvac_mode}, {self.entity_id}')
 
@@ -85,7 +85,8 @@ from .miot.const import (
     INTEGRATION_LANGUAGES,
     SUPPORT_CENTRAL_GATEWAY_CTRL,
     NETWORK_REFRESH_INTERVAL,
-    MIHOME_CERT_EXPIRE_MARGIN
+    MIHOME_CERT_EXPIRE_MARGIN,
+    MIHOME_STARTUP_REFRESH_WINDOW
 )
 from .miot.miot_cloud import MIoTHttpClient, MIoTOauthClient
 from .miot.miot_storage import MIoTStorage, MIoTCert
@@ -983,6 +984,8 @@ class OptionsFlowHandler(config_entries.OptionsFlow):
     _home_selected_list: list
     _devices_filter: dict
     _action_debug: bool
+    _ctrl_hedging: bool
+    _startup_refresh_window: int
     _hide_non_standard_entities: bool
     _display_binary_mode: list[str]
     _display_devs_notify: list[str]
@@ -998,6 +1001,8 @@ class OptionsFlowHandler(config_entries.OptionsFlow):
     _lang_new: str
     _nick_name_new: Optional[str]
     _action_debug_new: bool
+    _ctrl_hedging_new: bool
+    _startup_refresh_window_new: int
     _hide_non_standard_entities_new: bool
     _display_binary_mode_new: list[str]
     _update_user_info: bool
@@ -1036,6 +1041,9 @@ class OptionsFlowHandler(config_entries.OptionsFlow):
             'integration_language', DEFAULT_INTEGRATION_LANGUAGE)
         self._nick_name = self._entry_data.get('nick_name', DEFAULT_NICK_NAME)
         self._action_debug = self._entry_data.get('action_debug', False)
+        self._ctrl_hedging = self._entry_data.get('ctrl_hedging', False)
+        self._startup_refresh_window = int(self._entry_data.get(
+            'startup_refresh_window', MIHOME_STARTUP_REFRESH_WINDOW))
         self._hide_non_standard_entities = self._entry_data.get(
             'hide_non_standard_entities', False)
         self._display_binary_mode = self._entry_data.get(
@@ -1057,6 +1065,8 @@ class OptionsFlowHandler(config_entries.OptionsFlow):
         self._lang_new = self._integration_language
         self._nick_name_new = None
         self._action_debug_new = False
+        self._ctrl_hedging_new = False
+        self._startup_refresh_window_new = self._startup_refresh_window
         self._hide_non_standard_entities_new = False
         self._display_binary_mode_new = []
         self._update_user_info = False
@@ -1321,6 +1331,14 @@ class OptionsFlowHandler(config_entries.OptionsFlow):
                         'action_debug',
                         default=self._action_debug  # type: ignore
                     ): bool,
+                    vol.Required(
+                        'ctrl_hedging',
+                        default=self._ctrl_hedging  # type: ignore
+                    ): bool,
+                    vol.Required(
+                        'startup_refresh_window',
+                        default=self._startup_refresh_window  # type: ignore
+                    ): vol.All(vol.Coerce(int), vol.Range(min=0, max=600)),
                     vol.Required(
                         'hide_non_standard_entities',
                         default=self._hide_non_standard_entities  # type: ignore
@@ -1357,6 +1375,10 @@ class OptionsFlowHandler(config_entries.OptionsFlow):
             'update_devices', self._update_devices)
         self._action_debug_new = user_input.get(
             'action_debug', self._action_debug)
+        self._ctrl_hedging_new = user_input.get(
+            'ctrl_hedging', self._ctrl_hedging)
+        self._startup_refresh_window_new = user_input.get(
+            'startup_refresh_window', self._startup_refresh_window)
         self._hide_non_standard_entities_new = user_input.get(
             'hide_non_standard_entities', self._hide_non_standard_entities)
         self._display_binary_mode_new = user_input.get(
@@ -1957,6 +1979,13 @@ class OptionsFlowHandler(config_entries.OptionsFlow):
         if self._action_debug_new != self._action_debug:
             self._entry_data['action_debug'] = self._action_debug_new
             self._need_reload = True
+        if self._ctrl_hedging_new != self._ctrl_hedging:
+            self._entry_data['ctrl_hedging'] = self._ctrl_hedging_new
+            self._need_reload = True
+        if self._startup_refresh_window_new != self._startup_refresh_window:
+            # Applies from the next startup
+            self._entry_data['startup_refresh_window'] = (
+                self._startup_refresh_window_new)
         if (
             self._hide_non_standard_entities_new !=
             self._hide_non_standard_entities
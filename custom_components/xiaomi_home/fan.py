@@ -201,29 +201,18 @@ class Fan(MIoTServiceEntity, FanEntity):
         Shall set the percentage or the preset_mode attr to complying
         if applicable.
         """
+        # All properties are sent with one set_properties request
         # on
-        await self.set_property_async(prop=self._prop_on, value=True)
+        props: dict = {self._prop_on: True}
         # percentage
         if percentage:
-            if self._speed_names:
-                await self.set_property_async(
-                    prop=self._prop_fan_level,
-                    value=self.get_map_key(
-                        map_=self._speed_name_map,
-                        value=percentage_to_ordered_list_item(
-                            self._speed_names, percentage)))
-            else:
-                await self.set_property_async(
-                    prop=self._prop_fan_level,
-                    value=int(percentage_to_ranged_value(
-                        low_high_range=(self._speed_min, self._speed_max),
-                        percentage=percentage)))
+            props[self._prop_fan_level] = self.__percentage_to_level(
+                percentage=percentage)
         # preset_mode
         if preset_mode:
-            await self.set_property_async(
-                self._prop_mode,
-                value=self.get_map_key(
-                    map_=self._mode_map, value=preset_mode))
+            props[self._prop_mode] = self.get_map_key(
+                map_=self._mode_map, value=preset_mode)
+        await self.set_properties_async(props=props)
 
     async def async_turn_off(self, **kwargs: Any) -> None:
         """Turn the fan off."""
@@ -236,22 +225,13 @@ class Fan(MIoTServiceEntity, FanEntity):
     async def async_set_percentage(self, percentage: int) -> None:
         """Set the percentage of the fan speed."""
         if percentage > 0:
-            if self._speed_names:
-                await self.set_property_async(
-                    prop=self._prop_fan_level,
-                    value=self.get_map_key(
-                        map_=self._speed_name_map,
-                        value=percentage_to_ordered_list_item(
-                            self._speed_names, percentage)))
-            else:
-                await self.set_property_async(
-                    prop=self._prop_fan_level,
-                    value=int(percentage_to_ranged_value(
-                        low_high_range=(self._speed_min, self._speed_max),
-                        percentage=percentage)))
+            props: dict = {
+                self._prop_fan_level: self.__percentage_to_level(
+                    percentage=percentage)}
             if not self.is_on:
                 # If the fan is off, turn it on.
-                await self.set_property_async(prop=self._prop_on, value=True)
+                props[self._prop_on] = True
+            await self.set_properties_async(props=props)
         else:
             await self.set_property_async(prop=self._prop_on, value=False)
 
@@ -278,6 +258,16 @@ class Fan(MIoTServiceEntity, FanEntity):
         await self.set_property_async(
             prop=self._prop_horizontal_swing, value=oscillating)
 
+    def __percentage_to_level(self, percentage: int) -> Any:
+        if self._speed_names:
+            return self.get_map_key(
+                map_=self._speed_name_map,
+                value=percentage_to_ordered_list_item(
+                    self._speed_names, percentage))
+        return int(percentage_to_ranged_value(
+            low_high_range=(self._speed_min, self._speed_max),
+            percentage=percentage))
+
     @property
     def is_on(self) -> Optional[bool]:
         """Return if the fan is on. """
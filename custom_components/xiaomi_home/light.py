@@ -250,43 +250,37 @@ class Light(MIoTServiceEntity, LightEntity):
 
         Shall set attributes in kwargs if applicable.
         """
+        # All properties are sent with one set_properties request
+        props: dict = {}
         # on
         # Dirty logic for lumi.gateway.mgl03 indicator light
         if self._prop_on:
             value_on = True if self._prop_on.format_ == bool else 1
-            await self.set_property_async(
-                prop=self._prop_on, value=value_on)
+            props[self._prop_on] = value_on
         # brightness
         if ATTR_BRIGHTNESS in kwargs:
             brightness = brightness_to_value(
                 self._brightness_scale, kwargs[ATTR_BRIGHTNESS])
-            await self.set_property_async(
-                prop=self._prop_brightness, value=brightness,
-                write_ha_state=False)
+            props[self._prop_brightness] = brightness
         # color-temperature
         if ATTR_COLOR_TEMP_KELVIN in kwargs:
-            await self.set_property_async(
-                prop=self._prop_color_temp,
-                value=kwargs[ATTR_COLOR_TEMP_KELVIN],
-                write_ha_state=False)
-            self._attr_color_mode = ColorMode.COLOR_TEMP
+            props[self._prop_color_temp] = kwargs[ATTR_COLOR_TEMP_KELVIN]
         # rgb color
         if ATTR_RGB_COLOR in kwargs:
             r = kwargs[ATTR_RGB_COLOR][0]
             g = kwargs[ATTR_RGB_COLOR][1]
             b = kwargs[ATTR_RGB_COLOR][2]
             rgb = (r << 16) | (g << 8) | b
-            await self.set_property_async(
-                prop=self._prop_color, value=rgb,
-                write_ha_state=False)
-            self._attr_color_mode = ColorMode.RGB
+            props[self._prop_color] = rgb
         # mode
         if ATTR_EFFECT in kwargs:
-            await self.set_property_async(
-                prop=self._prop_mode,
-                value=self.get_map_key(
-                    map_=self._mode_map, value=kwargs[ATTR_EFFECT]),
-                write_ha_state=False)
+            props[self._prop_mode] = self.get_map_key(
+                map_=self._mode_map, value=kwargs[ATTR_EFFECT])
+        await self.set_properties_async(props=props, write_ha_state=False)
+        if ATTR_COLOR_TEMP_KELVIN in kwargs:
+            self._attr_color_mode = ColorMode.COLOR_TEMP
+        if ATTR_RGB_COLOR in kwargs:
+            self._attr_color_mode = ColorMode.RGB
         self.async_write_ha_state()
 
     async def async_turn_off(self, **kwargs) -> None:
@@ -46,10 +46,16 @@ off Xiaomi or its affiliates' products.
 Common utilities.
 """
 import asyncio
+import concurrent.futures
+from collections import deque
+import heapq
 import json
+import logging
 from os import path
 import random
-from typing import Any, Optional
+import threading
+import time
+from typing import Any, Callable, Optional
 import hashlib
 from urllib.parse import urlencode
 from urllib.request import Request, urlopen
@@ -57,6 +63,8 @@ from paho.mqtt.matcher import MQTTMatcher
 import yaml
 from slugify import slugify
 
+_LOGGER = logging.getLogger(__name__)
+
 MIOT_ROOT_PATH: str = path.dirname(path.abspath(__file__))
 
 
@@ -123,6 +131,418 @@ class MIoTMatcher(MQTTMatcher):
             return None
 
 
+class MIoTRequestTracker:
+    """Pending request tracker.
+
+    Requests are keyed by integer id. Deadlines are kept in one heap and
+    expired from a single timer on the owner loop. All methods SHOULD be
+    called in the owner loop thread, except stats().
+    """
+    _on_timeout: Callable[[int, Any], None]
+    _loop: Optional[asyncio.AbstractEventLoop]
+    # {req_id: (start_ts, deadline, data)}
+    _requests: dict[int, tuple[float, Optional[float], Any]]
+    _heap: list[tuple[float, int]]
+    _timer: Optional[asyncio.TimerHandle]
+    _timer_deadline: Optional[float]
+    _timeout_count: int
+
+    def __init__(
+        self, on_timeout: Callable[[int, Any], None],
+        loop: Optional[asyncio.AbstractEventLoop] = None
+    ) -> None:
+        """on_timeout(req_id, data) is called when a request expires.
+        The loop is bound on the first add if not set."""
+        self._on_timeout = on_timeout
+        self._loop = loop
+        self._requests = {}
+        self._heap = []
+        self._timer = None
+        self._timer_deadline = None
+        self._timeout_count = 0
+
+    def __len__(self) -> int:
+        return len(self._requests)
+
+    def __contains__(self, req_id: int) -> bool:
+        return req_id in self._requests
+
+    def add(
+        self, req_id: int, data: Any, timeout_s: Optional[float] = None
+    ) -> None:
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        now: float = self._loop.time()
+        deadline: Optional[float] = None
+        if timeout_s is not None:
+            deadline = now + timeout_s
+            heapq.heappush(self._heap, (deadline, req_id))
+        self._requests[req_id] = (now, deadline, data)
+        if deadline is not None:
+            self.__schedule()
+
+    def pop(self, req_id: int) -> Any:
+        """Remove a request and return its data, None if not found.
+        The heap entry is dropped lazily."""
+        item = self._requests.pop(req_id, None)
+        return item[2] if item else None
+
+    def clear(self) -> list[Any]:
+        """Remove all requests without calling on_timeout."""
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        self._timer_deadline = None
+        requests = [item[2] for item in self._requests.values()]
+        self._requests.clear()
+        self._heap.clear()
+        self._loop = None
+        return requests
+
+    def stats(self) -> dict:
+        """In-flight count and age percentiles (seconds)."""
+        loop = self._loop
+        items = list(self._requests.values())
+        result: dict = {
+            'in_flight': len(items), 'timeouts': self._timeout_count}
+        if not loop or not items:
+            result.update({
+                'age_p50': 0.0, 'age_p90': 0.0, 'age_p99': 0.0,
+                'age_max': 0.0})
+            return result
+        now: float = loop.time()
+        ages = sorted(now-item[0] for item in items)
+        for name, percent in (
+                ('age_p50', 50), ('age_p90', 90), ('age_p99', 99)):
+            result[name] = ages[min(
+                len(ages)-1, int(len(ages)*percent/100))]
+        result['age_max'] = ages[-1]
+        return result
+
+    def __schedule(self) -> None:
+        # Drop stale heap entries
+        while self._heap:
+            deadline, req_id = self._heap[0]
+            item = self._requests.get(req_id, None)
+            if item and item[1] == deadline:
+                break
+            heapq.heappop(self._heap)
+        if not self._heap or not self._loop:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            self._timer_deadline = None
+            return
+        deadline = self._heap[0][0]
+        if self._timer and self._timer_deadline is not None and (
+                self._timer_deadline <= deadline):
+            return
+        if self._timer:
+            self._timer.cancel()
+        self._timer_deadline = deadline
+        self._timer = self._loop.call_at(deadline, self.__timer_handler)
+
+    def __timer_handler(self) -> None:
+        self._timer = None
+        self._timer_deadline = None
+        if not self._loop:
+            return
+        now: float = self._loop.time()
+        while self._heap and self._heap[0][0] <= now:
+            deadline, req_id = heapq.heappop(self._heap)
+            item = self._requests.get(req_id, None)
+            if not item or item[1] != deadline:
+                continue
+            self._requests.pop(req_id, None)
+            self._timeout_count += 1
+            try:
+                self._on_timeout(req_id, item[2])
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                # Keep expiring the remaining requests
+                _LOGGER.error(
+                    'request timeout handler error, %s, %s', req_id, err,
+                    exc_info=True)
+        self.__schedule()
+
+
+class MIoTRouteStats:
+    """Rolling per-device, per-route request outcomes.
+
+    Each (did, route) keeps the last WINDOW outcomes (ok, latency) younger
+    than TTL_S. A route is unhealthy if at least MIN_SAMPLES outcomes show
+    a success rate below HEALTHY_RATE. Expired samples are dropped, so an
+    unhealthy route is tried again later.
+    """
+    WINDOW: int = 32
+    TTL_S: float = 600
+    MIN_SAMPLES: int = 3
+    HEALTHY_RATE: float = 0.5
+    # Score of a route without samples, seconds
+    PRIOR_LATENCY_S: float = 0.5
+    # A route is only preferred to an earlier one in the default order if
+    # it scores better by this factor per position
+    PREFERENCE_STEP: float = 1.5
+    # Latency budget of a route before a request is hedged, seconds
+    BUDGET_DEFAULT_S: float = 1
+    BUDGET_MIN_S: float = 0.3
+    BUDGET_MAX_S: float = 3
+    # {did: {route: deque[(ts, ok, latency)]}}
+    _samples: dict[str, dict[str, deque[tuple[float, bool, float]]]]
+    # {did: (route, ts)}
+    _last_route: dict[str, tuple[str, float]]
+
+    def __init__(self) -> None:
+        self._samples = {}
+        self._last_route = {}
+
+    def record(
+        self, did: str, route: str, ok: bool, latency_s: float
+    ) -> None:
+        now: float = time.monotonic()
+        self._samples.setdefault(did, {}).setdefault(
+            route, deque(maxlen=self.WINDOW)).append((now, ok, latency_s))
+        self._last_route[did] = (route, now)
+
+    def remove(self, did: str) -> None:
+        self._samples.pop(did, None)
+        self._last_route.pop(did, None)
+
+    def score(self, did: str, route: str) -> dict:
+        """Success rate and latency percentiles (seconds) of the route,
+        score is the expected cost of a request, lower is better."""
+        samples = self.__samples(did=did, route=route)
+        result: dict = {'samples': len(samples)}
+        if not samples:
+            result.update({
+                'success_rate': None, 'p50': None, 'p90': None,
+                'healthy': True, 'score': self.PRIOR_LATENCY_S})
+            return result
+        latencies = sorted(item[2] for item in samples if item[1])
+        rate: float = len(latencies) / len(samples)
+        result['success_rate'] = rate
+        if latencies:
+            result['p50'] = latencies[int(len(latencies)*0.5)]
+            result['p90'] = latencies[min(
+                len(latencies)-1, int(len(latencies)*0.9))]
+        else:
+            result['p50'] = result['p90'] = None
+        result['healthy'] = (
+            len(samples) < self.MIN_SAMPLES or rate >= self.HEALTHY_RATE)
+        result['score'] = (
+            (result['p90'] or self.PRIOR_LATENCY_S) / max(rate, 0.01)**2
+            if len(samples) >= self.MIN_SAMPLES
+            else self.PRIOR_LATENCY_S)
+        return result
+
+    def rank(self, did: str, routes: list[str]) -> list[str]:
+        """Order the available routes, best first. routes is the default
+        preference order, used as the tie-break."""
+        if len(routes) < 2:
+            return list(routes)
+        scores = {route: self.score(did=did, route=route) for route in routes}
+        return sorted(routes, key=lambda route: (
+            not scores[route]['healthy'],
+            scores[route]['score']*(
+                self.PREFERENCE_STEP**routes.index(route))))
+
+    def latency_budget(self, did: str, route: str) -> float:
+        """p90 latency of the route, clamped, the default without enough
+        samples."""
+        result = self.score(did=did, route=route)
+        if result['samples'] < self.MIN_SAMPLES or result['p90'] is None:
+            return self.BUDGET_DEFAULT_S
+        return min(
+            self.BUDGET_MAX_S, max(self.BUDGET_MIN_S, result['p90']))
+
+    def stats(self, did: Optional[str] = None) -> dict:
+        """Diagnostics, {did: {'last_route': str, 'routes': {...}}}."""
+        dids = [did] if did else list(self._samples.keys())
+        result: dict = {}
+        for item in dids:
+            routes = self._samples.get(item, None)
+            if not routes:
+                continue
+            last = self._last_route.get(item, None)
+            result[item] = {
+                'last_route': last[0] if last else None,
+                'routes': {
+                    route: self.score(did=item, route=route)
+                    for route in list(routes.keys())}}
+        return result
+
+    def __samples(
+        self, did: str, route: str
+    ) -> deque[tuple[float, bool, float]]:
+        samples = self._samples.get(did, {}).get(route, None)
+        if samples is None:
+            return deque()
+        expire_ts: float = time.monotonic() - self.TTL_S
+        while samples and samples[0][0] < expire_ts:
+            samples.popleft()
+        return samples
+
+
+class MIoTPropShadow:
+    """Last known property values, fed from pushes and read replies.
+
+    Each entry keeps the value, the wall clock timestamp and the source
+    (cloud, gateway, lan, or set for an applied write). Reads with a
+    max age are served from the shadow while the entry is fresh enough.
+    """
+    # {(did, siid, piid): (value, ts, source)}
+    _values: dict[tuple[str, int, int], tuple[Any, float, str]]
+    _hits: int
+    _misses: int
+
+    def __init__(self) -> None:
+        self._values = {}
+        self._hits = 0
+        self._misses = 0
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def update(
+        self, did: str, siid: int, piid: int, value: Any, source: str,
+        ts: Optional[float] = None
+    ) -> None:
+        self._values[(did, siid, piid)] = (
+            value, time.time() if ts is None else ts, source)
+
+    def get(
+        self, did: str, siid: int, piid: int, max_age: float
+    ) -> Optional[tuple[Any, float, str]]:
+        """(value, ts, source) if younger than max_age seconds."""
+        item = self._values.get((did, siid, piid), None)
+        if item is None or time.time() - item[1] > max_age:
+            self._misses += 1
+            return None
+        self._hits += 1
+        return item
+
+    def keys(self) -> list[tuple[str, int, int]]:
+        """[(did, siid, piid)] of all known values."""
+        return list(self._values.keys())
+
+    def remove(
+        self, did: str, siid: Optional[int] = None,
+        piid: Optional[int] = None
+    ) -> None:
+        """Remove one property, or all properties of the device."""
+        if siid is not None and piid is not None:
+            self._values.pop((did, siid, piid), None)
+            return
+        for key in [key for key in self._values if key[0] == did]:
+            self._values.pop(key, None)
+
+    def to_dict(self) -> dict:
+        """JSON serializable, {"did|siid|piid": [value, ts, source]}."""
+        return {
+            f'{did}|{siid}|{piid}': [value, ts, source]
+            for (did, siid, piid), (value, ts, source) in self._values.items()}
+
+    def load(self, data: dict, max_age: float) -> int:
+        """Restore entries younger than max_age seconds from to_dict(),
+        newer values already in the shadow are kept. Return the count."""
+        now: float = time.time()
+        count: int = 0
+        for key, item in data.items():
+            try:
+                did, siid, piid = key.split('|')
+                value, ts, source = item
+                prop_key = (did, int(siid), int(piid))
+            except (TypeError, ValueError):
+                continue
+            if now - ts > max_age:
+                continue
+            current = self._values.get(prop_key, None)
+            if current and current[1] >= ts:
+                continue
+            self._values[prop_key] = (value, ts, source)
+            count += 1
+        return count
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._values), 'hits': self._hits,
+            'misses': self._misses}
+
+
+class MIoTReactor:
+    """Shared I/O thread running one event loop.
+
+    MIPS clients and the LAN engine can host their sockets and timers on
+    one reactor instead of starting a thread each. The thread starts on
+    the first acquire() and stops when the last user calls release().
+    """
+    _name: str
+    _lock: threading.Lock
+    _ref_count: int
+    _loop: Optional[asyncio.AbstractEventLoop]
+    _thread: Optional[threading.Thread]
+
+    def __init__(self, name: str = 'miot_reactor') -> None:
+        self._name = name
+        self._lock = threading.Lock()
+        self._ref_count = 0
+        self._loop = None
+        self._thread = None
+
+    @property
+    def ref_count(self) -> int:
+        return self._ref_count
+
+    @property
+    def thread(self) -> Optional[threading.Thread]:
+        return self._thread
+
+    def acquire(self) -> asyncio.AbstractEventLoop:
+        """Return the reactor loop, start the thread if needed."""
+        with self._lock:
+            self._ref_count += 1
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever, name=self._name,
+                    daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def release(self) -> None:
+        """Stop the thread when the last user releases the reactor. MUST
+        NOT be called in the reactor thread."""
+        with self._lock:
+            if self._ref_count <= 0:
+                return
+            self._ref_count -= 1
+            if self._ref_count > 0 or not self._loop or not self._thread:
+                return
+            loop, thread = self._loop, self._thread
+            self._loop = None
+            self._thread = None
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+    def call(
+        self, func: Callable[..., Any], *args
+    ) -> concurrent.futures.Future:
+        """Run func in the reactor thread, return a future of the result."""
+        if not self._loop:
+            raise RuntimeError('reactor not started')
+        fut: concurrent.futures.Future = concurrent.futures.Future()
+
+        def run() -> None:
+            if not fut.set_running_or_notify_cancel():
+                return
+            try:
+                fut.set_result(func(*args))
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                fut.set_exception(err)
+        self._loop.call_soon_threadsafe(run)
+        return fut
+
+
 class MIoTHttp:
     """MIoT Common HTTP API."""
     @staticmethod
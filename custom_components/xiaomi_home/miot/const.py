@@ -52,6 +52,16 @@ DEFAULT_NICK_NAME: str = 'Xiaomi'
 
 MIHOME_HTTP_API_TIMEOUT: int = 30
 MIHOME_MQTT_KEEPALIVE: int = 60
+# Persistent mqtt session expiry interval (s), 0 for clean sessions
+MIHOME_MQTT_SESSION_EXPIRY: int = 0
+# Mqtt broadcast subscription mode, topic, device or gateway
+MIHOME_MQTT_SUB_MODE: str = 'topic'
+# Cloud mqtt connections, devices are hashed across them
+MIHOME_MQTT_CLOUD_SHARDS: int = 1
+# seconds, entity reads are served from pushed or read values this fresh
+MIHOME_PROP_SHADOW_MAX_AGE: float = 5
+# seconds, lower priority properties are refreshed over this window at startup
+MIHOME_STARTUP_REFRESH_WINDOW: float = 60
 # seconds, 3 days
 MIHOME_CERT_EXPIRE_MARGIN: int = 3600*24*3
 
@@ -46,29 +46,34 @@ off Xiaomi or its affiliates' products.
 MIoT client instance.
 """
 from copy import deepcopy
-from typing import Any, Callable, Optional, final
+from typing import Any, Callable, Coroutine, Optional, final
 import asyncio
+import heapq
 import json
 import logging
+import random
 import time
 import traceback
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum, auto
 
 from homeassistant.core import HomeAssistant
 from homeassistant.components import zeroconf
 
 # pylint: disable=relative-beyond-top-level
-from .common import MIoTMatcher, slugify_did
+from .common import (
+    MIoTMatcher, MIoTPropShadow, MIoTReactor, MIoTRouteStats, slugify_did)
 from .const import (
     DEFAULT_CTRL_MODE, DEFAULT_INTEGRATION_LANGUAGE, DEFAULT_NICK_NAME, DOMAIN,
-    MIHOME_CERT_EXPIRE_MARGIN, NETWORK_REFRESH_INTERVAL,
+    MIHOME_CERT_EXPIRE_MARGIN, MIHOME_MQTT_CLOUD_SHARDS,
+    MIHOME_MQTT_SESSION_EXPIRY, MIHOME_MQTT_SUB_MODE,
+    MIHOME_STARTUP_REFRESH_WINDOW, NETWORK_REFRESH_INTERVAL,
     OAUTH2_CLIENT_ID, SUPPORT_CENTRAL_GATEWAY_CTRL)
 from .miot_cloud import MIoTHttpClient, MIoTOauthClient
 from .miot_error import MIoTClientError, MIoTErrorCode
 from .miot_mips import (
-    MIoTDeviceState, MipsCloudClient, MipsDeviceState,
-    MipsLocalClient)
+    MIoTDeviceState, MipsCloudShardedClient, MipsDeviceState,
+    MipsLocalClient, MipsSubMode)
 from .miot_lan import MIoTLan
 from .miot_network import MIoTNetwork
 from .miot_storage import MIoTCert, MIoTStorage
@@ -77,6 +82,46 @@ from .miot_i18n import MIoTI18n
 
 _LOGGER = logging.getLogger(__name__)
 
+# Properties per cloud get_props request when refreshing
+REFRESH_PROPS_CLOUD_BATCH: int = 150
+# Concurrent cloud batches and lan devices per refresh cycle
+REFRESH_PROPS_CLOUD_CONCURRENCY: int = 4
+REFRESH_PROPS_LAN_CONCURRENCY: int = 8
+# Startup refresh priority. HIGH is refreshed at once, NORMAL is spread
+# over the first half of the startup window and LOW over the second half
+REFRESH_PRIORITY_HIGH: int = 0
+REFRESH_PRIORITY_NORMAL: int = 1
+REFRESH_PRIORITY_LOW: int = 2
+# seconds, a refresh is skipped if the last known value is this fresh.
+# Only values received since the device was last offline count, and for a
+# device that was never offline only during the startup window
+REFRESH_PROPS_FRESHNESS: dict[int, float] = {
+    REFRESH_PRIORITY_HIGH: 60,
+    REFRESH_PRIORITY_NORMAL: 900,
+    REFRESH_PRIORITY_LOW: 3600}
+# seconds, last known property values are saved at most this often and
+# restored at startup if younger than PROP_SHADOW_RESTORE_MAX_AGE
+PROP_SHADOW_SAVE_INTERVAL: float = 300
+PROP_SHADOW_RESTORE_MAX_AGE: float = 3600*24
+# Resync after a push channel gap, devices whose pushes came from the
+# channel are re-read in batches once it reconnects, seconds
+PUSH_GAP_RESYNC_DELAY: float = 3
+PUSH_GAP_RESYNC_BATCH: int = 10
+PUSH_GAP_RESYNC_INTERVAL: float = 1
+# Push source switching hysteresis, seconds. A device stays on its push
+# source for at least the hold time, and a better source must stay the
+# preferred one for the confirm time before the device moves to it. A
+# source that is lost is left at once
+MSG_SUB_HOLD_TIME: float = 30
+MSG_SUB_CONFIRM_TIME: float = 10
+# Request routes of a device
+ROUTE_GATEWAY: str = 'gateway'
+ROUTE_LAN: str = 'lan'
+ROUTE_CLOUD: str = 'cloud'
+# Result codes of the integration itself, e.g. timeout, not from the device
+ROUTE_LOCAL_ERROR_MIN: int = -10200
+ROUTE_LOCAL_ERROR_MAX: int = -10000
+
 
 @dataclass
 class MIoTClientSub:
@@ -89,6 +134,17 @@ class MIoTClientSub:
         return f'{self.topic}, {id(self.handler)}, {id(self.handler_ctx)}'
 
 
+@dataclass
+class MIoTClientWrite:
+    """Property write waiting for the in-flight write of the same
+    properties. Newer values replace the params, all callers get the
+    result of the write that is finally sent."""
+    params: Optional[list] = None
+    futs: list[asyncio.Future] = field(default_factory=list)
+    # Hedged requests of the last write that lost the race
+    pending: set[asyncio.Task] = field(default_factory=set)
+
+
 class CtrlMode(Enum):
     """MIoT client control mode."""
     AUTO = 0
@@ -134,10 +190,17 @@ class MIoTClient:
 
     # Multi local mips client, key=group_id
     _mips_local: dict[str, MipsLocalClient]
-    # Cloud mips client
-    _mips_cloud: MipsCloudClient
+    # Cloud mips client, devices hashed across mqtt_cloud_shards connections
+    _mips_cloud: MipsCloudShardedClient
     # MIoT lan client
     _miot_lan: MIoTLan
+    # Shared I/O thread for mips clients, None to use a thread per client
+    _reactor: Optional[MIoTReactor]
+    # Request outcomes per device and route, used to pick the route
+    _route_stats: MIoTRouteStats
+    # Last known property values from pushes and read replies, persisted
+    _prop_shadow: MIoTPropShadow
+    _prop_shadow_save_timer: Optional[asyncio.TimerHandle]
 
     # Device list load from local storage, {did: <info>}
     _device_list_cache: dict[str, dict]
@@ -151,6 +214,14 @@ class MIoTClient:
     _device_list_update_ts: int
 
     _sub_source_list: dict[str, Optional[str]]
+    # Wall clock time each device last went offline, {did: ts}
+    _device_offline_ts: dict[str, float]
+    # Push source switching, last switch time, better source waiting for
+    # confirmation {did: (source, since)} and its re-evaluation timers
+    _sub_source_ts: dict[str, float]
+    _sub_source_pending: dict[str, tuple[str, float]]
+    _sub_source_timers: dict[str, asyncio.TimerHandle]
+    _sub_source_stats: dict[str, int]
     _sub_tree: MIoTMatcher
     _sub_device_state: dict[str, MipsDeviceState]
 
@@ -158,10 +229,27 @@ class MIoTClient:
     _refresh_token_timer: Optional[asyncio.TimerHandle]
     _refresh_cert_timer: Optional[asyncio.TimerHandle]
     _refresh_cloud_devices_timer: Optional[asyncio.TimerHandle]
+    # Set after the first refresh of all cloud devices
+    _cloud_devices_refreshed: bool
+    # Devices of reconnected cloud shards waiting for a refresh
+    _refresh_cloud_dids: set[str]
+    _refresh_cloud_dids_timer: Optional[asyncio.TimerHandle]
     # Refresh prop
     _refresh_props_list: dict[str, dict]
     _refresh_props_timer: Optional[asyncio.TimerHandle]
     _refresh_props_retry_count: int
+    # Startup refresh and push gap resync, requests are deferred until
+    # their release time and skipped if a value arrived after since_ts,
+    # [(release_ts, key, params, since_ts)]
+    _startup_ts: float
+    _startup_refresh_end: float
+    _refresh_props_deferred: list[tuple[float, str, dict, float]]
+    _refresh_props_deferred_timer: Optional[asyncio.TimerHandle]
+    # Push channels that are down, {key: (start_ts, [did])}, key is the
+    # cloud shard client id, the gateway group id or 'lan'
+    _push_gaps: dict[str, tuple[float, list[str]]]
+    # Coalesced property writes, {(did, ((siid, piid), ...)): write}
+    _write_queue: dict[tuple[str, tuple], MIoTClientWrite]
 
     # Persistence notify handler, params: notify_id, title, message
     _persistence_notify: Callable[[str, Optional[str], Optional[str]], None]
@@ -182,6 +270,7 @@ class MIoTClient:
             storage: MIoTStorage,
             mips_service: MipsService,
             miot_lan: MIoTLan,
+            reactor: Optional[MIoTReactor] = None,
             loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
         # MUST run in a running event loop
         self._main_loop = loop or asyncio.get_running_loop()
@@ -205,6 +294,7 @@ class MIoTClient:
         self._network = network
         self._storage = storage
         self._mips_service = mips_service
+        self._reactor = reactor
         self._oauth = None
         self._http = None
         self._i18n = None
@@ -214,6 +304,9 @@ class MIoTClient:
         self._mips_local = {}
         self._mips_cloud = None
         self._miot_lan = miot_lan
+        self._route_stats = MIoTRouteStats()
+        self._prop_shadow = MIoTPropShadow()
+        self._prop_shadow_save_timer = None
 
         self._device_list_cache = {}
         self._device_list_cloud = {}
@@ -221,6 +314,11 @@ class MIoTClient:
         self._device_list_lan = {}
         self._device_list_update_ts = 0
         self._sub_source_list = {}
+        self._device_offline_ts = {}
+        self._sub_source_ts = {}
+        self._sub_source_pending = {}
+        self._sub_source_timers = {}
+        self._sub_source_stats = {'switched': 0, 'delayed': 0, 'suppressed': 0}
         self._sub_tree = MIoTMatcher()
         self._sub_device_state = {}
 
@@ -228,11 +326,20 @@ class MIoTClient:
         self._refresh_token_timer = None
         self._refresh_cert_timer = None
         self._refresh_cloud_devices_timer = None
+        self._cloud_devices_refreshed = False
+        self._refresh_cloud_dids = set()
+        self._refresh_cloud_dids_timer = None
 
         # Refresh prop
         self._refresh_props_list = {}
         self._refresh_props_timer = None
         self._refresh_props_retry_count = 0
+        self._startup_ts = 0
+        self._startup_refresh_end = 0
+        self._refresh_props_deferred = []
+        self._push_gaps = {}
+        self._refresh_props_deferred_timer = None
+        self._write_queue = {}
 
         self._persistence_notify = None
         self._show_devices_changed_notify_timer = None
@@ -246,6 +353,10 @@ class MIoTClient:
             'display_binary_mode', ['text'])
 
     async def init_async(self) -> None:
+        # Stage the property refresh of the entities set up from now on
+        self._startup_ts = time.time()
+        self._startup_refresh_end = (
+            self._main_loop.time() + self.startup_refresh_window)
         # Load user config and check
         self._user_config = await self._storage.load_user_config_async(
             uid=self._uid, cloud_server=self._cloud_server)
@@ -261,6 +372,8 @@ class MIoTClient:
         await self._i18n.init_async()
         # Load cache device list
         await self.__load_cache_device_async()
+        # Load last known property values
+        await self.__load_prop_shadow_async()
         # MIoT oauth client instance
         self._oauth = MIoTOauthClient(
             client_id=OAUTH2_CLIENT_ID,
@@ -280,11 +393,16 @@ class MIoTClient:
             uid=self._uid,
             cloud_server=self.cloud_server)
         # MIoT cloud mips client
-        self._mips_cloud = MipsCloudClient(
+        self._mips_cloud = MipsCloudShardedClient(
             uuid=self._entry_data['uuid'],
             cloud_server=self._cloud_server,
             app_id=OAUTH2_CLIENT_ID,
             token=self._user_config['auth_info']['access_token'],
+            shards=self.mqtt_cloud_shards,
+            session_expiry=self.mqtt_session_expiry,
+            sub_mode=self.mqtt_sub_mode,
+            qos_policy=self.mqtt_qos_policy,
+            reactor=self._reactor,
             loop=self._main_loop)
         self._mips_cloud.enable_logger(logger=_LOGGER)
         self._mips_cloud.sub_mips_state(
@@ -320,11 +438,16 @@ class MIoTClient:
                         did=self._entry_data['virtual_did'],
                         group_id=info['group_id'],
                         host=service_data['addresses'][0],
+                        hosts=service_data['addresses'],
                         ca_file=self._cert.ca_file,
                         cert_file=self._cert.cert_file,
                         key_file=self._cert.key_file,
                         port=service_data['port'],
                         home_name=info['home_name'],
+                        session_expiry=self.mqtt_session_expiry,
+                        sub_mode=self.mqtt_sub_mode,
+                        qos_policy=self.mqtt_qos_policy,
+                        reactor=self._reactor,
                         loop=self._main_loop)
                     self._mips_local[info['group_id']] = mips
                     mips.enable_logger(logger=_LOGGER)
@@ -363,6 +486,27 @@ class MIoTClient:
             self._refresh_props_timer = None
         self._refresh_props_list.clear()
         self._refresh_props_retry_count = 0
+        if self._refresh_props_deferred_timer:
+            self._refresh_props_deferred_timer.cancel()
+            self._refresh_props_deferred_timer = None
+        self._refresh_props_deferred.clear()
+        self._push_gaps.clear()
+        # Cancel push source switching
+        for timer in self._sub_source_timers.values():
+            timer.cancel()
+        self._sub_source_timers.clear()
+        self._sub_source_pending.clear()
+        # Save last known property values
+        if self._prop_shadow_save_timer:
+            self._prop_shadow_save_timer.cancel()
+            self._prop_shadow_save_timer = None
+            await self.__save_prop_shadow_async()
+        # Cancel coalesced writes
+        for write in self._write_queue.values():
+            for fut in write.futs:
+                if not fut.done():
+                    fut.cancel()
+        self._write_queue.clear()
         # Cloud mips
         self._mips_cloud.unsub_mips_state(
             key=f'{self._uid}-{self._cloud_server}')
@@ -371,6 +515,10 @@ class MIoTClient:
         if self._refresh_cloud_devices_timer:
             self._refresh_cloud_devices_timer.cancel()
             self._refresh_cloud_devices_timer = None
+        if self._refresh_cloud_dids_timer:
+            self._refresh_cloud_dids_timer.cancel()
+            self._refresh_cloud_dids_timer = None
+        self._refresh_cloud_dids.clear()
         if self._ctrl_mode == CtrlMode.AUTO:
             # Central hub gateway mips
             if self._cloud_server in SUPPORT_CENTRAL_GATEWAY_CTRL:
@@ -469,11 +617,78 @@ class MIoTClient:
     def action_debug(self) -> bool:
         return self._entry_data.get('action_debug', False)
 
+    @property
+    def ctrl_hedging(self) -> bool:
+        """Hedge idempotent commands over the next route if the primary
+        route is slower than its usual latency."""
+        return self._entry_data.get('ctrl_hedging', False)
+
     @property
     def hide_non_standard_entities(self) -> bool:
         return self._entry_data.get(
             'hide_non_standard_entities', False)
 
+    @property
+    def mqtt_session_expiry(self) -> int:
+        """MQTT session expiry interval in seconds, 0 for clean sessions."""
+        return self._entry_data.get(
+            'mqtt_session_expiry', MIHOME_MQTT_SESSION_EXPIRY)
+
+    @property
+    def mqtt_sub_mode(self) -> MipsSubMode:
+        """Broadcast subscriptions per topic, per device or per gateway."""
+        return MipsSubMode.load(self._entry_data.get(
+            'mqtt_sub_mode', MIHOME_MQTT_SUB_MODE))
+
+    @property
+    def mqtt_qos_policy(self) -> Optional[dict[str, int]]:
+        """MQTT QoS override per topic class, None for the defaults."""
+        return self._entry_data.get('mqtt_qos_policy', None)
+
+    @property
+    def mqtt_cloud_shards(self) -> int:
+        """Number of cloud MQTT connections the devices are sharded over."""
+        return max(1, int(self._entry_data.get(
+            'mqtt_cloud_shards', MIHOME_MQTT_CLOUD_SHARDS)))
+
+    @property
+    def startup_refresh_window(self) -> float:
+        """Seconds over which the startup refresh of lower priority
+        properties is spread, 0 to refresh everything at once."""
+        return self._entry_data.get(
+            'startup_refresh_window', MIHOME_STARTUP_REFRESH_WINDOW)
+
+    @property
+    def route_stats(self) -> dict:
+        """Last used route and route scores of each device."""
+        return self._route_stats.stats()
+
+    @property
+    def diagnostics(self) -> dict:
+        """Route scores and request stats of the local routes."""
+        return {
+            'routes': self._route_stats.stats(),
+            'gateways': {
+                group_id: {
+                    'connected': mips.mips_state,
+                    'degraded': mips.degraded,
+                    'requests': mips.request_stats}
+                for group_id, mips in self._mips_local.items()},
+            'lan': {
+                'requests': self._miot_lan.request_stats
+            } if self._miot_lan else None,
+            'cloud': {'connected': self._mips_cloud.mips_state}
+            if self._mips_cloud else None,
+            'prop_shadow': self._prop_shadow.stats(),
+            'push_gaps': {
+                key: {'start_ts': start_ts, 'devices': len(dids)}
+                for key, (start_ts, dids) in self._push_gaps.items()},
+            'msg_sub': {
+                **self._sub_source_stats,
+                'pending': {
+                    did: source for did, (source, _)
+                    in self._sub_source_pending.items()}}}
+
     @property
     def display_devices_changed_notify(self) -> list[str]:
         return self._display_devs_notify
@@ -615,127 +830,365 @@ class MIoTClient:
     async def set_prop_async(
         self, did: str, siid: int, piid: int, value: Any
     ) -> bool:
+        return await self.set_props_async(
+            did=did, params=[{'siid': siid, 'piid': piid, 'value': value}])
+
+    async def set_props_async(self, did: str, params: list) -> bool:
+        """
+        params = [{"siid": 2, "piid": 1, "value": False}, ...]
+        All properties of the device are set with one request.
+        Last write wins: while a write of the same properties is in
+        flight, newer values replace the queued one, only the latest is
+        sent once the in-flight write completes.
+        """
         if did not in self._device_list_cache:
             raise MIoTClientError(f'did not exist, {did}')
-        # Priority local control
-        if self._ctrl_mode == CtrlMode.AUTO:
-            # Gateway control
-            device_gw = self._device_list_gateway.get(did, None)
-            if (
-                device_gw and device_gw.get('online', False)
-                and device_gw.get('specv2_access', False)
-                and 'group_id' in device_gw
-            ):
-                mips = self._mips_local.get(device_gw['group_id'], None)
-                if mips is None:
-                    _LOGGER.error(
-                        'no gw route, %s, try control throw cloud',
-                        device_gw)
-                else:
-                    result = await mips.set_prop_async(
-                        did=did, siid=siid, piid=piid, value=value)
-                    rc = (result or {}).get(
-                        'code', MIoTErrorCode.CODE_MIPS_INVALID_RESULT.value)
-                    if rc in [0, 1]:
-                        return True
-                    raise MIoTClientError(
-                        self.__get_exec_error_with_rc(rc=rc))
-            # Lan control
-            device_lan = self._device_list_lan.get(did, None)
-            if device_lan and device_lan.get('online', False):
-                result = await self._miot_lan.set_prop_async(
-                    did=did, siid=siid, piid=piid, value=value)
-                _LOGGER.debug(
-                    'lan set prop, %s, %s, %s -> %s', did, siid, piid, result)
-                rc = (result or {}).get(
-                    'code', MIoTErrorCode.CODE_MIPS_INVALID_RESULT.value)
-                if rc in [0, 1]:
-                    return True
-                raise MIoTClientError(
-                    self.__get_exec_error_with_rc(rc=rc))
-
-        # Cloud control
-        device_cloud = self._device_list_cloud.get(did, None)
-        if device_cloud and device_cloud.get('online', False):
-            result = await self._http.set_prop_async(
-                params=[
-                    {'did': did, 'siid': siid, 'piid': piid, 'value': value}
-                ])
-            _LOGGER.debug(
-                'set prop response, %s.%d.%d, %s, result, %s',
-                did, siid, piid, value, result)
-            if result and len(result) == 1:
-                rc = result[0].get(
-                    'code', MIoTErrorCode.CODE_MIPS_INVALID_RESULT.value)
-                if rc in [0, 1]:
-                    return True
-                if rc in [-704010000, -704042011]:
-                    # Device remove or offline
-                    _LOGGER.error('device may be removed or offline, %s', did)
-                    self._main_loop.create_task(
-                        await self.__refresh_cloud_device_with_dids_async(
-                            dids=[did]))
-                raise MIoTClientError(
-                    self.__get_exec_error_with_rc(rc=rc))
+        if not params:
+            return True
+        key = (did, tuple(
+            (param['siid'], param['piid']) for param in params))
+        write = self._write_queue.get(key, None)
+        if write:
+            if write.params is not None:
+                _LOGGER.debug('coalesce prop write, %s, %s', did, params)
+            write.params = params
+            fut: asyncio.Future = self._main_loop.create_future()
+            write.futs.append(fut)
+            return await fut
+        write = MIoTClientWrite()
+        self._write_queue[key] = write
+        try:
+            return await self.__set_props_async(
+                did=did, params=params, pending=write.pending)
+        finally:
+            self.__write_next(key=key)
+
+    def __write_next(self, key: tuple[str, tuple]) -> None:
+        """Send the latest queued write of the properties, if any."""
+        write = self._write_queue.get(key, None)
+        if not write:
+            return
+        if write.pending:
+            # A losing hedged request may still reach the device, it must
+            # not land after the next write
+            next(iter(write.pending)).add_done_callback(
+                lambda _: self.__write_next(key=key))
+            return
+        if write.params is None:
+            self._write_queue.pop(key, None)
+            return
+        params, futs = write.params, write.futs
+        write.params, write.futs = None, []
+
+        async def send() -> None:
+            try:
+                result = await self.__set_props_async(
+                    did=key[0], params=params, pending=write.pending)
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                for fut in futs:
+                    if not fut.done():
+                        fut.set_exception(err)
+            else:
+                for fut in futs:
+                    if not fut.done():
+                        fut.set_result(result)
+            finally:
+                self.__write_next(key=key)
+        self._main_loop.create_task(send())
+
+    async def __set_props_async(
+        self, did: str, params: list,
+        pending: Optional[set[asyncio.Task]] = None
+    ) -> bool:
+        if did not in self._device_list_cache:
+            raise MIoTClientError(f'did not exist, {did}')
+        # Priority local control, unless the scores say otherwise
+        routes = self.__rank_routes(
+            did=did, routes=[ROUTE_GATEWAY, ROUTE_LAN, ROUTE_CLOUD])
+        if routes:
+            if self.ctrl_hedging and len(routes) > 1:
+                # Setting properties is idempotent, hedge over the next
+                # route if the primary one is slow
+                rc = await self.__hedged_call_async(
+                    did=did, routes=routes,
+                    call=lambda route: self.__set_props_route_async(
+                        did=did, route=route, params=params),
+                    pending=pending)
+            else:
+                rc = await self.__set_props_route_async(
+                    did=did, route=routes[0], params=params)
+            if rc == 0:
+                # Reads must not serve the value from before the write
+                for param in params:
+                    self.__update_prop_shadow(
+                        did=did, siid=param['siid'], piid=param['piid'],
+                        value=param['value'], source='set')
+                return True
+            if rc == 1:
+                # Accepted but not applied yet, read the real value back
+                for param in params:
+                    self._prop_shadow.remove(
+                        did=did, siid=param['siid'], piid=param['piid'])
+                    self.__request_refresh_props(
+                        key=f'{did}|{param["siid"]}|{param["piid"]}',
+                        params={
+                            'did': did, 'siid': param['siid'],
+                            'piid': param['piid']})
+                return True
+            raise MIoTClientError(self.__get_exec_error_with_rc(rc=rc))
 
         # Show error message
         raise MIoTClientError(
             f'{self._i18n.translate("miot.client.device_exec_error")}, '
             f'{self._i18n.translate("error.common.-10007")}')
 
+    async def __set_props_route_async(
+        self, did: str, route: str, params: list
+    ) -> int:
+        """Set the properties over one route, return the first failed
+        result code, or the success code."""
+        if route == ROUTE_CLOUD:
+            result = await self.__route_call_async(
+                did=did, route=route,
+                coro=self._http.set_prop_async(params=[
+                    {'did': did, **param} for param in params]),
+                check=lambda result: (
+                    bool(result) and len(result) == len(params)))
+            _LOGGER.debug(
+                'set prop response, %s, %s, result, %s', did, params, result)
+            if not result or len(result) != len(params):
+                return MIoTErrorCode.CODE_MIPS_INVALID_RESULT.value
+            rc = self.__merge_props_rc(results=result)
+            if rc in [-704010000, -704042011]:
+                # Device remove or offline
+                _LOGGER.error('device may be removed or offline, %s', did)
+                self._main_loop.create_task(
+                    await self.__refresh_cloud_device_with_dids_async(
+                        dids=[did]))
+            return rc
+        if route == ROUTE_GATEWAY:
+            coro = self.__get_gw_route(did=did).set_props_async(
+                did=did, params=params)
+        else:
+            coro = self._miot_lan.set_props_async(did=did, params=params)
+        result = await self.__route_call_async(
+            did=did, route=route, coro=coro,
+            check=lambda result: self.__route_result_ok(
+                {'code': self.__merge_props_rc(results=result)}))
+        _LOGGER.debug('%s set prop, %s, %s -> %s', route, did, params, result)
+        return self.__merge_props_rc(results=result)
+
+    @staticmethod
+    def __merge_props_rc(results: Optional[list]) -> int:
+        if not results:
+            return MIoTErrorCode.CODE_MIPS_INVALID_RESULT.value
+        rc: int = 0
+        for result in results:
+            item_rc = (result or {}).get(
+                'code', MIoTErrorCode.CODE_MIPS_INVALID_RESULT.value)
+            if item_rc not in [0, 1]:
+                return item_rc
+            rc = max(rc, item_rc)
+        return rc
+
     def request_refresh_prop(
-        self, did: str, siid: int, piid: int
+        self, did: str, siid: int, piid: int,
+        priority: int = REFRESH_PRIORITY_HIGH
     ) -> None:
         if did not in self._device_list_cache:
             raise MIoTClientError(f'did not exist, {did}')
         key: str = f'{did}|{siid}|{piid}'
         if key in self._refresh_props_list:
             return
-        self._refresh_props_list[key] = {
-            'did': did, 'siid': siid, 'piid': piid}
+        now: float = self._main_loop.time()
+        max_age: float = REFRESH_PROPS_FRESHNESS.get(priority, 0)
+        if did in self._device_offline_ts:
+            # Values from before an outage must be read again
+            max_age = min(
+                max_age, time.time()-self._device_offline_ts[did])
+        elif now >= self._startup_refresh_end:
+            max_age = 0
+        if max_age > 0 and self._prop_shadow.get(
+                did=did, siid=siid, piid=piid, max_age=max_age):
+            # Still fresh, e.g. restored at startup or pushed
+            return
+        params = {'did': did, 'siid': siid, 'piid': piid}
+        if (
+            priority > REFRESH_PRIORITY_HIGH
+            and now < self._startup_refresh_end
+        ):
+            # Startup, spread by priority over the window
+            start = self._startup_refresh_end - self.startup_refresh_window
+            half = self.startup_refresh_window / 2
+            release_ts = max(now, start + half*(
+                min(priority, REFRESH_PRIORITY_LOW)-1+random.random()))
+            heapq.heappush(
+                self._refresh_props_deferred,
+                (release_ts, key, params, self._startup_ts))
+            self.__schedule_deferred_refresh()
+            return
+        self.__request_refresh_props(key=key, params=params)
+
+    def __request_refresh_props(self, key: str, params: dict) -> None:
+        self._refresh_props_list[key] = params
         if self._refresh_props_timer:
             return
         self._refresh_props_timer = self._main_loop.call_later(
             0.2, lambda: self._main_loop.create_task(
                 self.__refresh_props_handler()))
 
-    async def get_prop_async(self, did: str, siid: int, piid: int) -> Any:
+    def __set_device_online(self, did: str, state: Optional[bool]) -> None:
+        self._device_list_cache[did]['online'] = state
+        if not state:
+            self._device_offline_ts[did] = time.time()
+
+    def get_last_prop_value(self, did: str, siid: int, piid: int) -> Any:
+        """Last known value, pushed, read or restored from storage. None
+        if unknown."""
+        item = self._prop_shadow.get(
+            did=did, siid=siid, piid=piid,
+            max_age=PROP_SHADOW_RESTORE_MAX_AGE)
+        return item[0] if item else None
+
+    def __update_prop_shadow(
+        self, did: str, siid: int, piid: int, value: Any, source: str
+    ) -> None:
+        self._prop_shadow.update(
+            did=did, siid=siid, piid=piid, value=value, source=source)
+        if self._prop_shadow_save_timer:
+            return
+        self._prop_shadow_save_timer = self._main_loop.call_later(
+            PROP_SHADOW_SAVE_INTERVAL, lambda: self._main_loop.create_task(
+                self.__save_prop_shadow_async()))
+
+    async def __load_prop_shadow_async(self) -> None:
+        data = await self._storage.load_async(
+            domain='miot_props', name=f'{self._uid}_{self._cloud_server}',
+            type_=dict)  # type: ignore
+        if not data:
+            return
+        count = self._prop_shadow.load(
+            data=data, max_age=PROP_SHADOW_RESTORE_MAX_AGE)
+        _LOGGER.info('restore last known props, %s', count)
+
+    async def __save_prop_shadow_async(self) -> None:
+        self._prop_shadow_save_timer = None
+        if not await self._storage.save_async(
+            domain='miot_props', name=f'{self._uid}_{self._cloud_server}',
+            data=self._prop_shadow.to_dict()
+        ):
+            _LOGGER.error('save last known props failed')
+
+    def __schedule_deferred_refresh(self) -> None:
+        if self._refresh_props_deferred_timer:
+            self._refresh_props_deferred_timer.cancel()
+            self._refresh_props_deferred_timer = None
+        if not self._refresh_props_deferred:
+            return
+        self._refresh_props_deferred_timer = self._main_loop.call_at(
+            self._refresh_props_deferred[0][0],
+            self.__deferred_refresh_handler)
+
+    def __open_push_gap(self, key: str, dids: list[str]) -> None:
+        """Remember the devices pushed from a channel that went down."""
+        if key in self._push_gaps:
+            start_ts, dids_old = self._push_gaps[key]
+            self._push_gaps[key] = (
+                start_ts, list(dict.fromkeys(dids_old + dids)))
+            return
+        self._push_gaps[key] = (time.time(), dids)
+
+    def __close_push_gap(self, key: str) -> None:
+        """Re-read the known properties of the devices of a gap."""
+        gap = self._push_gaps.pop(key, None)
+        if not gap:
+            return
+        start_ts, dids = gap
+        dids = [did for did in dids if did in self._device_list_cache]
+        if not dids:
+            return
+        now_ts: float = time.time()
+        now: float = self._main_loop.time()
+        props: dict[str, list[tuple[int, int]]] = {}
+        for did, siid, piid in self._prop_shadow.keys():
+            props.setdefault(did, []).append((siid, piid))
+        count: int = 0
+        for index, did in enumerate(dids):
+            release_ts = now + PUSH_GAP_RESYNC_DELAY + (
+                index // PUSH_GAP_RESYNC_BATCH) * PUSH_GAP_RESYNC_INTERVAL
+            for siid, piid in props.get(did, []):
+                heapq.heappush(self._refresh_props_deferred, (
+                    release_ts, f'{did}|{siid}|{piid}',
+                    {'did': did, 'siid': siid, 'piid': piid}, now_ts))
+                count += 1
+        _LOGGER.info(
+            'push gap closed, %s, %.1fs, resync %s props of %s devices',
+            key, now_ts-start_ts, count, len(dids))
+        if count:
+            self.__schedule_deferred_refresh()
+
+    def __deferred_refresh_handler(self) -> None:
+        self._refresh_props_deferred_timer = None
+        now: float = self._main_loop.time()
+        while (
+            self._refresh_props_deferred
+            and self._refresh_props_deferred[0][0] <= now
+        ):
+            _, key, params, since_ts = heapq.heappop(
+                self._refresh_props_deferred)
+            if params['did'] not in self._device_list_cache:
+                continue
+            # Values pushed or read since then need no refresh
+            if self._prop_shadow.get(
+                    did=params['did'], siid=params['siid'],
+                    piid=params['piid'], max_age=time.time()-since_ts):
+                continue
+            self.__request_refresh_props(key=key, params=params)
+        self.__schedule_deferred_refresh()
+
+    async def get_prop_async(
+        self, did: str, siid: int, piid: int,
+        max_age: Optional[float] = None
+    ) -> Any:
+        """Read a property. With max_age (seconds), a value pushed or read
+        within max_age is returned from the shadow without a request."""
         if did not in self._device_list_cache:
             raise MIoTClientError(f'did not exist, {did}')
+        if max_age is not None:
+            shadow = self._prop_shadow.get(
+                did=did, siid=siid, piid=piid, max_age=max_age)
+            if shadow:
+                return shadow[0]
 
         # NOTICE: Since there are too many request attributes and obtaining
         # them directly from the hub or device will cause device abnormalities,
-        # so obtaining the cache from the cloud is the priority here.
-        try:
-            if self._network.network_status:
-                result = await self._http.get_prop_async(
-                    did=did, siid=siid, piid=piid)
-                if result:
-                    return result
-        except Exception as err:  # pylint: disable=broad-exception-caught
-            # Catch all exceptions
-            _LOGGER.error(
-                'client get prop from cloud error, %s, %s',
-                err, traceback.format_exc())
-        if self._ctrl_mode == CtrlMode.AUTO:
-            # Central hub gateway
-            device_gw = self._device_list_gateway.get(did, None)
-            if (
-                device_gw and device_gw.get('online', False)
-                and device_gw.get('specv2_access', False)
-                and 'group_id' in device_gw
-            ):
-                mips = self._mips_local.get(device_gw['group_id'], None)
-                if mips is None:
-                    _LOGGER.error('no gw route, %s', device_gw)
+        # so the cloud cache is preferred, a local route is only used first
+        # if it scores clearly better.
+        for route in self.__rank_routes(
+                did=did, routes=[ROUTE_CLOUD, ROUTE_GATEWAY, ROUTE_LAN]):
+            try:
+                if route == ROUTE_CLOUD:
+                    coro = self._http.get_prop_async(
+                        did=did, siid=siid, piid=piid)
+                elif route == ROUTE_GATEWAY:
+                    coro = self.__get_gw_route(did=did).get_prop_async(
+                        did=did, siid=siid, piid=piid)
                 else:
-                    return await mips.get_prop_async(
+                    coro = self._miot_lan.get_prop_async(
                         did=did, siid=siid, piid=piid)
-            # Lan
-            device_lan = self._device_list_lan.get(did, None)
-            if device_lan and device_lan.get('online', False):
-                return await self._miot_lan.get_prop_async(
-                    did=did, siid=siid, piid=piid)
+                result = await self.__route_call_async(
+                    did=did, route=route, coro=coro,
+                    check=lambda result: result is not None)
+                if result is not None:
+                    self.__update_prop_shadow(
+                        did=did, siid=siid, piid=piid, value=result,
+                        source=route)
+                    return result
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                # Catch all exceptions, try the next route
+                _LOGGER.error(
+                    'client get prop from %s error, %s, %s',
+                    route, err, traceback.format_exc())
         # _LOGGER.error(
         #     'client get prop failed, no-link, %s.%d.%d', did, siid, piid)
         return None
@@ -746,45 +1199,33 @@ class MIoTClient:
         if did not in self._device_list_cache:
             raise MIoTClientError(f'did not exist, {did}')
 
-        device_gw = self._device_list_gateway.get(did, None)
-        # Priority local control
-        if self._ctrl_mode == CtrlMode.AUTO:
-            if (
-                device_gw and device_gw.get('online', False)
-                and device_gw.get('specv2_access', False)
-                and 'group_id' in device_gw
-            ):
-                mips = self._mips_local.get(
-                    device_gw['group_id'], None)
-                if mips is None:
-                    _LOGGER.error('no gw route, %s', device_gw)
-                else:
-                    result = await mips.action_async(
-                        did=did, siid=siid, aiid=aiid, in_list=in_list)
-                    rc = (result or {}).get(
-                        'code', MIoTErrorCode.CODE_MIPS_INVALID_RESULT.value)
-                    if rc in [0, 1]:
-                        return result.get('out', [])
-                    raise MIoTClientError(
-                        self.__get_exec_error_with_rc(rc=rc))
-            # Lan control
-            device_lan = self._device_list_lan.get(did, None)
-            if device_lan and device_lan.get('online', False):
-                result = await self._miot_lan.action_async(
+        # Priority local control, unless the scores say otherwise
+        routes = self.__rank_routes(
+            did=did, routes=[ROUTE_GATEWAY, ROUTE_LAN, ROUTE_CLOUD])
+        route = routes[0] if routes else None
+        if route in [ROUTE_GATEWAY, ROUTE_LAN]:
+            if route == ROUTE_GATEWAY:
+                coro = self.__get_gw_route(did=did).action_async(
                     did=did, siid=siid, aiid=aiid, in_list=in_list)
-                _LOGGER.debug(
-                    'lan action, %s, %s, %s -> %s', did, siid, aiid, result)
-                rc = (result or {}).get(
-                    'code', MIoTErrorCode.CODE_MIPS_INVALID_RESULT.value)
-                if rc in [0, 1]:
-                    return result.get('out', [])
-                raise MIoTClientError(
-                    self.__get_exec_error_with_rc(rc=rc))
-        # Cloud control
-        device_cloud = self._device_list_cloud.get(did, None)
-        if device_cloud and device_cloud.get('online', False):
-            result: dict = await self._http.action_async(
-                did=did, siid=siid, aiid=aiid, in_list=in_list)
+            else:
+                coro = self._miot_lan.action_async(
+                    did=did, siid=siid, aiid=aiid, in_list=in_list)
+            result = await self.__route_call_async(
+                did=did, route=route, coro=coro,
+                check=self.__route_result_ok)
+            _LOGGER.debug(
+                '%s action, %s, %s, %s -> %s', route, did, siid, aiid, result)
+            rc = (result or {}).get(
+                'code', MIoTErrorCode.CODE_MIPS_INVALID_RESULT.value)
+            if rc in [0, 1]:
+                return result.get('out', [])
+            raise MIoTClientError(self.__get_exec_error_with_rc(rc=rc))
+        if route == ROUTE_CLOUD:
+            result: dict = await self.__route_call_async(
+                did=did, route=route,
+                coro=self._http.action_async(
+                    did=did, siid=siid, aiid=aiid, in_list=in_list),
+                check=lambda result: bool(result))
             if result:
                 rc = result.get(
                     'code', MIoTErrorCode.CODE_MIPS_INVALID_RESULT.value)
@@ -877,6 +1318,9 @@ class MIoTClient:
         if did not in self._device_list_cache:
             return
         sub_from = self._sub_source_list.pop(did, None)
+        self.__clear_msg_sub_pending(did=did)
+        self._sub_source_ts.pop(did, None)
+        self._device_offline_ts.pop(did, None)
         # Unsub
         if sub_from:
             if sub_from == 'cloud':
@@ -889,6 +1333,8 @@ class MIoTClient:
                 mips = self._mips_local[sub_from]
                 mips.unsub_prop(did=did)
                 mips.unsub_event(did=did)
+        self._route_stats.remove(did=did)
+        self._prop_shadow.remove(did=did)
         # Storage
         await self._storage.save_async(
             domain='miot_devices',
@@ -914,6 +1360,125 @@ class MIoTClient:
             f'{self._i18n.translate(key="miot.client.device_exec_error")}, '
             + err_msg)
 
+    def __get_gw_route(self, did: str) -> Optional[MipsLocalClient]:
+        device_gw = self._device_list_gateway.get(did, None)
+        if not (
+            device_gw and device_gw.get('online', False)
+            and device_gw.get('specv2_access', False)
+            and 'group_id' in device_gw
+        ):
+            return None
+        mips = self._mips_local.get(device_gw['group_id'], None)
+        if mips is None:
+            _LOGGER.error('no gw route, %s', device_gw)
+            return None
+        if mips.degraded:
+            _LOGGER.info('gw degraded, %s, skip', device_gw['group_id'])
+            return None
+        return mips
+
+    def __rank_routes(self, did: str, routes: list[str]) -> list[str]:
+        """Filter the available routes, best scored first."""
+        available: list[str] = []
+        for route in routes:
+            if route == ROUTE_CLOUD:
+                if (
+                    self._network.network_status
+                    and self._device_list_cloud.get(did, {}).get(
+                        'online', False)
+                ):
+                    available.append(route)
+            elif self._ctrl_mode != CtrlMode.AUTO:
+                continue
+            elif route == ROUTE_GATEWAY:
+                if self.__get_gw_route(did=did):
+                    available.append(route)
+            elif route == ROUTE_LAN:
+                if self._device_list_lan.get(did, {}).get('online', False):
+                    available.append(route)
+        return self._route_stats.rank(did=did, routes=available)
+
+    async def __route_call_async(
+        self, did: str, route: str, coro: Coroutine,
+        check: Callable[[Any], bool]
+    ) -> Any:
+        """Await the request, record its outcome and latency."""
+        start_ts: float = self._main_loop.time()
+        try:
+            result = await coro
+        except Exception:
+            self._route_stats.record(
+                did=did, route=route, ok=False,
+                latency_s=self._main_loop.time()-start_ts)
+            raise
+        self._route_stats.record(
+            did=did, route=route, ok=check(result),
+            latency_s=self._main_loop.time()-start_ts)
+        return result
+
+    async def __hedged_call_async(
+        self, did: str, routes: list[str],
+        call: Callable[[str], Coroutine],
+        pending: Optional[set[asyncio.Task]] = None
+    ) -> int:
+        """Call the best route, and the next one each time the latency
+        budget of the primary route passes or a route fails locally. The
+        first success, or the first device error, wins. Slower requests
+        are not cancelled, they finish in the background and feed the
+        route scores. They are tracked in pending until they finish."""
+        budget: float = self._route_stats.latency_budget(
+            did=did, route=routes[0])
+        routes = list(routes)
+        tasks: dict[asyncio.Task, str] = {}
+        rc: int = MIoTErrorCode.CODE_MIPS_INVALID_RESULT.value
+
+        def start_next() -> None:
+            route = routes.pop(0)
+            task = self._main_loop.create_task(call(route))
+            task.add_done_callback(self.__hedged_task_done)
+            tasks[task] = route
+            if len(tasks) > 1:
+                _LOGGER.info('hedge request, %s, %s', did, route)
+
+        start_next()
+        while tasks:
+            done, _ = await asyncio.wait(
+                list(tasks.keys()), timeout=budget if routes else None,
+                return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                start_next()
+                continue
+            for task in done:
+                tasks.pop(task)
+                if task.exception():
+                    rc = MIoTErrorCode.CODE_INTERNAL_ERROR.value
+                    continue
+                rc = task.result()
+                if self.__route_result_ok({'code': rc}):
+                    if pending is not None:
+                        for loser in tasks:
+                            pending.add(loser)
+                            loser.add_done_callback(pending.discard)
+                    return rc
+            if routes:
+                # The route failed locally, do not wait for the budget
+                start_next()
+        return rc
+
+    @staticmethod
+    def __hedged_task_done(task: asyncio.Task) -> None:
+        # Retrieve the exception of requests that lost the race
+        if not task.cancelled():
+            task.exception()
+
+    @staticmethod
+    def __route_result_ok(result: Optional[dict]) -> bool:
+        # Device errors came back over the route, only local errors such
+        # as timeouts count against it
+        rc = (result or {}).get(
+            'code', MIoTErrorCode.CODE_MIPS_INVALID_RESULT.value)
+        return not ROUTE_LOCAL_ERROR_MIN < rc <= ROUTE_LOCAL_ERROR_MAX
+
     @final
     def __gen_notify_key(self, name: str) -> str:
         return f'{DOMAIN}-{self._uid}-{self._cloud_server}-{name}'
@@ -964,7 +1529,33 @@ class MIoTClient:
             from_new = 'cloud'
         if from_new == from_old:
             # No need to update
+            if self.__clear_msg_sub_pending(did=did):
+                self._sub_source_stats['suppressed'] += 1
             return
+        now: float = self._main_loop.time()
+        if from_old and self.__msg_sub_source_ok(did=did, source=from_old):
+            # Moving to a better source, dampen flapping
+            pending = self._sub_source_pending.get(did, None)
+            if not pending or pending[0] != from_new:
+                if pending:
+                    self._sub_source_stats['suppressed'] += 1
+                self._sub_source_stats['delayed'] += 1
+                pending = (from_new, now)  # type: ignore
+                self._sub_source_pending[did] = pending
+            switch_ts: float = max(
+                self._sub_source_ts.get(did, 0) + MSG_SUB_HOLD_TIME,
+                pending[1] + MSG_SUB_CONFIRM_TIME)
+            if now < switch_ts:
+                timer = self._sub_source_timers.pop(did, None)
+                if timer:
+                    timer.cancel()
+                self._sub_source_timers[did] = self._main_loop.call_at(
+                    switch_ts, self.__update_device_msg_sub, did)
+                _LOGGER.debug(
+                    'device sub change delayed, %s, from %s to %s, %.1fs',
+                    did, from_old, from_new, switch_ts-now)
+                return
+        self.__clear_msg_sub_pending(did=did)
         # Unsub old
         if from_old:
             if from_old == 'cloud':
@@ -979,19 +1570,49 @@ class MIoTClient:
                 mips.unsub_event(did=did)
         # Sub new
         if from_new == 'cloud':
-            self._mips_cloud.sub_prop(did=did, handler=self.__on_prop_msg)
+            self._mips_cloud.sub_prop(
+                did=did, handler=self.__on_prop_msg, handler_ctx=ROUTE_CLOUD)
             self._mips_cloud.sub_event(did=did, handler=self.__on_event_msg)
         elif from_new == 'lan':
-            self._miot_lan.sub_prop(did=did, handler=self.__on_prop_msg)
+            self._miot_lan.sub_prop(
+                did=did, handler=self.__on_prop_msg, handler_ctx=ROUTE_LAN)
             self._miot_lan.sub_event(did=did, handler=self.__on_event_msg)
         elif from_new in self._mips_local:
             mips = self._mips_local[from_new]
-            mips.sub_prop(did=did, handler=self.__on_prop_msg)
+            mips.sub_prop(
+                did=did, handler=self.__on_prop_msg, handler_ctx=ROUTE_GATEWAY)
             mips.sub_event(did=did, handler=self.__on_event_msg)
         self._sub_source_list[did] = from_new
+        self._sub_source_ts[did] = now
+        self._sub_source_stats['switched'] += 1
         _LOGGER.info(
             'device sub changed, %s, from %s to %s', did, from_old, from_new)
 
+    def __msg_sub_source_ok(self, did: str, source: str) -> bool:
+        """Whether the device can still be pushed from the source."""
+        if source == 'cloud':
+            return self._device_list_cloud.get(did, {}).get('online', False)
+        if source == 'lan':
+            info = self._device_list_lan.get(did, {})
+        else:
+            info = self._device_list_gateway.get(did, {})
+            if (
+                info.get('group_id', None) != source
+                or source not in self._mips_local
+            ):
+                return False
+        return (
+            self._ctrl_mode == CtrlMode.AUTO
+            and info.get('online', False)
+            and info.get('push_available', False))
+
+    def __clear_msg_sub_pending(self, did: str) -> bool:
+        """Drop the source waiting for confirmation, True if any."""
+        timer = self._sub_source_timers.pop(did, None)
+        if timer:
+            timer.cancel()
+        return self._sub_source_pending.pop(did, None) is not None
+
     @final
     async def __on_network_status_changed(self, status: bool) -> None:
         _LOGGER.info('network status changed, %s', status)
@@ -1027,9 +1648,11 @@ class MIoTClient:
                 return
             if (
                 mips.client_id == self._entry_data['virtual_did']
-                and mips.host == data['addresses'][0]
                 and mips.port == data['port']
             ):
+                if set(mips.hosts) != set(data['addresses']):
+                    # Keep the connection and subscriptions
+                    mips.update_hosts(data['addresses'])
                 return
             mips.disconnect()
             self._mips_local.pop(group_id, None)
@@ -1041,11 +1664,16 @@ class MIoTClient:
             did=self._entry_data['virtual_did'],
             group_id=group_id,
             host=data['addresses'][0],
+            hosts=data['addresses'],
             ca_file=self._cert.ca_file,
             cert_file=self._cert.cert_file,
             key_file=self._cert.key_file,
             port=data['port'],
             home_name=home_name,
+            session_expiry=self.mqtt_session_expiry,
+            sub_mode=self.mqtt_sub_mode,
+            qos_policy=self.mqtt_qos_policy,
+            reactor=self._reactor,
             loop=self._main_loop)
         self._mips_local[group_id] = mips
         mips.enable_logger(logger=_LOGGER)
@@ -1058,17 +1686,36 @@ class MIoTClient:
     async def __on_mips_cloud_state_changed(
         self, key: str, state: bool
     ) -> None:
+        # key is the client id of the shard, only its devices are affected
         _LOGGER.info('cloud mips state changed, %s, %s', key, state)
         if state:
             # Connect
-            self.__request_refresh_cloud_devices(immediately=True)
+            if len(self._mips_cloud.shards) <= 1:
+                self.__request_refresh_cloud_devices(immediately=True)
+            elif not self._cloud_devices_refreshed:
+                # First connect, one refresh for all shards
+                self.__request_refresh_cloud_devices()
+            else:
+                # Only the devices of this shard missed state changes
+                self.__request_refresh_cloud_dids(dids=[
+                    did for did in self._device_list_cache
+                    if self._mips_cloud.shard_id(did) == key])
             # Sub cloud device state
             for did in list(self._device_list_cache.keys()):
+                if self._mips_cloud.shard_id(did) != key:
+                    continue
                 self._mips_cloud.sub_device_state(
                     did=did, handler=self.__on_cloud_device_state_changed)
+            self.__close_push_gap(key=key)
         else:
             # Disconnect
+            self.__open_push_gap(key=key, dids=[
+                did for did, source in self._sub_source_list.items()
+                if source == 'cloud'
+                and self._mips_cloud.shard_id(did) == key])
             for did, info in self._device_list_cloud.items():
+                if self._mips_cloud.shard_id(did) != key:
+                    continue
                 cloud_state_old: Optional[bool] = info.get('online', None)
                 if not cloud_state_old:
                     # Cloud state is None or False, no need to update
@@ -1086,7 +1733,7 @@ class MIoTClient:
                     self._device_list_lan.get(did, {}).get('online', False))
                 if state_old == state_new:
                     continue
-                self._device_list_cache[did]['online'] = state_new
+                self.__set_device_online(did=did, state=state_new)
                 sub = self._sub_device_state.get(did, None)
                 if sub and sub.handler:
                     sub.handler(did, MIoTDeviceState.OFFLINE, sub.handler_ctx)
@@ -1105,8 +1752,12 @@ class MIoTClient:
         if state:
             # Connected
             self.__request_refresh_gw_devices_by_group_id(group_id=group_id)
+            self.__close_push_gap(key=group_id)
         else:
             # Disconnect
+            self.__open_push_gap(key=group_id, dids=[
+                did for did, source in self._sub_source_list.items()
+                if source == group_id])
             for did, info in self._device_list_gateway.items():
                 if info.get('group_id', None) != group_id:
                     # Not belong to this gateway
@@ -1129,7 +1780,7 @@ class MIoTClient:
                     self._device_list_lan.get(did, {}).get('online', False))
                 if state_old == state_new:
                     continue
-                self._device_list_cache[did]['online'] = state_new
+                self.__set_device_online(did=did, state=state_new)
                 sub = self._sub_device_state.get(did, None)
                 if sub and sub.handler:
                     sub.handler(did, MIoTDeviceState.OFFLINE, sub.handler_ctx)
@@ -1159,7 +1810,11 @@ class MIoTClient:
                 if 'token' in info and 'connect_type' in info
                 and info['connect_type'] in [0, 8, 12, 23]
             })
+            self.__close_push_gap(key='lan')
         else:
+            self.__open_push_gap(key='lan', dids=[
+                did for did, source in self._sub_source_list.items()
+                if source == 'lan'])
             for did, info in self._device_list_lan.items():
                 if not info.get('online', False):
                     continue
@@ -1176,7 +1831,7 @@ class MIoTClient:
                     False)
                 if state_old == state_new:
                     continue
-                self._device_list_cache[did]['online'] = state_new
+                self.__set_device_online(did=did, state=state_new)
                 sub = self._sub_device_state.get(did, None)
                 if sub and sub.handler:
                     sub.handler(did, MIoTDeviceState.OFFLINE, sub.handler_ctx)
@@ -1206,7 +1861,7 @@ class MIoTClient:
             self._device_list_lan.get(did, {}).get('online', False))
         if state_old == state_new:
             return
-        self._device_list_cache[did]['online'] = state_new
+        self.__set_device_online(did=did, state=state_new)
         sub = self._sub_device_state.get(did, None)
         if sub and sub.handler:
             sub.handler(
@@ -1262,7 +1917,7 @@ class MIoTClient:
             lan_state_new)
         if state_old == state_new:
             return
-        self._device_list_cache[did]['online'] = state_new
+        self.__set_device_online(did=did, state=state_new)
         sub = self._sub_device_state.get(did, None)
         if sub and sub.handler:
             sub.handler(
@@ -1272,9 +1927,13 @@ class MIoTClient:
 
     @final
     def __on_prop_msg(self, params: dict, ctx: Any) -> None:
-        """params MUST contain did, siid, piid, value"""
+        """params MUST contain did, siid, piid, value, ctx is the source"""
         # BLE device has no online/offline msg
         try:
+            self.__update_prop_shadow(
+                did=params['did'], siid=params['siid'],
+                piid=params['piid'], value=params['value'],
+                source=ctx or 'unknown')
             subs: list[MIoTClientSub] = list(self._sub_tree.iter_match(
                 f'{params["did"]}/p/{params["siid"]}/{params["piid"]}'))
             for sub in subs:
@@ -1374,7 +2033,7 @@ class MIoTClient:
             if state_old == state_new:
                 # Online status no change
                 continue
-            info['online'] = state_new
+            self.__set_device_online(did=did, state=state_new)
             # Call device state changed callback
             sub = self._sub_device_state.get(did, None)
             if sub and sub.handler:
@@ -1409,6 +2068,7 @@ class MIoTClient:
                 message=None, notify_key='device_cloud')
         cloud_list: dict[str, dict] = result['devices']
         await self.__update_devices_from_cloud_async(cloud_list=cloud_list)
+        self._cloud_devices_refreshed = True
         # Update lan device
         if (
             self._ctrl_mode == CtrlMode.AUTO
@@ -1439,6 +2099,25 @@ class MIoTClient:
             cloud_list=cloud_list, filter_dids=dids)
         self.__request_show_devices_changed_notify()
 
+    def __request_refresh_cloud_dids(self, dids: list[str]) -> None:
+        """Refresh some cloud devices, requests made within a second are
+        merged into one."""
+        self._refresh_cloud_dids.update(dids)
+        if self._refresh_cloud_dids_timer or not self._refresh_cloud_dids:
+            return
+        self._refresh_cloud_dids_timer = self._main_loop.call_later(
+            1, lambda: self._main_loop.create_task(
+                self.__refresh_cloud_dids_handler()))
+
+    async def __refresh_cloud_dids_handler(self) -> None:
+        self._refresh_cloud_dids_timer = None
+        dids = list(self._refresh_cloud_dids)
+        self._refresh_cloud_dids.clear()
+        if not dids or self._refresh_cloud_devices_timer:
+            # Covered by the pending refresh of all devices
+            return
+        await self.__refresh_cloud_device_with_dids_async(dids=dids)
+
     def __request_refresh_cloud_devices(self, immediately=False) -> None:
         _LOGGER.debug(
             'request refresh cloud devices, %s, %s',
@@ -1496,7 +2175,7 @@ class MIoTClient:
                 self._device_list_lan.get(did, {}).get('online', False))
             if state_old == state_new:
                 continue
-            info['online'] = state_new
+            self.__set_device_online(did=did, state=state_new)
             sub = self._sub_device_state.get(did, None)
             if sub and sub.handler:
                 sub.handler(
@@ -1521,7 +2200,7 @@ class MIoTClient:
                 self._device_list_lan.get(did, {}).get('online', False))
             if state_old == state_new:
                 continue
-            self._device_list_cache[did]['online'] = state_new
+            self.__set_device_online(did=did, state=state_new)
             sub = self._sub_device_state.get(did, None)
             if sub and sub.handler:
                 sub.handler(
@@ -1584,154 +2263,139 @@ class MIoTClient:
                         group_id=group_id))))
 
     @final
-    async def __refresh_props_from_cloud(self, patch_len: int = 150) -> bool:
-        if not self._network.network_status:
-            return False
+    async def __refresh_props_from_cloud(
+        self, request_list: dict[str, dict]
+    ) -> None:
+        """Refresh in batches of REFRESH_PROPS_CLOUD_BATCH, at most
+        REFRESH_PROPS_CLOUD_CONCURRENCY at a time. Refreshed keys are
+        removed from request_list."""
+        params = list(request_list.values())
+        batches = [
+            params[index:index+REFRESH_PROPS_CLOUD_BATCH]
+            for index in range(0, len(params), REFRESH_PROPS_CLOUD_BATCH)]
+        semaphore = asyncio.Semaphore(REFRESH_PROPS_CLOUD_CONCURRENCY)
+
+        async def get_batch(batch: list) -> Any:
+            async with semaphore:
+                return await self._http.get_props_async(params=batch)
+        results = await asyncio.gather(*[
+            get_batch(batch) for batch in batches], return_exceptions=True)
+        for batch_results in results:
+            if isinstance(batch_results, Exception):
+                _LOGGER.error('refresh props error, cloud, %s', batch_results)
+                continue
+            self.__on_refresh_props_results(
+                request_list=request_list, results=batch_results or [],
+                source=ROUTE_CLOUD)
 
-        request_list = None
-        if len(self._refresh_props_list) < patch_len:
-            request_list = self._refresh_props_list
-            self._refresh_props_list = {}
-        else:
-            request_list = {}
-            for _ in range(patch_len):
-                key, value = self._refresh_props_list.popitem()
-                request_list[key] = value
+    @final
+    async def __refresh_props_from_gw(
+        self, mips: MipsLocalClient, request_list: dict[str, dict]
+    ) -> None:
+        """One get_properties rpc per device, all devices concurrently."""
         try:
-            results = await self._http.get_props_async(
-                params=list(request_list.values()))
-            if not results:
-                raise MIoTClientError('get_props_async failed')
-            for result in results:
-                if (
-                    'did' not in result
-                    or 'siid' not in result
-                    or 'piid' not in result
-                    or 'value' not in result
-                ):
-                    continue
-                request_list.pop(
-                    f'{result["did"]}|{result["siid"]}|{result["piid"]}',
-                    None)
-                self.__on_prop_msg(params=result, ctx=None)
-            if request_list:
-                _LOGGER.info(
-                    'refresh props failed, cloud, %s',
-                    list(request_list.keys()))
-                request_list = None
-            return True
-        except Exception as err:  # pylint:disable=broad-exception-caught
+            results = await mips.get_props_async(
+                params=list(request_list.values()), timeout_ms=6000)
+        except Exception as err:  # pylint: disable=broad-exception-caught
             _LOGGER.error(
-                'refresh props error, cloud, %s, %s',
-                err, traceback.format_exc())
-            # Add failed request back to the list
-            self._refresh_props_list.update(request_list)
-            return False
+                'refresh props error, gw, %s, %s', mips.group_id, err)
+            return
+        self.__on_refresh_props_results(
+            request_list=request_list, results=results,
+            source=ROUTE_GATEWAY)
 
     @final
-    async def __refresh_props_from_gw(self) -> bool:
-        if not self._mips_local or not self._device_list_gateway:
-            return False
-        request_list = {}
-        succeed_once = False
-        for key in list(self._refresh_props_list.keys()):
-            did = key.split('|')[0]
-            if did in request_list:
-                # NOTICE: A device only requests once a cycle, continuous
-                # acquisition of properties can cause device exceptions.
-                continue
-            params = self._refresh_props_list.pop(key)
-            device_gw = self._device_list_gateway.get(did, None)
-            if not device_gw:
-                # Device not exist
-                continue
-            mips_gw = self._mips_local.get(device_gw['group_id'], None)
-            if not mips_gw:
-                _LOGGER.error('mips gateway not exist, %s', key)
-                continue
-            request_list[did] = {
-                **params,
-                'fut': mips_gw.get_prop_async(
-                    did=did, siid=params['siid'], piid=params['piid'],
-                    timeout_ms=6000)}
-        results = await asyncio.gather(
-            *[v['fut'] for v in request_list.values()])
-        for (did, param), result in zip(request_list.items(), results):
-            if result is None:
-                # Don't use "not result", it will be skipped when result
-                # is 0, false
-                continue
-            self.__on_prop_msg(
-                params={
-                    'did': did,
-                    'siid': param['siid'],
-                    'piid': param['piid'],
-                    'value': result},
-                ctx=None)
-            succeed_once = True
-        if succeed_once:
-            return True
-        _LOGGER.info(
-            'refresh props failed, gw, %s', list(request_list.keys()))
-        # Add failed request back to the list
-        self._refresh_props_list.update(request_list)
-        return False
+    async def __refresh_props_from_lan(
+        self, did: str, request_list: dict[str, dict],
+        semaphore: asyncio.Semaphore
+    ) -> None:
+        """One get_properties request for all properties of the device."""
+        try:
+            async with semaphore:
+                results = await self.__route_call_async(
+                    did=did, route=ROUTE_LAN,
+                    coro=self._miot_lan.get_props_async(
+                        did=did, params=list(request_list.values()),
+                        timeout_ms=6000),
+                    check=bool)
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            _LOGGER.error('refresh props error, lan, %s, %s', did, err)
+            return
+        self.__on_refresh_props_results(
+            request_list=request_list, results=results, source=ROUTE_LAN)
 
-    @final
-    async def __refresh_props_from_lan(self) -> bool:
-        if not self._miot_lan.init_done or len(self._mips_local) > 0:
-            return False
-        request_list = {}
-        succeed_once = False
-        for key in list(self._refresh_props_list.keys()):
-            did = key.split('|')[0]
-            if did in request_list:
-                # NOTICE: A device only requests once a cycle, continuous
-                # acquisition of properties can cause device exceptions.
-                continue
-            params = self._refresh_props_list.pop(key)
-            if did not in self._device_list_lan:
+    def __on_refresh_props_results(
+        self, request_list: dict[str, dict], results: list, source: str
+    ) -> None:
+        for result in results:
+            if (
+                not isinstance(result, dict)
+                or 'did' not in result
+                or 'siid' not in result
+                or 'piid' not in result
+                or 'value' not in result
+            ):
                 continue
-            request_list[did] = {
-                **params,
-                'fut': self._miot_lan.get_prop_async(
-                    did=did, siid=params['siid'], piid=params['piid'],
-                    timeout_ms=6000)}
-        results = await asyncio.gather(
-            *[v['fut'] for v in request_list.values()])
-        for (did, param), result in zip(request_list.items(), results):
-            if result is None:
-                # Don't use "not result", it will be skipped when result
-                # is 0, false
+            if request_list.pop(
+                f'{result["did"]}|{result["siid"]}|{result["piid"]}',
+                None
+            ) is None:
                 continue
-            self.__on_prop_msg(
-                params={
-                    'did': did,
-                    'siid': param['siid'],
-                    'piid': param['piid'],
-                    'value': result},
-                ctx=None)
-            succeed_once = True
-        if succeed_once:
-            return True
-        _LOGGER.info(
-            'refresh props failed, lan, %s', list(request_list.keys()))
-        # Add failed request back to the list
-        self._refresh_props_list.update(request_list)
-        return False
+            self.__on_prop_msg(params=result, ctx=source)
 
     @final
     async def __refresh_props_handler(self) -> None:
         if not self._refresh_props_list:
             return
-        # Cloud, Central hub gateway, Lan control
-        if (
-            await self.__refresh_props_from_cloud()
-            or await self.__refresh_props_from_gw()
-            or await self.__refresh_props_from_lan()
-        ):
+        request_list = self._refresh_props_list
+        self._refresh_props_list = {}
+        # Partition by the best route of each device, run the routes
+        # concurrently, bounded per route
+        cloud_list: dict[str, dict] = {}
+        gw_lists: dict[str, dict[str, dict]] = {}
+        lan_lists: dict[str, dict[str, dict]] = {}
+        # No route now, retried with the failed requests
+        failed_list: dict[str, dict] = {}
+        for key, params in request_list.items():
+            did = params['did']
+            routes = self.__rank_routes(
+                did=did, routes=[ROUTE_CLOUD, ROUTE_GATEWAY, ROUTE_LAN])
+            route = routes[0] if routes else (
+                ROUTE_CLOUD if self._network.network_status else None)
+            if route == ROUTE_CLOUD:
+                cloud_list[key] = params
+            elif route == ROUTE_GATEWAY:
+                group_id = self._device_list_gateway[did]['group_id']
+                gw_lists.setdefault(group_id, {})[key] = params
+            elif route == ROUTE_LAN:
+                lan_lists.setdefault(did, {})[key] = params
+            else:
+                failed_list[key] = params
+        tasks: list[Coroutine] = []
+        if cloud_list:
+            tasks.append(self.__refresh_props_from_cloud(
+                request_list=cloud_list))
+        for group_id, gw_list in gw_lists.items():
+            tasks.append(self.__refresh_props_from_gw(
+                mips=self._mips_local[group_id], request_list=gw_list))
+        lan_semaphore = asyncio.Semaphore(REFRESH_PROPS_LAN_CONCURRENCY)
+        for did, lan_list in lan_lists.items():
+            tasks.append(self.__refresh_props_from_lan(
+                did=did, request_list=lan_list, semaphore=lan_semaphore))
+        await asyncio.gather(*tasks)
+        # Refreshed keys were removed from the partitions
+        for item in (cloud_list, *gw_lists.values(), *lan_lists.values()):
+            failed_list.update(item)
+        succeed_once = len(failed_list) < len(request_list)
+        # Keep requests added while refreshing
+        failed_list.update(self._refresh_props_list)
+        self._refresh_props_list = failed_list
+        if succeed_once:
             self._refresh_props_retry_count = 0
             if self._refresh_props_list:
+                _LOGGER.info(
+                    'refresh props partly failed, %s',
+                    list(self._refresh_props_list.keys()))
                 self._refresh_props_timer = self._main_loop.call_later(
                     0.2, lambda: self._main_loop.create_task(
                         self.__refresh_props_handler()))
@@ -1925,7 +2589,9 @@ async def get_miot_instance_async(
         _LOGGER.info('create miot_storage instance')
     global_config: dict = await storage.load_user_config_async(
         uid='global_config', cloud_server='all',
-        keys=['network_detect_addr', 'net_interfaces', 'enable_subscribe'])
+        keys=[
+            'network_detect_addr', 'net_interfaces', 'enable_subscribe',
+            'shared_reactor'])
     # MIoT network
     network_detect_addr: dict = global_config.get('network_detect_addr', {})
     network: Optional[MIoTNetwork] = hass.data[DOMAIN].get(
@@ -1948,6 +2614,13 @@ async def get_miot_instance_async(
         hass.data[DOMAIN]['mips_service'] = mips_service
         await mips_service.init_async()
         _LOGGER.info('create mips_service instance')
+    # MIoT reactor, shared I/O thread for mips clients and lan
+    reactor: Optional[MIoTReactor] = hass.data[DOMAIN].get(
+        'miot_reactor', None)
+    if not reactor and global_config.get('shared_reactor', False):
+        reactor = MIoTReactor()
+        hass.data[DOMAIN]['miot_reactor'] = reactor
+        _LOGGER.info('create miot_reactor instance')
     # MIoT lan
     miot_lan: Optional[MIoTLan] = hass.data[DOMAIN].get('miot_lan', None)
     if not miot_lan:
@@ -1956,6 +2629,7 @@ async def get_miot_instance_async(
             network=network,
             mips_service=mips_service,
             enable_subscribe=global_config.get('enable_subscribe', False),
+            reactor=reactor,
             loop=loop)
         hass.data[DOMAIN]['miot_lan'] = miot_lan
         _LOGGER.info('create miot_lan instance')
@@ -1967,6 +2641,7 @@ async def get_miot_instance_async(
         storage=storage,
         mips_service=mips_service,
         miot_lan=miot_lan,
+        reactor=reactor,
         loop=loop
     )
     miot_client.persistent_notify = persistent_notify
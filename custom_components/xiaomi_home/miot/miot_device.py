@@ -88,8 +88,10 @@ from .specs.specv2entity import (
     SPEC_SERVICE_TRANS_MAP
 )
 from .common import slugify_name, slugify_did
-from .const import DOMAIN
-from .miot_client import MIoTClient
+from .const import DOMAIN, MIHOME_PROP_SHADOW_MAX_AGE
+from .miot_client import (
+    MIoTClient, REFRESH_PRIORITY_HIGH, REFRESH_PRIORITY_LOW,
+    REFRESH_PRIORITY_NORMAL)
 from .miot_error import MIoTClientError, MIoTDeviceError
 from .miot_mips import MIoTDeviceState
 from .miot_spec import (
@@ -104,6 +106,11 @@ from .miot_spec import (
 
 _LOGGER = logging.getLogger(__name__)
 
+# Visible and controllable platforms, refreshed first at startup
+REFRESH_PRIORITY_PLATFORMS: set[str] = {
+    'light', 'switch', 'climate', 'fan', 'cover', 'humidifier',
+    'water_heater', 'vacuum'}
+
 
 class MIoTEntityData:
     """MIoT Entity Data."""
@@ -960,6 +967,8 @@ class MIoTServiceEntity(Entity):
             self._value_sub_ids[key] = self.miot_device.sub_event(
                 handler=self.__on_event_occurred,
                 siid=event.service.iid, eiid=event.iid)
+        # Restore last known value
+        self.__restore_props_value()
 
         # Refresh value
         if self._attr_available:
@@ -1056,6 +1065,45 @@ class MIoTServiceEntity(Entity):
             self.async_write_ha_state()
         return True
 
+    async def set_properties_async(
+        self, props: dict[MIoTSpecProperty, Any],
+        update_value: bool = True, write_ha_state: bool = True
+    ) -> bool:
+        """Set several properties of the device with one request, in the
+        order of the dict."""
+        if not props:
+            return True
+        values: dict[MIoTSpecProperty, Any] = {}
+        for prop, value in props.items():
+            if not prop:
+                raise RuntimeError(
+                    f'set properties failed, property is None, '
+                    f'{self.entity_id}, {self.name}')
+            if prop not in self.entity_data.props:
+                raise RuntimeError(
+                    f'set properties failed, unknown property, '
+                    f'{self.entity_id}, {self.name}, {prop.name}')
+            if not prop.writable:
+                raise RuntimeError(
+                    f'set properties failed, not writable, '
+                    f'{self.entity_id}, {self.name}, {prop.name}')
+            values[prop] = prop.value_format(value)
+        try:
+            await self.miot_device.miot_client.set_props_async(
+                did=self.miot_device.did, params=[
+                    {'siid': prop.service.iid, 'piid': prop.iid,
+                     'value': value}
+                    for prop, value in values.items()])
+        except MIoTClientError as e:
+            raise RuntimeError(
+                f'{e}, {self.entity_id}, {self.name}, '
+                f'{[prop.name for prop in values]}') from e
+        if update_value:
+            self._prop_value_map.update(values)
+        if write_ha_state:
+            self.async_write_ha_state()
+        return True
+
     async def get_property_async(self, prop: MIoTSpecProperty) -> Any:
         if not prop:
             _LOGGER.error(
@@ -1074,7 +1122,8 @@ class MIoTServiceEntity(Entity):
             return None
         result = prop.value_format(
             await self.miot_device.miot_client.get_prop_async(
-                did=self.miot_device.did, siid=prop.service.iid, piid=prop.iid))
+                did=self.miot_device.did, siid=prop.service.iid,
+                piid=prop.iid, max_age=MIHOME_PROP_SHADOW_MAX_AGE))
         if result != self._prop_value_map[prop]:
             self._prop_value_map[prop] = result
             self.async_write_ha_state()
@@ -1142,12 +1191,31 @@ class MIoTServiceEntity(Entity):
             return
         self.__refresh_props_value()
 
+    def __restore_props_value(self) -> None:
+        for prop in self.entity_data.props:
+            if not prop.notifiable and not prop.readable:
+                continue
+            value: Any = self.miot_device.miot_client.get_last_prop_value(
+                did=self.miot_device.did, siid=prop.service.iid,
+                piid=prop.iid)
+            if value is None:
+                continue
+            value = prop.value_format(value)
+            self._prop_value_map[prop] = value
+            if prop in self._prop_changed_subs:
+                self._prop_changed_subs[prop](prop, value)
+
     def __refresh_props_value(self) -> None:
+        priority = (
+            REFRESH_PRIORITY_HIGH
+            if self.entity_data.platform in REFRESH_PRIORITY_PLATFORMS
+            else REFRESH_PRIORITY_NORMAL)
         for prop in self.entity_data.props:
             if not prop.readable:
                 continue
             self.miot_device.miot_client.request_refresh_prop(
-                did=self.miot_device.did, siid=prop.service.iid, piid=prop.iid)
+                did=self.miot_device.did, siid=prop.service.iid, piid=prop.iid,
+                priority=priority)
         if self._pending_write_ha_state_timer:
             self._pending_write_ha_state_timer.cancel()
         self._pending_write_ha_state_timer = self._main_loop.call_later(
@@ -1221,6 +1289,12 @@ class MIoTPropertyEntity(Entity):
         self._value_sub_id = self.miot_device.sub_property(
             handler=self.__on_value_changed,
             siid=self.service.iid, piid=self.spec.iid)
+        # Restore last known value
+        value: Any = self.miot_device.miot_client.get_last_prop_value(
+            did=self.miot_device.did, siid=self.service.iid,
+            piid=self.spec.iid)
+        if value is not None:
+            self._value = self.spec.eval_expr(self.spec.value_format(value))
         # Refresh value
         if self._attr_available:
             self.__request_refresh_prop()
@@ -1272,7 +1346,7 @@ class MIoTPropertyEntity(Entity):
         return self.spec.value_format(
             await self.miot_device.miot_client.get_prop_async(
                 did=self.miot_device.did, siid=self.spec.service.iid,
-                piid=self.spec.iid))
+                piid=self.spec.iid, max_age=MIHOME_PROP_SHADOW_MAX_AGE))
 
     def __on_value_changed(self, params: dict, ctx: Any) -> None:
         _LOGGER.debug('property changed, %s', params)
@@ -1293,9 +1367,16 @@ class MIoTPropertyEntity(Entity):
 
     def __request_refresh_prop(self) -> None:
         if self.spec.readable:
+            if self.spec.platform in REFRESH_PRIORITY_PLATFORMS:
+                priority = REFRESH_PRIORITY_HIGH
+            elif self.spec.proprietary:
+                # Non-standard properties, mostly diagnostics
+                priority = REFRESH_PRIORITY_LOW
+            else:
+                priority = REFRESH_PRIORITY_NORMAL
             self.miot_device.miot_client.request_refresh_prop(
                 did=self.miot_device.did, siid=self.service.iid,
-                piid=self.spec.iid)
+                piid=self.spec.iid, priority=priority)
         if self._pending_write_ha_state_timer:
             self._pending_write_ha_state_timer.cancel()
         self._pending_write_ha_state_timer = self._main_loop.call_later(
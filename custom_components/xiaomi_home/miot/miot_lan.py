@@ -52,6 +52,7 @@ import time
 import asyncio
 from dataclasses import dataclass
 from enum import Enum, auto
+import heapq
 import logging
 import random
 import secrets
@@ -69,7 +70,8 @@ from .miot_error import MIoTError, MIoTLanError, MIoTErrorCode
 from .miot_network import InterfaceStatus, MIoTNetwork, NetworkInfo
 from .miot_mdns import MipsService, MipsServiceState
 from .common import (
-    randomize_float, load_yaml_file, gen_absolute_path, MIoTMatcher)
+    randomize_float, load_yaml_file, gen_absolute_path, MIoTMatcher,
+    MIoTReactor, MIoTRequestTracker)
 
 
 _LOGGER = logging.getLogger(__name__)
@@ -117,7 +119,14 @@ class _MIoTLanRequestData:
     msg_id: int
     handler: Optional[Callable[[dict, Any], None]]
     handler_ctx: Any
-    timeout: Optional[asyncio.TimerHandle]
+
+
+@dataclass
+class _MIoTLanSubscribeItem:
+    due: float
+    renew: bool
+    pending: bool
+    retry_cnt: int
 
 
 class _MIoTLanDeviceState(Enum):
@@ -281,6 +290,8 @@ class _MIoTLanDevice:
                 timeout_ms=5000)
         except Exception as err:  # pylint: disable=broad-exception-caught
             _LOGGER.error('subscribe device error, %s', err)
+            self._manager.sub_manager.on_subscribe_result(
+                did=self.did, success=False)
 
         self._sub_locked = False
 
@@ -336,9 +347,13 @@ class _MIoTLanDevice:
             or msg['result']['code'] != 0
         ):
             _LOGGER.error('subscribe device error, %s, %s', self.did, msg)
+            self._manager.sub_manager.on_subscribe_result(
+                did=self.did, success=False)
             return
         self.subscribed = True
         self.sub_ts = sub_ts
+        self._manager.sub_manager.on_subscribe_result(
+            did=self.did, success=True)
         self._manager.broadcast_device_state(
             did=self.did, state={
                 'online': self._online, 'push_available': self.subscribed})
@@ -435,6 +450,173 @@ class _MIoTLanDevice:
         return hasher.finalize()
 
 
+class _MIoTLanSubscribeManager:
+    """MIoT lan device subscription lifecycle manager.
+
+    Tracks the miIO.sub state of every lan device with a single timer. Sub
+    requests are sent in rate-limited batches, subscriptions are renewed in
+    staggered windows before they lapse, and the resubscribe wave after a
+    network change is spread out to avoid a packet storm.
+    """
+    SUB_BATCH_SIZE: int = 8
+    SUB_BATCH_INTERVAL: float = 1
+    SUB_RENEW_INTERVAL: float = 1800
+    SUB_RETRY_INTERVAL_MIN: float = 5
+    SUB_RETRY_INTERVAL_MAX: float = 120
+    SUB_SPREAD_WINDOW_MIN: float = 3
+
+    _manager: 'MIoTLan'
+    _items: dict[str, _MIoTLanSubscribeItem]
+    _heap: list[tuple[float, str]]
+    _timer: Optional[asyncio.TimerHandle]
+    _timer_due: Optional[float]
+    _window_ts: float
+
+# All functions SHOULD be called from the internal loop
+
+    def __init__(self, manager: 'MIoTLan') -> None:
+        self._manager = manager
+        self._items = {}
+        self._heap = []
+        self._timer = None
+        self._timer_due = None
+        self._window_ts = 0
+
+    def request(self, did: str, delay: float = 0) -> None:
+        """Request a device (re)subscribe, no earlier than delay seconds."""
+        due: float = self._manager.internal_loop.time() + delay
+        item = self._items.get(did, None)
+        if item and (item.pending or (not item.renew and item.due <= due)):
+            # Sub request in flight or an earlier one already scheduled
+            return
+        if item:
+            item.due = due
+            item.renew = False
+        else:
+            item = _MIoTLanSubscribeItem(
+                due=due, renew=False, pending=False, retry_cnt=0)
+            self._items[did] = item
+        self.__push(did=did, due=due)
+
+    def on_subscribe_result(self, did: str, success: bool) -> None:
+        item = self._items.get(did, None)
+        if not item:
+            return
+        item.pending = False
+        if success:
+            item.retry_cnt = 0
+            item.renew = True
+            item.due = self._manager.internal_loop.time() + randomize_float(
+                self.SUB_RENEW_INTERVAL, 0.1)
+        else:
+            item.retry_cnt += 1
+            item.renew = False
+            item.due = self._manager.internal_loop.time() + randomize_float(
+                min(
+                    self.SUB_RETRY_INTERVAL_MIN * 2 ** (item.retry_cnt-1),
+                    self.SUB_RETRY_INTERVAL_MAX), 0.3)
+        self.__push(did=did, due=item.due)
+
+    def on_network_changed(self) -> None:
+        """Spread the resubscribe of all tracked devices over a window."""
+        if not self._items:
+            return
+        window: float = max(
+            self.SUB_SPREAD_WINDOW_MIN,
+            len(self._items)/self.SUB_BATCH_SIZE*self.SUB_BATCH_INTERVAL)
+        now: float = self._manager.internal_loop.time()
+        for did, item in self._items.items():
+            item.due = now + random.random()*window
+            item.renew = False
+            item.pending = False
+            item.retry_cnt = 0
+            self.__push(did=did, due=item.due)
+        _LOGGER.info(
+            'resubscribe %s devices in %.1fs', len(self._items), window)
+
+    def remove(self, did: str) -> None:
+        # Stale heap entries are dropped lazily
+        self._items.pop(did, None)
+
+    def clear(self) -> None:
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        self._timer_due = None
+        self._window_ts = 0
+        self._items.clear()
+        self._heap.clear()
+
+    def __push(self, did: str, due: float) -> None:
+        heapq.heappush(self._heap, (due, did))
+        self.__schedule()
+
+    def __schedule(self) -> None:
+        # Drop stale entries
+        while self._heap:
+            due, did = self._heap[0]
+            item = self._items.get(did, None)
+            if item and item.due == due:
+                break
+            heapq.heappop(self._heap)
+        if not self._heap:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            self._timer_due = None
+            return
+        # Never start a batch before the current window is over
+        due = max(self._heap[0][0], self._window_ts)
+        if self._timer and self._timer_due is not None and (
+                self._timer_due <= due):
+            return
+        if self._timer:
+            self._timer.cancel()
+        self._timer_due = due
+        self._timer = self._manager.internal_loop.call_at(
+            due, self.__timer_handler)
+
+    def __timer_handler(self) -> None:
+        self._timer = None
+        self._timer_due = None
+        now: float = self._manager.internal_loop.time()
+        count: int = 0
+        while self._heap and count < self.SUB_BATCH_SIZE:
+            due, did = self._heap[0]
+            if due > now:
+                break
+            heapq.heappop(self._heap)
+            item = self._items.get(did, None)
+            if not item or item.due != due:
+                continue
+            device = self._manager.get_device(did=did)
+            if not device:
+                self._items.pop(did, None)
+                continue
+            if not device.online:
+                # Wait for the device to come back
+                item.due = now + self.SUB_RETRY_INTERVAL_MAX
+                heapq.heappush(self._heap, (item.due, did))
+                continue
+            # Mark in flight, the result will reschedule it. If no result
+            # arrives, the fallback entry subscribes again.
+            item.pending = True
+            item.due = now + self.SUB_RETRY_INTERVAL_MAX
+            heapq.heappush(self._heap, (item.due, did))
+            _LOGGER.debug(
+                'subscribe device, %s, renew=%s', did, item.renew)
+            try:
+                device.subscribe()
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                _LOGGER.error('subscribe device error, %s, %s', did, err)
+                self.on_subscribe_result(did=did, success=False)
+            count += 1
+        if count >= self.SUB_BATCH_SIZE:
+            # Rate limit, continue in the next window
+            self._window_ts = now + self.SUB_BATCH_INTERVAL
+        self.__schedule()
+
+
 class MIoTLan:
     """MIoT lan device control."""
     # pylint: disable=unused-argument
@@ -462,6 +644,7 @@ class MIoTLan:
     _read_buffer: bytearray
 
     _internal_loop: asyncio.AbstractEventLoop
+    _reactor: Optional[MIoTReactor]
     _thread: threading.Thread
 
     _available_net_ifs: set[str]
@@ -470,10 +653,11 @@ class MIoTLan:
     _scan_timer: Optional[asyncio.TimerHandle]
     _last_scan_interval: Optional[float]
     _msg_id_counter: int
-    _pending_requests: dict[int, _MIoTLanRequestData]
+    _pending_requests: MIoTRequestTracker
     _device_msg_matcher: MIoTMatcher
     _device_state_sub_map: dict[str, _MIoTLanSubDeviceData]
     _reply_msg_buffer: dict[str, asyncio.TimerHandle]
+    _sub_manager: _MIoTLanSubscribeManager
 
     _lan_state_sub_map: dict[str, Callable[[bool], Coroutine]]
     _lan_ctrl_vote_map: dict[str, bool]
@@ -492,6 +676,7 @@ class MIoTLan:
         mips_service: MipsService,
         enable_subscribe: bool = False,
         virtual_did: Optional[int] = None,
+        reactor: Optional[MIoTReactor] = None,
         loop: Optional[asyncio.AbstractEventLoop] = None
     ) -> None:
         if not network:
@@ -509,6 +694,8 @@ class MIoTLan:
             key='miot_lan', group_id='*',
             handler=self.__on_mips_service_change)
         self._enable_subscribe = enable_subscribe
+        # Run on the shared reactor thread if set
+        self._reactor = reactor
         self._virtual_did = (
             str(virtual_did) if (virtual_did is not None)
             else str(secrets.randbits(64)))
@@ -529,10 +716,12 @@ class MIoTLan:
         self._scan_timer = None
         self._last_scan_interval = None
         self._msg_id_counter = int(random.random()*0x7FFFFFFF)
-        self._pending_requests = {}
+        self._pending_requests = MIoTRequestTracker(
+            on_timeout=self.__on_request_timeout)
         self._device_msg_matcher = MIoTMatcher()
         self._device_state_sub_map = {}
         self._reply_msg_buffer = {}
+        self._sub_manager = _MIoTLanSubscribeManager(manager=self)
 
         self._lan_state_sub_map = {}
         self._lan_ctrl_vote_map = {}
@@ -567,6 +756,15 @@ class MIoTLan:
     def init_done(self) -> bool:
         return self._init_done
 
+    @property
+    def sub_manager(self) -> _MIoTLanSubscribeManager:
+        return self._sub_manager
+
+    @property
+    def request_stats(self) -> dict:
+        """In-flight request count, age percentiles and timeouts."""
+        return self._pending_requests.stats()
+
     async def init_async(self) -> None:
         # Avoid race condition
         async with self._init_lock:
@@ -597,12 +795,18 @@ class MIoTLan:
             except Exception as err:  # pylint: disable=broad-exception-caught
                 _LOGGER.error('load profile models error, %s', err)
                 self._profile_models = {}
-            self._internal_loop = asyncio.new_event_loop()
-            # All tasks meant for the internal loop should happen in this thread
-            self._thread = threading.Thread(target=self.__internal_loop_thread)
-            self._thread.name = 'miot_lan'
-            self._thread.daemon = True
-            self._thread.start()
+            if self._reactor:
+                self._internal_loop = self._reactor.acquire()
+                self._reactor.call(self.__internal_loop_init)
+            else:
+                self._internal_loop = asyncio.new_event_loop()
+                # All tasks meant for the internal loop should happen in this
+                # thread
+                self._thread = threading.Thread(
+                    target=self.__internal_loop_thread)
+                self._thread.name = 'miot_lan'
+                self._thread.daemon = True
+                self._thread.start()
             self._init_done = True
             for handler in list(self._lan_state_sub_map.values()):
                 self._main_loop.create_task(handler(True))
@@ -611,20 +815,28 @@ class MIoTLan:
 
     def __internal_loop_thread(self) -> None:
         _LOGGER.info('miot lan thread start')
+        self.__internal_loop_init()
+        self._internal_loop.run_forever()
+        _LOGGER.info('miot lan thread exit')
+
+    def __internal_loop_init(self) -> None:
         self.__init_socket()
         self._scan_timer = self._internal_loop.call_later(
             int(3*random.random()), self.__scan_devices)
-        self._internal_loop.run_forever()
-        _LOGGER.info('miot lan thread exit')
 
     async def deinit_async(self) -> None:
         if not self._init_done:
             _LOGGER.info('miot lan not init')
             return
         self._init_done = False
-        self._internal_loop.call_soon_threadsafe(self.__deinit)
-        self._thread.join()
-        self._internal_loop.close()
+        if self._reactor:
+            await asyncio.wrap_future(self._reactor.call(self.__deinit))
+            await self._main_loop.run_in_executor(
+                None, self._reactor.release)
+        else:
+            self._internal_loop.call_soon_threadsafe(self.__deinit)
+            self._thread.join()
+            self._internal_loop.close()
 
         self._profile_models = {}
         self._lan_devices = {}
@@ -633,7 +845,8 @@ class MIoTLan:
         self._scan_timer = None
         self._last_scan_interval = None
         self._msg_id_counter = int(random.random()*0x7FFFFFFF)
-        self._pending_requests = {}
+        self._pending_requests = MIoTRequestTracker(
+            on_timeout=self.__on_request_timeout)
         self._device_msg_matcher = MIoTMatcher()
         self._device_state_sub_map = {}
         self._reply_msg_buffer = {}
@@ -832,6 +1045,33 @@ class MIoTLan:
             return result_obj['result'][0].get('value', None)
         return None
 
+    @final
+    async def get_props_async(
+        self, did: str, params: list, timeout_ms: int = 10000
+    ) -> list:
+        """
+        params = [{"siid": 2, "piid": 1}, ...]
+        One get_properties request for all properties of the device.
+        Returns the results with a value, [] if the reply is invalid.
+        """
+        self.__assert_service_ready()
+        result_obj = await self.__call_api_async(
+            did=did, msg={
+                'method': 'get_properties',
+                'params': [{
+                    'did': did, 'siid': param['siid'],
+                    'piid': param['piid']} for param in params]
+            }, timeout_ms=timeout_ms)
+        if (
+            not result_obj
+            or not isinstance(result_obj.get('result', None), list)
+        ):
+            return []
+        return [
+            result for result in result_obj['result']
+            if isinstance(result, dict) and result.get('did', None) == did
+            and 'siid' in result and 'piid' in result and 'value' in result]
+
     @final
     async def set_prop_async(
         self, did: str, siid: int, piid: int, value: Any,
@@ -857,6 +1097,37 @@ class MIoTLan:
                 return result_obj
         raise MIoTError('Invalid result', MIoTErrorCode.CODE_INTERNAL_ERROR)
 
+    @final
+    async def set_props_async(
+        self, did: str, params: list, timeout_ms: int = 10000
+    ) -> list[dict]:
+        """
+        params = [{"siid": 2, "piid": 1, "value": False}, ...]
+        One set_properties request for all properties of the device.
+        Returns one result with a code for each param, in the same order.
+        """
+        self.__assert_service_ready()
+        result_obj = await self.__call_api_async(
+            did=did, msg={
+                'method': 'set_properties',
+                'params': [{
+                    'did': did, 'siid': param['siid'],
+                    'piid': param['piid'], 'value': param['value']}
+                    for param in params]
+            }, timeout_ms=timeout_ms)
+        if result_obj:
+            if (
+                isinstance(result_obj.get('result', None), list)
+                and len(result_obj['result']) == len(params)
+                and all(
+                    isinstance(item, dict) and 'code' in item
+                    for item in result_obj['result'])
+            ):
+                return result_obj['result']
+            if 'code' in result_obj:
+                return [result_obj]*len(params)
+        raise MIoTError('Invalid result', MIoTErrorCode.CODE_INTERNAL_ERROR)
+
     @final
     async def action_async(
         self, did: str, siid: int, aiid: int, in_list: list,
@@ -956,6 +1227,9 @@ class MIoTLan:
             if_name=if_name, data=self._probe_msg, address=target_ip,
             port=self.OT_PORT)
 
+    def get_device(self, did: str) -> Optional[_MIoTLanDevice]:
+        return self._lan_devices.get(did, None)
+
     def send2device(
         self, did: str,
         msg: dict,
@@ -1000,27 +1274,24 @@ class MIoTLan:
         handler_ctx: Any = None,
         timeout_ms: Optional[int] = None
     ) -> None:
-        def request_timeout_handler(req_data: _MIoTLanRequestData):
-            self._pending_requests.pop(req_data.msg_id, None)
-            if req_data and req_data.handler:
-                req_data.handler({
-                    'code': MIoTErrorCode.CODE_TIMEOUT.value,
-                    'error': 'timeout'},
-                    req_data.handler_ctx)
-
-        timer: Optional[asyncio.TimerHandle] = None
         request_data = _MIoTLanRequestData(
             msg_id=msg_id,
             handler=handler,
-            handler_ctx=handler_ctx,
-            timeout=timer)
-        if timeout_ms:
-            timer = self._internal_loop.call_later(
-                timeout_ms/1000, request_timeout_handler, request_data)
-            request_data.timeout = timer
-        self._pending_requests[msg_id] = request_data
+            handler_ctx=handler_ctx)
+        self._pending_requests.add(
+            req_id=msg_id, data=request_data,
+            timeout_s=timeout_ms/1000 if timeout_ms else None)
         self.__sendto(if_name=if_name, data=msg, address=ip, port=self.OT_PORT)
 
+    def __on_request_timeout(
+        self, msg_id: int, req_data: _MIoTLanRequestData
+    ) -> None:
+        if req_data.handler:
+            req_data.handler({
+                'code': MIoTErrorCode.CODE_TIMEOUT.value,
+                'error': 'timeout'},
+                req_data.handler_ctx)
+
     def broadcast_device_state(self, did: str, state: dict) -> None:
         for handler in self._device_state_sub_map.values():
             self._main_loop.call_soon_threadsafe(
@@ -1115,6 +1386,7 @@ class MIoTLan:
 
     def __delete_devices(self, devices: list[str]) -> None:
         for did in devices:
+            self._sub_manager.remove(did=did)
             lan_device = self._lan_devices.pop(did, None)
             if not lan_device:
                 continue
@@ -1125,6 +1397,7 @@ class MIoTLan:
             self._available_net_ifs.add(data.if_name)
             if data.if_name in self._net_ifs:
                 self.__create_socket(if_name=data.if_name)
+                self._sub_manager.on_network_changed()
         elif data.status == InterfaceStatus.REMOVE:
             self._available_net_ifs.remove(data.if_name)
             self.__destroy_socket(if_name=data.if_name)
@@ -1137,6 +1410,7 @@ class MIoTLan:
             for if_name in list(self._broadcast_socks.keys()):
                 if if_name not in self._net_ifs:
                     self.__destroy_socket(if_name=if_name)
+            self._sub_manager.on_network_changed()
 
     def __update_subscribe_option(self, options: dict) -> None:
         if 'enable_subscribe' in options:
@@ -1144,6 +1418,7 @@ class MIoTLan:
                 self._enable_subscribe = options['enable_subscribe']
                 if not self._enable_subscribe:
                     # Unsubscribe all
+                    self._sub_manager.clear()
                     for device in self._lan_devices.values():
                         device.unsubscribe()
 
@@ -1152,20 +1427,18 @@ class MIoTLan:
         if self._scan_timer:
             self._scan_timer.cancel()
             self._scan_timer = None
+        self._sub_manager.clear()
         for device in self._lan_devices.values():
             device.on_delete()
         self._lan_devices.clear()
-        for req_data in self._pending_requests.values():
-            if req_data.timeout:
-                req_data.timeout.cancel()
-                req_data.timeout = None
         self._pending_requests.clear()
         for timer in self._reply_msg_buffer.values():
             timer.cancel()
         self._reply_msg_buffer.clear()
         self._device_msg_matcher = MIoTMatcher()
         self.__deinit_socket()
-        self._internal_loop.stop()
+        if not self._reactor:
+            self._internal_loop.stop()
 
     def __init_socket(self) -> None:
         self.__deinit_socket()
@@ -1258,7 +1531,7 @@ class MIoTLan:
                 and sub_ts != device.sub_ts
             ):
                 device.subscribed = False
-                device.subscribe()
+                self._sub_manager.request(did=did)
         if data_len > self.OT_PROBE_LEN:
             # handle device message
             try:
@@ -1274,11 +1547,8 @@ class MIoTLan:
             return
         # Reply
         req: Optional[_MIoTLanRequestData] = (
-            self._pending_requests.pop(msg['id'], None))
+            self._pending_requests.pop(msg['id']))
         if req:
-            if req.timeout:
-                req.timeout.cancel()
-                req.timeout = None
             if req.handler is not None:
                 self._main_loop.call_soon_threadsafe(
                     req.handler, msg, req.handler_ctx)
@@ -106,11 +106,13 @@ class MipsServiceData:
             raise MipsServiceError('invalid service profile')
         self.profile_bin = base64.b64decode(self.profile)
         self.name = service_info.name
-        self.addresses = service_info.parsed_addresses(
-            version=IPVersion.V4Only)
+        # IPv6 link-local addresses need the scope id to connect
+        self.addresses = service_info.parsed_scoped_addresses(
+            version=IPVersion.All)
         if not self.addresses:
             raise MipsServiceError('invalid addresses')
-        self.addresses.sort()
+        # IPv4 first, clients prefer the first address
+        self.addresses.sort(key=lambda addr: (':' in addr, addr))
         if not service_info.port:
             raise MipsServiceError('invalid port')
         self.port = service_info.port
@@ -46,14 +46,21 @@ off Xiaomi or its affiliates' products.
 MIoT Pub/Sub client.
 """
 import asyncio
+import concurrent.futures
+import errno
 import json
 import logging
 import random
 import re
+import selectors
+import socket
 import ssl
 import struct
 import threading
+import time
+import zlib
 from abc import ABC, abstractmethod
+from collections import deque
 from dataclasses import dataclass
 from enum import Enum, auto
 from typing import Any, Callable, Optional, final, Coroutine
@@ -64,9 +71,11 @@ from paho.mqtt.client import (
     Client,
     MQTTv5,
     MQTTMessage)
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 
 # pylint: disable=relative-beyond-top-level
-from .common import MIoTMatcher
+from .common import MIoTMatcher, MIoTReactor, MIoTRequestTracker
 from .const import MIHOME_MQTT_KEEPALIVE
 from .miot_error import MIoTErrorCode, MIoTMipsError
 
@@ -82,6 +91,11 @@ class _MipsMsgTypeOptions(Enum):
     MAX = auto()
 
 
+# TLV header of MIoT Pub/Sub message, value length and value type
+_MIPS_TLV_HEADER: struct.Struct = struct.Struct('<IB')
+_MIPS_UINT32: struct.Struct = struct.Struct('<I')
+
+
 class _MipsMessage:
     """MIoT Pub/Sub message."""
     mid: int = 0
@@ -92,27 +106,28 @@ class _MipsMessage:
     @staticmethod
     def unpack(data: bytes) -> '_MipsMessage':
         mips_msg = _MipsMessage()
-        data_len = len(data)
+        view = memoryview(data)
+        data_len = len(view)
         data_start = 0
         data_end = 0
         while data_start < data_len:
-            data_end = data_start+5
-            unpack_len, unpack_type = struct.unpack(
-                '<IB', data[data_start:data_end])
-            unpack_data = data[data_end:data_end+unpack_len]
-            #  string end with \x00
+            unpack_len, unpack_type = _MIPS_TLV_HEADER.unpack_from(
+                view, data_start)
+            data_end = data_start+_MIPS_TLV_HEADER.size
+            value_end = min(data_end+unpack_len, data_len)
             match unpack_type:
                 case _MipsMsgTypeOptions.ID.value:
                     mips_msg.mid = int.from_bytes(
-                        unpack_data, byteorder='little')
+                        view[data_end:value_end], byteorder='little')
                 case _MipsMsgTypeOptions.RET_TOPIC.value:
-                    mips_msg.ret_topic = str(
-                        unpack_data.strip(b'\x00'), 'utf-8')
+                    mips_msg.ret_topic = _MipsMessage.__decode_str(
+                        view, data_end, value_end)
                 case _MipsMsgTypeOptions.PAYLOAD.value:
-                    mips_msg.payload = str(unpack_data.strip(b'\x00'), 'utf-8')
+                    mips_msg.payload = _MipsMessage.__decode_str(
+                        view, data_end, value_end)
                 case _MipsMsgTypeOptions.FROM.value:
-                    mips_msg.msg_from = str(
-                        unpack_data.strip(b'\x00'), 'utf-8')
+                    mips_msg.msg_from = _MipsMessage.__decode_str(
+                        view, data_end, value_end)
                 case _:
                     pass
             data_start = data_end+unpack_len
@@ -127,27 +142,55 @@ class _MipsMessage:
     ) -> bytes:
         if mid is None or payload is None:
             raise MIoTMipsError('invalid mid or payload')
-        pack_msg: bytes = b''
+        # String values are null terminated, the terminating null is
+        # already zero in the preallocated buffer
+        from_bytes = msg_from.encode('utf-8') if msg_from else b''
+        topic_bytes = ret_topic.encode('utf-8') if ret_topic else b''
+        payload_bytes = payload.encode('utf-8')
+        header_size = _MIPS_TLV_HEADER.size
+        # Exact size, only the present strings take a header
+        pack_msg = bytearray(header_size+4 + sum(
+            header_size+len(value)+1
+            for value in (from_bytes, topic_bytes) if value)
+            + header_size+len(payload_bytes)+1)
         # mid
-        pack_msg += struct.pack('<IBI', 4, _MipsMsgTypeOptions.ID.value, mid)
+        _MIPS_TLV_HEADER.pack_into(
+            pack_msg, 0, 4, _MipsMsgTypeOptions.ID.value)
+        _MIPS_UINT32.pack_into(pack_msg, header_size, mid)
+        offset = header_size+4
         # msg_from
-        if msg_from:
-            pack_len = len(msg_from)
-            pack_msg += struct.pack(
-                f'<IB{pack_len}sx', pack_len+1,
-                _MipsMsgTypeOptions.FROM.value, msg_from.encode('utf-8'))
+        if from_bytes:
+            offset = _MipsMessage.__pack_str(
+                pack_msg, offset, _MipsMsgTypeOptions.FROM.value, from_bytes)
         # ret_topic
-        if ret_topic:
-            pack_len = len(ret_topic)
-            pack_msg += struct.pack(
-                f'<IB{pack_len}sx', pack_len+1,
-                _MipsMsgTypeOptions.RET_TOPIC.value, ret_topic.encode('utf-8'))
+        if topic_bytes:
+            offset = _MipsMessage.__pack_str(
+                pack_msg, offset, _MipsMsgTypeOptions.RET_TOPIC.value,
+                topic_bytes)
         # payload
-        pack_len = len(payload)
-        pack_msg += struct.pack(
-            f'<IB{pack_len}sx', pack_len+1,
-            _MipsMsgTypeOptions.PAYLOAD.value, payload.encode('utf-8'))
-        return pack_msg
+        _MipsMessage.__pack_str(
+            pack_msg, offset, _MipsMsgTypeOptions.PAYLOAD.value,
+            payload_bytes)
+        return bytes(pack_msg)
+
+    @staticmethod
+    def __pack_str(
+        out_buffer: bytearray, offset: int, value_type: int, value: bytes
+    ) -> int:
+        value_len = len(value)
+        _MIPS_TLV_HEADER.pack_into(out_buffer, offset, value_len+1, value_type)
+        offset += _MIPS_TLV_HEADER.size
+        out_buffer[offset:offset+value_len] = value
+        return offset+value_len+1
+
+    @staticmethod
+    def __decode_str(view: memoryview, start: int, end: int) -> str:
+        # Same as bytes.strip(b'\x00') without copying the value
+        while start < end and view[start] == 0:
+            start += 1
+        while end > start and view[end-1] == 0:
+            end -= 1
+        return str(view[start:end], 'utf-8')
 
     def __str__(self) -> str:
         return f'{self.mid}, {self.msg_from}, {self.ret_topic}, {self.payload}'
@@ -157,21 +200,26 @@ class _MipsMessage:
 class _MipsRequest:
     """MIoT Pub/Sub request."""
     mid: int
-    on_reply: Callable[[str, Any], None]
+    on_reply: Optional[Callable[[str, Any], None]]
     on_reply_ctx: Any
-    timer: Optional[asyncio.TimerHandle]
+    topic: str
 
 
 @dataclass
 class _MipsBroadcast:
     """MIoT Pub/Sub broadcast."""
     topic: str
-    """
+    """decoder, called in the mips thread
     param 1: msg topic
     param 2: msg payload
-    param 3: handle_ctx
+    return: update record, None to drop the message
     """
-    handler: Callable[[str, str, Any], None]
+    decoder: Callable[[str, str], Any]
+    """handler, called in the main loop
+    param 1: update record
+    param 2: handle_ctx
+    """
+    handler: Callable[[Any, Any], None]
     handler_ctx: Any
 
     def __str__(self) -> str:
@@ -189,6 +237,114 @@ class _MipsState:
     handler: Callable[[str, bool], Coroutine]
 
 
+class _MipsSSLContext(ssl.SSLContext):
+    """TLS context resuming the last session of a host on reconnect."""
+    tls_sessions: dict[str, ssl.SSLSession]
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__()
+        self.tls_sessions = {}
+
+    def wrap_socket(
+        self, sock, server_side=False, do_handshake_on_connect=True,
+        suppress_ragged_eofs=True, server_hostname=None, session=None
+    ) -> ssl.SSLSocket:
+        if session is None and server_hostname:
+            session = self.tls_sessions.get(server_hostname, None)
+        return super().wrap_socket(
+            sock, server_side=server_side,
+            do_handshake_on_connect=do_handshake_on_connect,
+            suppress_ragged_eofs=suppress_ragged_eofs,
+            server_hostname=server_hostname, session=session)
+
+
+def _mips_race_connect(
+    hosts: list[str], port: int, timeout: float, delay: float
+) -> tuple[socket.socket, str]:
+    """Connect to the first reachable host, happy eyeballs style.
+
+    Attempts start in order, a new one every delay seconds or as soon as
+    the previous one failed. The first established TCP connection wins,
+    the others are closed. Blocking, the returned socket has the timeout
+    set like socket.create_connection().
+    """
+    sel = selectors.DefaultSelector()
+    errors: list[OSError] = []
+    deadline: float = time.monotonic()+timeout
+    next_start: float = 0
+    index: int = 0
+    try:
+        while True:
+            now = time.monotonic()
+            if index < len(hosts) and (
+                    now >= next_start or not sel.get_map()):
+                host = hosts[index]
+                index += 1
+                next_start = now+delay
+                sock: Optional[socket.socket] = None
+                try:
+                    addr_info = socket.getaddrinfo(
+                        host, port, type=socket.SOCK_STREAM)[0]
+                    sock = socket.socket(
+                        addr_info[0], addr_info[1], addr_info[2])
+                    sock.setblocking(False)
+                    err = sock.connect_ex(addr_info[4])
+                    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                        raise OSError(err, f'connect {host} failed')
+                    sel.register(sock, selectors.EVENT_WRITE, host)
+                except OSError as error:
+                    if sock:
+                        sock.close()
+                    errors.append(error)
+                continue
+            if not sel.get_map():
+                raise errors[-1] if errors else OSError('no host')
+            if now >= deadline:
+                raise TimeoutError('connect timeout')
+            wait_until = deadline
+            if index < len(hosts):
+                wait_until = min(wait_until, next_start)
+            for key, _ in sel.select(max(wait_until-now, 0)):
+                sock = key.fileobj  # type: ignore
+                sel.unregister(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    sock.close()
+                    errors.append(OSError(err, f'connect {key.data} failed'))
+                    continue
+                sock.settimeout(timeout)
+                return sock, key.data
+    finally:
+        for key in list(sel.get_map().values()):
+            key.fileobj.close()  # type: ignore
+        sel.close()
+
+
+class _MipsMqttClient(Client):
+    """paho client racing the connection to several host addresses."""
+    MIPS_CONNECT_RACE_DELAY: float = 0.25
+    # All addresses of the host, preferred first
+    mips_hosts: list[str]
+    # Address the last connection was made to
+    mips_host: Optional[str]
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.mips_hosts = []
+        self.mips_host = None
+
+    def _create_socket_connection(self) -> socket.socket:
+        if len(self.mips_hosts) <= 1:
+            self.mips_host = self._host
+            return super()._create_socket_connection()
+        self.mips_host = None
+        sock, self.mips_host = _mips_race_connect(
+            hosts=self.mips_hosts, port=self._port,
+            timeout=getattr(self, '_connect_timeout', 5.0),
+            delay=self.MIPS_CONNECT_RACE_DELAY)
+        return sock
+
+
 class MIoTDeviceState(Enum):
     """MIoT device state define."""
     DISABLE = 0
@@ -196,6 +352,28 @@ class MIoTDeviceState(Enum):
     ONLINE = auto()
 
 
+class MipsSubMode(Enum):
+    """MIoT Pub/Sub broadcast subscription mode.
+    TOPIC: one broker subscription per broadcast topic
+    DEVICE: one wildcard broker subscription per device
+    GATEWAY: one wildcard broker subscription per central hub gateway,
+        the same as DEVICE for the cloud
+    """
+    TOPIC = 0
+    DEVICE = auto()
+    GATEWAY = auto()
+
+    @staticmethod
+    def load(mode: str) -> 'MipsSubMode':
+        if mode == 'topic':
+            return MipsSubMode.TOPIC
+        if mode == 'device':
+            return MipsSubMode.DEVICE
+        if mode == 'gateway':
+            return MipsSubMode.GATEWAY
+        raise MIoTMipsError(f'unknown sub mode, {mode}')
+
+
 @dataclass
 class MipsDeviceState:
     """MIoT Pub/Sub device state."""
@@ -212,23 +390,44 @@ class MipsDeviceState:
 class _MipsClient(ABC):
     """MIoT Pub/Sub client."""
     # pylint: disable=unused-argument
+    # Fallback housekeeping tick if the keepalive deadline is unknown
     MQTT_INTERVAL_S = 1
+    # Fire a little late, paho checks the keepalive with >=
+    MQTT_TIMER_SLACK_S: float = 0.05
     MIPS_QOS: int = 2
+    # QoS by topic class, telemetry does not need exactly-once delivery.
+    # prop: properties_changed, event: event_occured, state: device
+    # online state, request: request and reply
+    MIPS_QOS_POLICY: dict[str, int] = {
+        'prop': 1, 'event': 2, 'state': 1, 'request': 2}
     UINT32_MAX: int = 0xFFFFFFFF
+    # The first retry runs within MIPS_RECONNECT_INTERVAL_FAST (jittered),
+    # then back off from MIN to MAX. The backoff restarts once a connection
+    # stayed up for MIPS_RECONNECT_STABLE_S.
+    MIPS_RECONNECT_INTERVAL_FAST: float = 1
     MIPS_RECONNECT_INTERVAL_MIN: float = 30
     MIPS_RECONNECT_INTERVAL_MAX: float = 600
-    MIPS_SUB_PATCH: int = 300
+    MIPS_RECONNECT_STABLE_S: float = 60
+    # Pending (un)subscribe topics are packed into multi-topic packets
+    MIPS_SUB_PACKET_SIZE: int = 4096
+    MIPS_SUB_PACKET_COUNT: int = 4
     MIPS_SUB_INTERVAL: float = 1
+    MIPS_SUB_RETRY_MAX: int = 3
     main_loop: asyncio.AbstractEventLoop
     _logger: Optional[logging.Logger]
     _client_id: str
     _host: str
+    # All addresses of the host, the preferred one first
+    _hosts: list[str]
     _port: int
     _username: Optional[str]
     _password: Optional[str]
     _ca_file: Optional[str]
     _cert_file: Optional[str]
     _key_file: Optional[str]
+    _session_expiry: int
+    _sub_mode: MipsSubMode
+    _qos_policy: dict[str, int]
 
     _mqtt_logger: Optional[logging.Logger]
     _mqtt: Optional[Client]
@@ -239,14 +438,31 @@ class _MipsClient(ABC):
     _event_connect: asyncio.Event
     _event_disconnect: asyncio.Event
     _internal_loop: asyncio.AbstractEventLoop
+    _reactor: Optional[MIoTReactor]
+    # Pending disconnect in the reactor thread
+    _reactor_disconnect_fut: Optional[concurrent.futures.Future]
+    # Pending reactor release in the executor
+    _reactor_release_fut: Optional[asyncio.Future]
     _mips_thread: Optional[threading.Thread]
     _mips_reconnect_tag: bool
     _mips_reconnect_interval: float
+    _mips_connect_ts: float
     _mips_reconnect_timer: Optional[asyncio.TimerHandle]
     _mips_state_sub_map: dict[str, _MipsState]
     _mips_state_sub_map_lock: threading.Lock
     _mips_sub_pending_map: dict[str, int]
+    _mips_unsub_pending_map: dict[str, int]
     _mips_sub_pending_timer: Optional[asyncio.TimerHandle]
+    # Topics the client wants, and topics known to be in the broker session
+    _mips_sub_topics: set[str]
+    _mips_session_topics: set[str]
+    _mips_sub_inflight: dict[int, list[str]]
+    _mips_session_started: bool
+    # Broadcast topics sharing a broker subscription, {sub_topic: ref count}
+    _mips_sub_refs: dict[str, int]
+    # Decoded broadcasts waiting for the main loop, (handler, record, ctx)
+    _mips_dispatch_queue: deque[tuple[Callable[[Any, Any], None], Any, Any]]
+    _mips_dispatch_scheduled: bool
 
     def __init__(
             self,
@@ -258,12 +474,29 @@ class _MipsClient(ABC):
             ca_file: Optional[str] = None,
             cert_file: Optional[str] = None,
             key_file: Optional[str] = None,
+            session_expiry: int = 0,
+            sub_mode: MipsSubMode = MipsSubMode.TOPIC,
+            qos_policy: Optional[dict[str, int]] = None,
+            reactor: Optional[MIoTReactor] = None,
+            hosts: Optional[list[str]] = None,
             loop: Optional[asyncio.AbstractEventLoop] = None
     ) -> None:
+        """session_expiry: mqtt session expiry interval in seconds. If
+        greater than 0, reconnect with a persistent session and only
+        resubscribe the changes if the broker still has the session.
+        sub_mode: how broadcast topics are mapped to broker subscriptions,
+        messages are always dispatched by the full topic locally.
+        qos_policy: QoS overrides by topic class, see MIPS_QOS_POLICY.
+        reactor: shared I/O thread, if set the client runs on it instead
+        of starting its own thread.
+        hosts: other addresses of the host, connections are raced to all
+        of them and the first one established is used.
+        """
         # MUST run with running loop
         self.main_loop = loop or asyncio.get_running_loop()
         self._logger = None
         self._client_id = client_id
+        self._hosts = [host]+[item for item in hosts or [] if item != host]
         self._host = host
         self._port = port
         self._username = username
@@ -271,6 +504,12 @@ class _MipsClient(ABC):
         self._ca_file = ca_file
         self._cert_file = cert_file
         self._key_file = key_file
+        self._session_expiry = max(session_expiry, 0)
+        self._sub_mode = sub_mode
+        self._qos_policy = {**self.MIPS_QOS_POLICY, **(qos_policy or {})}
+        for topic_class, qos in self._qos_policy.items():
+            if qos not in (0, 1, 2):
+                raise MIoTMipsError(f'invalid qos, {topic_class}, {qos}')
 
         self._mqtt_logger = None
         self._mqtt_fd = -1
@@ -281,14 +520,26 @@ class _MipsClient(ABC):
         # Mips init
         self._event_connect = asyncio.Event()
         self._event_disconnect = asyncio.Event()
+        self._reactor = reactor
+        self._reactor_disconnect_fut = None
+        self._reactor_release_fut = None
         self._mips_thread = None
         self._mips_reconnect_tag = False
         self._mips_reconnect_interval = 0
+        self._mips_connect_ts = 0
         self._mips_reconnect_timer = None
         self._mips_state_sub_map = {}
         self._mips_state_sub_map_lock = threading.Lock()
         self._mips_sub_pending_map = {}
+        self._mips_unsub_pending_map = {}
         self._mips_sub_pending_timer = None
+        self._mips_sub_topics = set()
+        self._mips_session_topics = set()
+        self._mips_sub_inflight = {}
+        self._mips_session_started = False
+        self._mips_sub_refs = {}
+        self._mips_dispatch_queue = deque()
+        self._mips_dispatch_scheduled = False
         # DO NOT start the thread yet. Do that on connect
 
     @property
@@ -299,6 +550,10 @@ class _MipsClient(ABC):
     def host(self) -> str:
         return self._host
 
+    @property
+    def hosts(self) -> list[str]:
+        return list(self._hosts)
+
     @property
     def port(self) -> int:
         return self._port
@@ -320,6 +575,11 @@ class _MipsClient(ABC):
         # Start mips thread
         if self._mips_thread:
             return
+        if self._reactor:
+            self._internal_loop = self._reactor.acquire()
+            self._mips_thread = self._reactor.thread
+            self._reactor.call(self.__mips_loop_init)
+            return
         self._internal_loop = asyncio.new_event_loop()
         self._mips_thread = threading.Thread(target=self.__mips_loop_thread)
         self._mips_thread.daemon = True
@@ -327,6 +587,18 @@ class _MipsClient(ABC):
             self._client_id if thread_name is None else thread_name)
         self._mips_thread.start()
 
+    def update_hosts(self, hosts: list[str]) -> None:
+        """Update the host addresses, e.g. after a mdns update. The
+        connection and subscriptions are kept, the addresses are used from
+        the next connect."""
+        if not hosts:
+            return
+        if self._mips_thread:
+            self._internal_loop.call_soon_threadsafe(
+                self.__mips_update_hosts, list(hosts))
+        else:
+            self.__mips_update_hosts(list(hosts))
+
     async def connect_async(self) -> None:
         """mips connect async."""
         self.connect()
@@ -336,6 +608,22 @@ class _MipsClient(ABC):
         """mips disconnect."""
         if not self._mips_thread:
             return
+        if self._reactor:
+            # Do not wait in the caller thread, the reactor runs the
+            # disconnect before it stops
+            self._reactor_disconnect_fut = self._reactor.call(
+                self.__mips_disconnect)
+            self._mips_thread = None
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # No event loop in this thread, the join blocks nobody
+                self._reactor.release()
+                return
+            # The last release joins the reactor thread
+            self._reactor_release_fut = loop.run_in_executor(
+                None, self._reactor.release)
+            return
         self._internal_loop.call_soon_threadsafe(self.__mips_disconnect)
         self._mips_thread.join()
         self._mips_thread = None
@@ -344,6 +632,16 @@ class _MipsClient(ABC):
     async def disconnect_async(self) -> None:
         """mips disconnect async."""
         self.disconnect()
+        if self._reactor:
+            fut, self._reactor_disconnect_fut = (
+                self._reactor_disconnect_fut, None)
+            if fut:
+                await asyncio.wrap_future(fut)
+            release_fut, self._reactor_release_fut = (
+                self._reactor_release_fut, None)
+            if release_fut:
+                await release_fut
+            return
         await self._event_disconnect.wait()
 
     @final
@@ -360,6 +658,7 @@ class _MipsClient(ABC):
         with self._mips_state_sub_map_lock:
             self._mips_state_sub_map.clear()
         self._mips_sub_pending_map.clear()
+        self._mips_unsub_pending_map.clear()
         self._mips_sub_pending_timer = None
 
     @final
@@ -376,6 +675,7 @@ class _MipsClient(ABC):
         with self._mips_state_sub_map_lock:
             self._mips_state_sub_map.clear()
         self._mips_sub_pending_map.clear()
+        self._mips_unsub_pending_map.clear()
         self._mips_sub_pending_timer = None
 
     def update_mqtt_password(self, password: str) -> None:
@@ -505,20 +805,28 @@ class _MipsClient(ABC):
     @abstractmethod
     def _on_mips_disconnect(self, rc: int, props: dict) -> None: ...
 
+    def _on_mips_release(self) -> None:
+        """Called in the mips thread on disconnect(), release the timers
+        and requests living in the internal loop."""
+
     @final
     def _mips_sub_internal(self, topic: str) -> None:
         """mips subscribe.
         NOTICE: Internal function, only mips threads are allowed to call
         """
         self.__thread_check()
+        self._mips_sub_topics.add(topic)
         if not self._mqtt or not self._mqtt.is_connected():
             return
         try:
+            self._mips_unsub_pending_map.pop(topic, None)
+            if topic in self._mips_session_topics:
+                # Still subscribed in the persistent session
+                self._mips_sub_pending_map.pop(topic, None)
+                return
             if topic not in self._mips_sub_pending_map:
                 self._mips_sub_pending_map[topic] = 0
-            if not self._mips_sub_pending_timer:
-                self._mips_sub_pending_timer = self._internal_loop.call_later(
-                    0.01, self.__mips_sub_internal_pending_handler, topic)
+            self.__mips_start_pending_timer()
         except Exception as err:  # pylint: disable=broad-exception-caught
             # Catch all exception
             self.log_error(f'mips sub internal error, {topic}. {err}')
@@ -529,20 +837,107 @@ class _MipsClient(ABC):
         NOTICE: Internal function, only mips threads are allowed to call
         """
         self.__thread_check()
+        self._mips_sub_topics.discard(topic)
         if not self._mqtt or not self._mqtt.is_connected():
+            # Stale session topics are unsubscribed on reconnect
             return
         try:
-            result, mid = self._mqtt.unsubscribe(topic=topic)
-            if result == MQTT_ERR_SUCCESS:
-                self.log_debug(
-                    f'mips unsub internal success, {result}, {mid}, {topic}')
-                return
-            self.log_error(
-                f'mips unsub internal error, {result}, {mid}, {topic}')
+            self._mips_sub_pending_map.pop(topic, None)
+            if topic not in self._mips_unsub_pending_map:
+                self._mips_unsub_pending_map[topic] = 0
+            self.__mips_start_pending_timer()
         except Exception as err:  # pylint: disable=broad-exception-caught
             # Catch all exception
             self.log_error(f'mips unsub internal error, {topic}, {err}')
 
+    def _mips_sub_topic(self, topic: str) -> str:
+        """Broker subscription topic of a broadcast topic."""
+        return topic
+
+    def _mips_topic_classes(self, topic: str) -> list[str]:
+        """Topic classes covered by a topic, see MIPS_QOS_POLICY."""
+        return []
+
+    @final
+    def _mips_qos(self, topic: str) -> int:
+        """QoS of a topic, a wildcard topic uses the highest QoS of the
+        topic classes it covers."""
+        topic_classes = self._mips_topic_classes(topic)
+        if not topic_classes:
+            return self.MIPS_QOS
+        return max(
+            self._qos_policy.get(topic_class, self.MIPS_QOS)
+            for topic_class in topic_classes)
+
+    @final
+    def _mips_sub_ref(self, topic: str) -> None:
+        """Subscribe a broadcast topic through a shared broker subscription.
+        NOTICE: Internal function, only mips threads are allowed to call
+        """
+        sub_topic: str = self._mips_sub_topic(topic)
+        count: int = self._mips_sub_refs.get(sub_topic, 0)
+        self._mips_sub_refs[sub_topic] = count+1
+        if count == 0:
+            self._mips_sub_internal(topic=sub_topic)
+
+    @final
+    def _mips_unsub_ref(self, topic: str) -> None:
+        """Release a broadcast topic, unsubscribe if it was the last one.
+        NOTICE: Internal function, only mips threads are allowed to call
+        """
+        sub_topic: str = self._mips_sub_topic(topic)
+        count: int = self._mips_sub_refs.get(sub_topic, 0)
+        if count > 1:
+            self._mips_sub_refs[sub_topic] = count-1
+            return
+        if self._mips_sub_refs.pop(sub_topic, None) is not None:
+            self._mips_unsub_internal(topic=sub_topic)
+
+    @final
+    def _mips_sub_refs_internal(self) -> None:
+        """Subscribe all shared broker subscriptions, e.g. on connect.
+        NOTICE: Internal function, only mips threads are allowed to call
+        """
+        for sub_topic in list(self._mips_sub_refs.keys()):
+            self._mips_sub_internal(topic=sub_topic)
+
+    @final
+    def _mips_broadcast_internal(
+        self, bc_list: list[_MipsBroadcast], topic: str, payload: str
+    ) -> None:
+        """Decode a broadcast for all matched handlers and queue the records
+        for the main loop. Records queued before the main loop gets to run
+        are delivered in one batch.
+        NOTICE: Internal function, only mips threads are allowed to call
+        """
+        for item in bc_list:
+            if item.handler is None:
+                continue
+            try:
+                record = item.decoder(topic, payload)
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                self.log_error(f'mips decode error, {topic}, {err}')
+                continue
+            if record is None:
+                continue
+            self._mips_dispatch_queue.append(
+                (item.handler, record, item.handler_ctx))
+        if self._mips_dispatch_queue and not self._mips_dispatch_scheduled:
+            self._mips_dispatch_scheduled = True
+            self.main_loop.call_soon_threadsafe(self.__mips_dispatch_handler)
+
+    def __mips_dispatch_handler(self) -> None:
+        """Run in the main loop."""
+        self._mips_dispatch_scheduled = False
+        queue = self._mips_dispatch_queue
+        # Records queued meanwhile schedule another batch
+        for _ in range(len(queue)):
+            handler, record, ctx = queue.popleft()
+            try:
+                handler(record, ctx)
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                self.log_error(f'mips broadcast handler error, {err}')
+
     @final
     def _mips_publish_internal(
         self, topic: str, payload: str | bytes,
@@ -557,7 +952,7 @@ class _MipsClient(ABC):
             return False
         try:
             handle = self._mqtt.publish(
-                topic=topic, payload=payload, qos=self.MIPS_QOS)
+                topic=topic, payload=payload, qos=self._mips_qos(topic))
             # self.log_debug(f'_mips_publish_internal, {topic}, {payload}')
             if wait_for_publish is True:
                 handle.wait_for_publish(timeout_ms/1000.0)
@@ -573,16 +968,66 @@ class _MipsClient(ABC):
 
     def __mqtt_read_handler(self) -> None:
         self.__mqtt_loop_handler()
+        # paho reads one packet at a time, the rest may stay in the TLS
+        # buffer without the fd becoming readable again
+        sock = self._mqtt.socket() if self._mqtt else None
+        if isinstance(sock, ssl.SSLSocket) and sock.pending():
+            self._internal_loop.call_soon(self.__mqtt_read_handler)
 
     def __mqtt_write_handler(self) -> None:
-        self._internal_loop.remove_writer(self._mqtt_fd)
+        # paho unregisters the writer once its buffer is flushed
         self.__mqtt_loop_handler()
 
     def __mqtt_timer_handler(self) -> None:
+        self._mqtt_timer = None
         self.__mqtt_loop_handler()
-        if self._mqtt:
-            self._mqtt_timer = self._internal_loop.call_later(
-                self.MQTT_INTERVAL_S, self.__mqtt_timer_handler)
+
+    def __on_socket_register_write_connecting(
+        self, client, user_data, sock
+    ) -> None:
+        # Keep the CONNECT packet queued, the writer is registered once the
+        # connect is done on the loop
+        pass
+
+    def __on_socket_register_write(self, client, user_data, sock) -> None:
+        self._internal_loop.add_writer(
+            sock.fileno(), self.__mqtt_write_handler)
+
+    def __on_socket_unregister_write(self, client, user_data, sock) -> None:
+        self._internal_loop.remove_writer(sock.fileno())
+
+    def __mqtt_keepalive_deadline(self) -> Optional[float]:
+        """Time (monotonic) of the next paho keepalive action, None if the
+        keepalive is off."""
+        if not self._mqtt:
+            return None
+        keepalive: int = getattr(self._mqtt, '_keepalive', 0)
+        if not keepalive:
+            return None
+        ping_t: float = getattr(self._mqtt, '_ping_t', 0)
+        if ping_t > 0:
+            # Waiting for PINGRESP
+            return ping_t+keepalive
+        return min(
+            getattr(self._mqtt, '_last_msg_out', 0),
+            getattr(self._mqtt, '_last_msg_in', 0))+keepalive
+
+    def __mqtt_update_timer(self) -> None:
+        """Wake up only when paho has housekeeping to do."""
+        if not self._mqtt or self._mqtt_fd == -1:
+            return
+        deadline = self.__mqtt_keepalive_deadline()
+        delay: float = self.MQTT_INTERVAL_S
+        if deadline is not None:
+            delay = max(deadline-time.monotonic(), 0)+self.MQTT_TIMER_SLACK_S
+        when: float = self._internal_loop.time()+delay
+        if self._mqtt_timer:
+            if self._mqtt_timer.when() <= when:
+                # An earlier wakeup reschedules itself
+                return
+            self._mqtt_timer.cancel()
+        self._mqtt_timer = self._internal_loop.call_at(
+            when, self.__mqtt_timer_handler)
 
     def __mqtt_loop_handler(self) -> None:
         try:
@@ -592,9 +1037,7 @@ class _MipsClient(ABC):
                 self._mqtt.loop_write()
             if self._mqtt:
                 self._mqtt.loop_misc()
-            if self._mqtt and self._mqtt.want_write():
-                self._internal_loop.add_writer(
-                    self._mqtt_fd, self.__mqtt_write_handler)
+            self.__mqtt_update_timer()
         except Exception as err:  # pylint: disable=broad-exception-caught
             # Catch all exception
             self.log_error(f'__mqtt_loop_handler, {err}')
@@ -602,36 +1045,45 @@ class _MipsClient(ABC):
 
     def __mips_loop_thread(self) -> None:
         self.log_info('mips_loop_thread start')
+        self.__mips_loop_init()
+        # Run event loop
+        self._internal_loop.run_forever()
+        self.log_info('mips_loop_thread exit!')
+
+    def __mips_loop_init(self) -> None:
         # mqtt init for API_VERSION2,
         # callback_api_version=CallbackAPIVersion.VERSION2,
-        self._mqtt = Client(client_id=self._client_id, protocol=MQTTv5)
+        self._mqtt = _MipsMqttClient(
+            client_id=self._client_id, protocol=MQTTv5)
+        self._mqtt.mips_hosts = self._hosts
         self._mqtt.enable_logger(logger=self._mqtt_logger)
         # Set mqtt config
         if self._username:
             self._mqtt.username_pw_set(
                 username=self._username, password=self._password)
+        # Same as tls_set(), with TLS session resumption
+        ssl_context = _MipsSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_REQUIRED
         if (
             self._ca_file
             and self._cert_file
             and self._key_file
         ):
-            self._mqtt.tls_set(
-                tls_version=ssl.PROTOCOL_TLS_CLIENT,
-                ca_certs=self._ca_file,
-                certfile=self._cert_file,
-                keyfile=self._key_file)
+            ssl_context.load_cert_chain(
+                certfile=self._cert_file, keyfile=self._key_file)
+            ssl_context.load_verify_locations(cafile=self._ca_file)
         else:
-            self._mqtt.tls_set(tls_version=ssl.PROTOCOL_TLS_CLIENT)
+            ssl_context.load_default_certs()
+        self._mqtt.tls_set_context(ssl_context)
         self._mqtt.tls_insecure_set(True)
         self._mqtt.on_connect = self.__on_connect
         self._mqtt.on_connect_fail = self.__on_connect_failed
         self._mqtt.on_disconnect = self.__on_disconnect
         self._mqtt.on_message = self.__on_message
+        self._mqtt.on_subscribe = self.__on_subscribe
         # Connect to mips
         self.__mips_start_connect_tries()
-        # Run event loop
-        self._internal_loop.run_forever()
-        self.log_info('mips_loop_thread exit!')
 
     def __on_connect(self, client, user_data, flags, rc, props) -> None:
         if not self._mqtt:
@@ -641,8 +1093,21 @@ class _MipsClient(ABC):
             return
         self.log_info(f'mips connect, {flags}, {rc}, {props}')
         self._mqtt_state = True
+        self._mips_connect_ts = time.monotonic()
+        self.__mips_sort_hosts(success=True)
+        self.__mips_save_tls_session()
+        self._mips_session_started = True
+        self._mips_sub_inflight.clear()
+        if not self._session_expiry or not flags.get('session present', 0):
+            # Clean session, resubscribe all
+            self._mips_session_topics.clear()
+        else:
+            self.log_info(
+                'mips session present, %s topics',
+                len(self._mips_session_topics))
         self._internal_loop.call_soon(
             self._on_mips_connect, rc, props)
+        self._internal_loop.call_soon(self.__mips_unsub_stale_topics)
         with self._mips_state_sub_map_lock:
             for item in self._mips_state_sub_map.values():
                 if item.handler is None:
@@ -666,6 +1131,12 @@ class _MipsClient(ABC):
             (self.log_info if rc == 0 else self.log_error)(
                 f'mips disconnect, {rc}, {props}')
             self._mqtt_state = False
+            if (
+                time.monotonic()-self._mips_connect_ts
+                >= self.MIPS_RECONNECT_STABLE_S
+            ):
+                # Not a flapping connection, retry fast again
+                self._mips_reconnect_interval = 0
             if self._mqtt_timer:
                 self._mqtt_timer.cancel()
                 self._mqtt_timer = None
@@ -678,6 +1149,10 @@ class _MipsClient(ABC):
                 self._mips_sub_pending_timer.cancel()
                 self._mips_sub_pending_timer = None
             self._mips_sub_pending_map = {}
+            self._mips_unsub_pending_map = {}
+            self._mips_sub_inflight.clear()
+            if not self._session_expiry:
+                self._mips_session_topics.clear()
             self._internal_loop.call_soon(
                 self._on_mips_disconnect, rc, props)
             # Call state sub handler
@@ -705,61 +1180,205 @@ class _MipsClient(ABC):
     ) -> None:
         self._on_mips_message(topic=msg.topic, payload=msg.payload)
 
+    def __on_subscribe(
+        self, client: Client, user_data: Any, mid: int, reason_codes: list,
+        props: Any = None
+    ) -> None:
+        topics = self._mips_sub_inflight.pop(mid, None)
+        if not topics:
+            return
+        for topic, reason_code in zip(topics, reason_codes):
+            # Reason code < 0x80 is the granted qos
+            if int(getattr(reason_code, 'value', reason_code)) < 0x80:
+                self._mips_session_topics.add(topic)
+            else:
+                self.log_error(f'mips sub rejected, {topic}, {reason_code}')
+
+    def __mips_unsub_stale_topics(self) -> None:
+        """Unsubscribe topics left in the session but no longer wanted."""
+        for topic in self._mips_session_topics - self._mips_sub_topics:
+            self._mips_unsub_internal(topic=topic)
+
+    def __mips_start_pending_timer(self) -> None:
+        if not self._mips_sub_pending_timer:
+            self._mips_sub_pending_timer = self._internal_loop.call_later(
+                0.01, self.__mips_sub_internal_pending_handler, None)
+
+    def __mips_pack_pending_topics(
+        self, pending_map: dict[str, int], extra_len: int, packet_count: int
+    ) -> list[list[str]]:
+        """Split pending topics into batches by the estimated packet size.
+        Every topic costs a two bytes length prefix plus extra_len bytes.
+        """
+        batches: list[list[str]] = []
+        batch: list[str] = []
+        # Fixed header, packet identifier and properties length
+        batch_size: int = 8
+        for topic in list(pending_map.keys()):
+            if pending_map[topic] > self.MIPS_SUB_RETRY_MAX:
+                pending_map.pop(topic)
+                self.log_error(f'retry mips (un)sub internal error, {topic}')
+                continue
+            topic_size = 2+len(topic.encode('utf-8'))+extra_len
+            if batch and batch_size+topic_size > self.MIPS_SUB_PACKET_SIZE:
+                batches.append(batch)
+                if len(batches) >= packet_count:
+                    return batches
+                batch = []
+                batch_size = 8
+            batch.append(topic)
+            batch_size += topic_size
+        if batch:
+            batches.append(batch)
+        return batches
+
     def __mips_sub_internal_pending_handler(self, ctx: Any) -> None:
+        self._mips_sub_pending_timer = None
         if not self._mqtt or not self._mqtt.is_connected():
             _LOGGER.error(
                 'mips sub internal pending, but mqtt is None or disconnected')
             return
-        subbed_count = 1
-        for topic in list(self._mips_sub_pending_map.keys()):
-            if subbed_count > self.MIPS_SUB_PATCH:
-                break
-            count = self._mips_sub_pending_map[topic]
-            if count > 3:
-                self._mips_sub_pending_map.pop(topic)
-                self.log_error(f'retry mips sub internal error, {topic}')
-                continue
-            subbed_count += 1
-            result, mid = self._mqtt.subscribe(topic, qos=self.MIPS_QOS)
+        packet_count: int = self.MIPS_SUB_PACKET_COUNT
+        # Unsubscribe first, a topic is never pending in both maps
+        for topics in self.__mips_pack_pending_topics(
+                pending_map=self._mips_unsub_pending_map, extra_len=0,
+                packet_count=packet_count):
+            packet_count -= 1
+            try:
+                result, mid = self._mqtt.unsubscribe(topics)
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                result, mid = MQTT_ERR_UNKNOWN, None
+                self.log_error(f'mips unsub internal error, {err}')
+            self.__mips_update_pending(
+                pending_map=self._mips_unsub_pending_map, topics=topics,
+                success=result == MQTT_ERR_SUCCESS)
             if result == MQTT_ERR_SUCCESS:
-                self._mips_sub_pending_map.pop(topic)
-                self.log_debug(f'mips sub internal success, {topic}')
-                continue
-            self._mips_sub_pending_map[topic] = count+1
-            self.log_error(
-                f'retry mips sub internal, {count}, {topic}, {result}, {mid}')
+                # The broker handles packets in order, a later subscribe of
+                # the same topic is safe
+                self._mips_session_topics.difference_update(topics)
+                self.log_debug(
+                    f'mips unsub internal success, {mid}, {len(topics)}')
+            else:
+                self.log_error(
+                    f'retry mips unsub internal, {result}, {mid}, {topics}')
+        # Subscribe with the remaining packet budget, with one subscription
+        # options byte per topic
+        sub_batches: list[list[str]] = self.__mips_pack_pending_topics(
+            pending_map=self._mips_sub_pending_map, extra_len=1,
+            packet_count=packet_count) if packet_count > 0 else []
+        for topics in sub_batches:
+            try:
+                result, mid = self._mqtt.subscribe(
+                    [(topic, self._mips_qos(topic)) for topic in topics])
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                result, mid = MQTT_ERR_UNKNOWN, None
+                self.log_error(f'mips sub internal error, {err}')
+            self.__mips_update_pending(
+                pending_map=self._mips_sub_pending_map, topics=topics,
+                success=result == MQTT_ERR_SUCCESS)
+            if result == MQTT_ERR_SUCCESS:
+                # Confirmed in the session on SUBACK
+                self._mips_sub_inflight[mid] = topics
+                self.log_debug(
+                    f'mips sub internal success, {mid}, {len(topics)}')
+            else:
+                self.log_error(
+                    f'retry mips sub internal, {result}, {mid}, {topics}')
 
-        if len(self._mips_sub_pending_map):
+        if self._mips_sub_pending_map or self._mips_unsub_pending_map:
             self._mips_sub_pending_timer = self._internal_loop.call_later(
                 self.MIPS_SUB_INTERVAL,
                 self.__mips_sub_internal_pending_handler, None)
-        else:
-            self._mips_sub_pending_timer = None
+
+    def __mips_update_pending(
+        self, pending_map: dict[str, int], topics: list[str], success: bool
+    ) -> None:
+        for topic in topics:
+            if success:
+                pending_map.pop(topic, None)
+            elif topic in pending_map:
+                pending_map[topic] += 1
 
     def __mips_connect(self) -> None:
         if not self._mqtt:
             _LOGGER.error('__mips_connect, but mqtt is None')
             return
-        result = MQTT_ERR_UNKNOWN
         if self._mips_reconnect_timer:
             self._mips_reconnect_timer.cancel()
             self._mips_reconnect_timer = None
+        # Try clean mqtt fd before mqtt connect
+        if self._mqtt_timer:
+            self._mqtt_timer.cancel()
+            self._mqtt_timer = None
+        if self._mqtt_fd != -1:
+            self._internal_loop.remove_reader(self._mqtt_fd)
+            self._internal_loop.remove_writer(self._mqtt_fd)
+            self._mqtt_fd = -1
+        kwargs: dict = {
+            'host': self._host, 'port': self._port, 'clean_start': True,
+            'keepalive': MIHOME_MQTT_KEEPALIVE}
+        if self._session_expiry:
+            # Clean the first connect only, keep the session afterwards.
+            # paho resets its own first connect flag on every connect().
+            properties = Properties(PacketTypes.CONNECT)
+            properties.SessionExpiryInterval = self._session_expiry
+            kwargs['clean_start'] = not self._mips_session_started
+            kwargs['properties'] = properties
+        mqtt = self._mqtt
+        # The connect may run off the loop, do not let paho touch the loop
+        # until the connect is done
+        mqtt.on_socket_register_write = (
+            self.__on_socket_register_write_connecting)
+        mqtt.on_socket_unregister_write = None
+        if not self._reactor:
+            self.__mips_connect_done(
+                mqtt=mqtt, result=self.__mips_connect_blocking(
+                    mqtt=mqtt, kwargs=kwargs))
+            return
+        # The TCP and TLS handshakes block, keep them off the shared
+        # reactor so that one unreachable broker does not stall the others.
+        # A daemon thread, a hanging handshake must not block the exit.
+        loop = self._internal_loop
+
+        def connect_thread() -> None:
+            result = self.__mips_connect_blocking(mqtt=mqtt, kwargs=kwargs)
+            try:
+                loop.call_soon_threadsafe(
+                    self.__mips_connect_done, mqtt, result)
+            except RuntimeError:
+                # Reactor stopped meanwhile
+                pass
+        threading.Thread(
+            target=connect_thread, name=f'{self._client_id}.connect',
+            daemon=True).start()
+
+    def __mips_connect_blocking(
+        self, mqtt: Client, kwargs: dict
+    ) -> Optional[int]:
+        """Return the connect result, None if the connection failed."""
         try:
-            # Try clean mqtt fd before mqtt connect
-            if self._mqtt_timer:
-                self._mqtt_timer.cancel()
-                self._mqtt_timer = None
-            if self._mqtt_fd != -1:
-                self._internal_loop.remove_reader(self._mqtt_fd)
-                self._internal_loop.remove_writer(self._mqtt_fd)
-                self._mqtt_fd = -1
-            result = self._mqtt.connect(
-                host=self._host, port=self._port,
-                clean_start=True, keepalive=MIHOME_MQTT_KEEPALIVE)
+            result = mqtt.connect(**kwargs)
             self.log_info(f'__mips_connect success, {result}')
-        except (TimeoutError, OSError) as error:
+            return result
+        except Exception as error:  # pylint: disable=broad-exception-caught
             self.log_error('__mips_connect, connect error, %s', error)
+        return None
 
+    def __mips_connect_done(
+        self, mqtt: Client, result: Optional[int]
+    ) -> None:
+        if mqtt is not self._mqtt or not self._mips_reconnect_tag:
+            # Disconnected while connecting
+            sock = mqtt.socket()
+            if sock:
+                self._internal_loop.remove_writer(sock.fileno())
+                self._internal_loop.remove_reader(sock.fileno())
+                sock.close()
+            return
+        if result is None:
+            # TCP connected but TLS failed, try the other addresses first
+            self.__mips_sort_hosts(success=False)
+            result = MQTT_ERR_UNKNOWN
         if result == MQTT_ERR_SUCCESS:
             socket = self._mqtt.socket()
             if socket is None:
@@ -771,15 +1390,42 @@ class _MipsClient(ABC):
             self.log_debug(f'__mips_connect, _mqtt_fd, {self._mqtt_fd}')
             self._internal_loop.add_reader(
                 self._mqtt_fd, self.__mqtt_read_handler)
-            if self._mqtt.want_write():
-                self._internal_loop.add_writer(
-                    self._mqtt_fd, self.__mqtt_write_handler)
-            self._mqtt_timer = self._internal_loop.call_later(
-                self.MQTT_INTERVAL_S, self.__mqtt_timer_handler)
+            # Register the writer only while paho has data to send, the
+            # CONNECT packet is still queued
+            self._mqtt.on_socket_register_write = (
+                self.__on_socket_register_write)
+            self._mqtt.on_socket_unregister_write = (
+                self.__on_socket_unregister_write)
+            self._internal_loop.add_writer(
+                self._mqtt_fd, self.__mqtt_write_handler)
+            self.__mqtt_update_timer()
         else:
             self.log_error(f'__mips_connect error result, {result}')
             self.__mips_try_reconnect()
 
+    def __mips_sort_hosts(self, success: bool) -> None:
+        """Prefer the address that worked, try the one that failed last."""
+        host = self._mqtt.mips_host if self._mqtt else None
+        if not host or len(self._hosts) <= 1 or host not in self._hosts:
+            return
+        self._hosts.remove(host)
+        if success:
+            self._hosts.insert(0, host)
+        else:
+            self._hosts.append(host)
+        self._host = self._hosts[0]
+
+    def __mips_update_hosts(self, hosts: list[str]) -> None:
+        # Keep the current address first while it is still advertised
+        self._hosts[:] = (
+            [self._host] if self._host in hosts else [])+[
+                item for item in hosts if item != self._host]
+        self._host = self._hosts[0]
+        self.log_info(f'mips update hosts, {self._hosts}')
+        if self._mips_reconnect_timer and not self.mips_state:
+            # Waiting for a retry, try the new addresses now
+            self.__mips_try_reconnect(immediately=True)
+
     def __mips_try_reconnect(self, immediately: bool = False) -> None:
         if self._mips_reconnect_timer:
             self._mips_reconnect_timer.cancel()
@@ -815,13 +1461,36 @@ class _MipsClient(ABC):
             self._mips_sub_pending_timer.cancel()
             self._mips_sub_pending_timer = None
         self._mips_sub_pending_map = {}
+        self._mips_unsub_pending_map = {}
+        self._mips_sub_topics.clear()
+        self._mips_session_topics.clear()
+        self._mips_sub_inflight.clear()
+        self._mips_session_started = False
+        self._mips_sub_refs.clear()
+        self._on_mips_release()
         if self._mqtt:
             self._mqtt.disconnect()
             self._mqtt = None
-        self._internal_loop.stop()
+        if not self._reactor:
+            self._internal_loop.stop()
+
+    def __mips_save_tls_session(self) -> None:
+        sock = self._mqtt.socket() if self._mqtt else None
+        if not isinstance(sock, ssl.SSLSocket) or not sock.session:
+            return
+        ssl_context = sock.context
+        if isinstance(ssl_context, _MipsSSLContext):
+            ssl_context.tls_sessions[
+                sock.server_hostname or self._host] = sock.session
+        self.log_debug(f'mips tls session reused, {sock.session_reused}')
 
     def __get_next_reconnect_time(self) -> float:
         if self._mips_reconnect_interval == 0:
+            # Short blips, retry at once. The jitter keeps the clients of a
+            # restarted broker apart.
+            self._mips_reconnect_interval = self.MIPS_RECONNECT_INTERVAL_FAST
+            return random.uniform(0, self.MIPS_RECONNECT_INTERVAL_FAST)
+        if self._mips_reconnect_interval < self.MIPS_RECONNECT_INTERVAL_MIN:
             self._mips_reconnect_interval = self.MIPS_RECONNECT_INTERVAL_MIN
         else:
             self._mips_reconnect_interval = min(
@@ -838,13 +1507,18 @@ class MipsCloudClient(_MipsClient):
 
     def __init__(
             self, uuid: str, cloud_server: str, app_id: str,
-            token: str, port: int = 8883,
+            token: str, port: int = 8883, session_expiry: int = 0,
+            sub_mode: MipsSubMode = MipsSubMode.TOPIC,
+            qos_policy: Optional[dict[str, int]] = None,
+            reactor: Optional[MIoTReactor] = None,
             loop: Optional[asyncio.AbstractEventLoop] = None
     ) -> None:
         self._msg_matcher = MIoTMatcher()
         super().__init__(
             client_id=f'ha.{uuid}', host=f'{cloud_server}-ha.mqtt.io.mi.com',
-            port=port, username=app_id, password=token, loop=loop)
+            port=port, username=app_id, password=token,
+            session_expiry=session_expiry, sub_mode=sub_mode,
+            qos_policy=qos_policy, reactor=reactor, loop=loop)
 
     @final
     def disconnect(self) -> None:
@@ -873,13 +1547,13 @@ class MipsCloudClient(_MipsClient):
             f'device/{did}/up/properties_changed/'
             f'{"#" if siid is None or piid is None else f"{siid}/{piid}"}')
 
-        def on_prop_msg(topic: str, payload: str, ctx: Any) -> None:
+        def decode_prop_msg(topic: str, payload: str) -> Optional[dict]:
             try:
                 msg: dict = json.loads(payload)
             except json.JSONDecodeError:
                 self.log_error(
                     f'on_prop_msg, invalid msg, {topic}, {payload}')
-                return
+                return None
             if (
                 not isinstance(msg.get('params', None), dict)
                 or 'siid' not in msg['params']
@@ -888,12 +1562,12 @@ class MipsCloudClient(_MipsClient):
             ):
                 self.log_error(
                     f'on_prop_msg, invalid msg, {topic}, {payload}')
-                return
-            if handler:
-                self.log_debug('on properties_changed, %s', payload)
-                handler(msg['params'], ctx)
+                return None
+            self.log_debug('on properties_changed, %s', payload)
+            return msg['params']
         return self.__reg_broadcast_external(
-            topic=topic, handler=on_prop_msg, handler_ctx=handler_ctx)
+            topic=topic, decoder=decode_prop_msg, handler=handler,
+            handler_ctx=handler_ctx)
 
     @final
     def unsub_prop(
@@ -925,13 +1599,13 @@ class MipsCloudClient(_MipsClient):
             f'device/{did}/up/event_occured/'
             f'{"#" if siid is None or eiid is None else f"{siid}/{eiid}"}')
 
-        def on_event_msg(topic: str, payload: str, ctx: Any) -> None:
+        def decode_event_msg(topic: str, payload: str) -> Optional[dict]:
             try:
                 msg: dict = json.loads(payload)
             except json.JSONDecodeError:
                 self.log_error(
                     f'on_event_msg, invalid msg, {topic}, {payload}')
-                return
+                return None
             if (
                 not isinstance(msg.get('params', None), dict)
                 or 'siid' not in msg['params']
@@ -940,13 +1614,13 @@ class MipsCloudClient(_MipsClient):
             ):
                 self.log_error(
                     f'on_event_msg, invalid msg, {topic}, {payload}')
-                return
-            if handler:
-                self.log_debug('on on_event_msg, %s', payload)
-                msg['params']['from'] = 'cloud'
-                handler(msg['params'], ctx)
+                return None
+            self.log_debug('on on_event_msg, %s', payload)
+            msg['params']['from'] = 'cloud'
+            return msg['params']
         return self.__reg_broadcast_external(
-            topic=topic, handler=on_event_msg, handler_ctx=handler_ctx)
+            topic=topic, decoder=decode_event_msg, handler=handler,
+            handler_ctx=handler_ctx)
 
     @final
     def unsub_event(
@@ -973,24 +1647,29 @@ class MipsCloudClient(_MipsClient):
             raise MIoTMipsError('invalid params')
         topic: str = f'device/{did}/state/#'
 
-        def on_state_msg(topic: str, payload: str, ctx: Any) -> None:
+        def decode_state_msg(
+            topic: str, payload: str
+        ) -> Optional[MIoTDeviceState]:
             msg: dict = json.loads(payload)
             # {"device_id":"xxxx","device_name":"米家智能插座3   ","event":"online",
             # "model": "cuco.plug.v3","timestamp":1709001070828,"uid":xxxx}
             if msg is None or 'device_id' not in msg or 'event' not in msg:
                 self.log_error(f'on_state_msg, recv unknown msg, {payload}')
-                return
+                return None
             if msg['device_id'] != did:
                 self.log_error(
                     f'on_state_msg, err msg, {did}!={msg["device_id"]}')
-                return
-            if handler:
-                self.log_debug('cloud, device state changed, %s', payload)
-                handler(
-                    did, MIoTDeviceState.ONLINE if msg['event'] == 'online'
-                    else MIoTDeviceState.OFFLINE, ctx)
+                return None
+            self.log_debug('cloud, device state changed, %s', payload)
+            return (
+                MIoTDeviceState.ONLINE if msg['event'] == 'online'
+                else MIoTDeviceState.OFFLINE)
+
+        def on_state_msg(state: MIoTDeviceState, ctx: Any) -> None:
+            handler(did, state, ctx)
         return self.__reg_broadcast_external(
-            topic=topic, handler=on_state_msg, handler_ctx=handler_ctx)
+            topic=topic, decoder=decode_state_msg, handler=on_state_msg,
+            handler_ctx=handler_ctx)
 
     @final
     def unsub_device_state(self, did: str) -> bool:
@@ -1022,11 +1701,11 @@ class MipsCloudClient(_MipsClient):
         raise NotImplementedError('please call in http client')
 
     def __reg_broadcast_external(
-        self, topic: str, handler: Callable[[str, str, Any], None],
-        handler_ctx: Any = None
+        self, topic: str, decoder: Callable[[str, str], Any],
+        handler: Callable[[Any, Any], None], handler_ctx: Any = None
     ) -> bool:
         self._internal_loop.call_soon_threadsafe(
-            self.__reg_broadcast, topic, handler, handler_ctx)
+            self.__reg_broadcast, topic, decoder, handler, handler_ctx)
         return True
 
     def __unreg_broadcast_external(self, topic: str) -> bool:
@@ -1035,28 +1714,50 @@ class MipsCloudClient(_MipsClient):
         return True
 
     def __reg_broadcast(
-        self, topic: str, handler: Callable[[str, str, Any], None],
-        handler_ctx: Any = None
+        self, topic: str, decoder: Callable[[str, str], Any],
+        handler: Callable[[Any, Any], None], handler_ctx: Any = None
     ) -> None:
         if not self._msg_matcher.get(topic=topic):
             sub_bc: _MipsBroadcast = _MipsBroadcast(
-                topic=topic, handler=handler,
+                topic=topic, decoder=decoder, handler=handler,
                 handler_ctx=handler_ctx)
             self._msg_matcher[topic] = sub_bc
-            self._mips_sub_internal(topic=topic)
+            self._mips_sub_ref(topic=topic)
         else:
             self.log_debug(f'mips cloud re-reg broadcast, {topic}')
 
     def __unreg_broadcast(self, topic: str) -> None:
         if self._msg_matcher.get(topic=topic):
             del self._msg_matcher[topic]
-            self._mips_unsub_internal(topic=topic)
+            self._mips_unsub_ref(topic=topic)
+
+    def _mips_sub_topic(self, topic: str) -> str:
+        if self._sub_mode == MipsSubMode.TOPIC:
+            return topic
+        # device/{did}/..., covers properties, events and state
+        return '/'.join(topic.split('/', 2)[:2]+['#'])
+
+    def _mips_topic_classes(self, topic: str) -> list[str]:
+        # device/{did}/up/properties_changed/..., device/{did}/state/...
+        levels = topic.split('/', 4)
+        if len(levels) < 3 or levels[0] != 'device':
+            return []
+        if levels[2] == '#':
+            return ['prop', 'event', 'state']
+        if levels[2] == 'state':
+            return ['state']
+        if levels[2] == 'up' and len(levels) > 3:
+            if levels[3] == 'properties_changed':
+                return ['prop']
+            if levels[3] == 'event_occured':
+                return ['event']
+            if levels[3] == '#':
+                return ['prop', 'event']
+        return []
 
     def _on_mips_connect(self, rc: int, props: dict) -> None:
         """sub topic."""
-        for topic, _ in list(
-                self._msg_matcher.iter_all_nodes()):
-            self._mips_sub_internal(topic=topic)
+        self._mips_sub_refs_internal()
 
     def _on_mips_disconnect(self, rc: int, props: dict) -> None:
         """unsub topic."""
@@ -1074,12 +1775,156 @@ class MipsCloudClient(_MipsClient):
         # The message from the cloud is not packed.
         payload_str: str = payload.decode('utf-8')
         # self.log_debug(f"on broadcast, {topic}, {payload}")
-        for item in bc_list or []:
-            if item.handler is None:
-                continue
-            # NOTICE: call threadsafe
-            self.main_loop.call_soon_threadsafe(
-                item.handler, topic, payload_str, item.handler_ctx)
+        self._mips_broadcast_internal(
+            bc_list=bc_list, topic=topic, payload=payload_str)
+
+
+class MipsCloudShardedClient:
+    """MIoT Pub/Sub Cloud Client, devices hashed across several connections.
+    Each shard is a MipsCloudClient with its own session, socket and thread
+    (or a shared reactor), a reconnect only affects the devices of the
+    shard. The shard of a device is stable, crc32(did) % shards.
+    One shard behaves exactly like a single MipsCloudClient.
+    """
+    _shards: list[MipsCloudClient]
+
+    def __init__(
+            self, uuid: str, cloud_server: str, app_id: str,
+            token: str, shards: int = 1, port: int = 8883,
+            session_expiry: int = 0,
+            sub_mode: MipsSubMode = MipsSubMode.TOPIC,
+            qos_policy: Optional[dict[str, int]] = None,
+            reactor: Optional[MIoTReactor] = None,
+            loop: Optional[asyncio.AbstractEventLoop] = None
+    ) -> None:
+        if not isinstance(shards, int) or shards < 1:
+            raise MIoTMipsError(f'invalid shards, {shards}')
+        # Shard 0 keeps the client id of the unsharded client, so the
+        # broker session survives enabling sharding
+        self._shards = [
+            MipsCloudClient(
+                uuid=uuid if index == 0 else f'{uuid}.{index}',
+                cloud_server=cloud_server, app_id=app_id, token=token,
+                port=port, session_expiry=session_expiry,
+                sub_mode=sub_mode, qos_policy=qos_policy, reactor=reactor,
+                loop=loop)
+            for index in range(shards)]
+
+    @property
+    def shards(self) -> list[MipsCloudClient]:
+        return list(self._shards)
+
+    @property
+    def mips_state(self) -> bool:
+        """True if all shards are connected."""
+        return all(shard.mips_state for shard in self._shards)
+
+    def get_shard(self, did: str) -> MipsCloudClient:
+        if len(self._shards) == 1:
+            return self._shards[0]
+        return self._shards[
+            zlib.crc32(did.encode('utf-8')) % len(self._shards)]
+
+    def shard_id(self, did: str) -> str:
+        """Client id of the shard carrying the device, as passed to the
+        mips state handlers."""
+        return self.get_shard(did).client_id
+
+    def connect(self) -> None:
+        for shard in self._shards:
+            shard.connect()
+
+    def disconnect(self) -> None:
+        for shard in self._shards:
+            shard.disconnect()
+
+    def deinit(self) -> None:
+        for shard in self._shards:
+            shard.deinit()
+
+    def enable_logger(self, logger: Optional[logging.Logger] = None) -> None:
+        for shard in self._shards:
+            shard.enable_logger(logger=logger)
+
+    def update_access_token(self, access_token: str) -> bool:
+        for shard in self._shards:
+            shard.update_access_token(access_token=access_token)
+        return True
+
+    def sub_mips_state(
+        self, key: str, handler: Callable[[str, bool], Coroutine]
+    ) -> bool:
+        """Subscribe mips state of every shard.
+        NOTICE: the handler is called with the client id of the shard
+        instead of the key, see shard_id().
+        """
+        for shard in self._shards:
+            shard.sub_mips_state(
+                key=key, handler=self.__shard_state_handler(
+                    client_id=shard.client_id, handler=handler))
+        return True
+
+    def unsub_mips_state(self, key: str) -> bool:
+        for shard in self._shards:
+            shard.unsub_mips_state(key=key)
+        return True
+
+    def sub_prop(
+        self,
+        did: str,
+        handler: Callable[[dict, Any], None],
+        siid: Optional[int] = None,
+        piid: Optional[int] = None,
+        handler_ctx: Any = None
+    ) -> bool:
+        return self.get_shard(did).sub_prop(
+            did=did, handler=handler, siid=siid, piid=piid,
+            handler_ctx=handler_ctx)
+
+    def unsub_prop(
+        self,
+        did: str,
+        siid: Optional[int] = None,
+        piid: Optional[int] = None
+    ) -> bool:
+        return self.get_shard(did).unsub_prop(did=did, siid=siid, piid=piid)
+
+    def sub_event(
+        self,
+        did: str,
+        handler: Callable[[dict, Any], None],
+        siid: Optional[int] = None,
+        eiid: Optional[int] = None,
+        handler_ctx: Any = None
+    ) -> bool:
+        return self.get_shard(did).sub_event(
+            did=did, handler=handler, siid=siid, eiid=eiid,
+            handler_ctx=handler_ctx)
+
+    def unsub_event(
+        self,
+        did: str,
+        siid: Optional[int] = None,
+        eiid: Optional[int] = None
+    ) -> bool:
+        return self.get_shard(did).unsub_event(did=did, siid=siid, eiid=eiid)
+
+    def sub_device_state(
+        self, did: str, handler: Callable[[str, MIoTDeviceState, Any], None],
+        handler_ctx: Any = None
+    ) -> bool:
+        return self.get_shard(did).sub_device_state(
+            did=did, handler=handler, handler_ctx=handler_ctx)
+
+    def unsub_device_state(self, did: str) -> bool:
+        return self.get_shard(did).unsub_device_state(did=did)
+
+    def __shard_state_handler(
+        self, client_id: str, handler: Callable[[str, bool], Coroutine]
+    ) -> Callable[[str, bool], Coroutine]:
+        async def on_state(key: str, state: bool) -> None:
+            await handler(client_id, state)
+        return on_state
 
 
 class MipsLocalClient(_MipsClient):
@@ -1088,46 +1933,100 @@ class MipsLocalClient(_MipsClient):
     # pylint: disable=inconsistent-quotes
     MIPS_RECONNECT_INTERVAL_MIN: float = 6
     MIPS_RECONNECT_INTERVAL_MAX: float = 60
-    MIPS_SUB_PATCH: int = 1000
+    MIPS_SUB_PACKET_COUNT: int = 10
     MIPS_SUB_INTERVAL: float = 0.1
+    MIPS_NOTIFY_TOPIC_PREFIX: str = 'master/appMsg/notify/iot/'
+    # Queued property reads are sent as one get_properties rpc per device
+    # every GET_PROP_INTERVAL seconds, at most GET_PROP_BATCH_MAX each
+    GET_PROP_INTERVAL: float = 0.1
+    GET_PROP_BATCH_MAX: int = 16
+    # Liveness probe, a request with a tight deadline sent when no reply
+    # was seen for PROBE_INTERVAL seconds. A probe timeout marks the
+    # gateway degraded until the next reply.
+    PROBE_INTERVAL: float = 15
+    PROBE_INTERVAL_DEGRADED: float = 3
+    PROBE_TIMEOUT_MS: int = 1500
     _did: str
     _group_id: str
     _home_name: str
     _mips_seed_id: int
     _reply_topic: str
     _dev_list_change_topic: str
-    _request_map: dict[str, _MipsRequest]
+    _requests: MIoTRequestTracker
     _msg_matcher: MIoTMatcher
     _get_prop_queue: dict[str, list]
     _get_prop_timer: Optional[asyncio.TimerHandle]
+    _get_prop_interval: float
+    _get_prop_batch_max: int
     _on_dev_list_changed: Optional[Callable[[Any, list[str]], Coroutine]]
+    _probe_interval: float
+    _probe_timer: Optional[asyncio.TimerHandle]
+    _probe_mid: Optional[int]
+    _last_reply_ts: float
+    _degraded: bool
 
     def __init__(
         self, did: str, host: str, group_id: str,
         ca_file: str, cert_file: str, key_file: str,
-        port: int = 8883, home_name: str = '',
+        port: int = 8883, home_name: str = '', session_expiry: int = 0,
+        sub_mode: MipsSubMode = MipsSubMode.TOPIC,
+        qos_policy: Optional[dict[str, int]] = None,
+        get_prop_interval: Optional[float] = None,
+        get_prop_batch_max: Optional[int] = None,
+        probe_interval: Optional[float] = None,
+        reactor: Optional[MIoTReactor] = None,
+        hosts: Optional[list[str]] = None,
         loop: Optional[asyncio.AbstractEventLoop] = None
     ) -> None:
+        """probe_interval: liveness probe interval in seconds, 0 to
+        disable, defaults to PROBE_INTERVAL.
+        hosts: all advertised addresses of the central hub gateway."""
         self._did = did
         self._group_id = group_id
         self._home_name = home_name
         self._mips_seed_id = random.randint(0, self.UINT32_MAX)
         self._reply_topic = f'{did}/reply'
         self._dev_list_change_topic = f'{did}/appMsg/devListChange'
-        self._request_map = {}
+        self._requests = MIoTRequestTracker(
+            on_timeout=self.__on_request_timeout)
         self._msg_matcher = MIoTMatcher()
         self._get_prop_queue = {}
         self._get_prop_timer = None
+        self._get_prop_interval = (
+            self.GET_PROP_INTERVAL if get_prop_interval is None
+            else get_prop_interval)
+        self._get_prop_batch_max = max(
+            get_prop_batch_max or self.GET_PROP_BATCH_MAX, 1)
         self._on_dev_list_changed = None
+        self._probe_interval = (
+            self.PROBE_INTERVAL if probe_interval is None
+            else max(probe_interval, 0))
+        self._probe_timer = None
+        self._probe_mid = None
+        self._last_reply_ts = 0
+        self._degraded = False
 
         super().__init__(
             client_id=did, host=host, port=port,
-            ca_file=ca_file, cert_file=cert_file, key_file=key_file, loop=loop)
+            ca_file=ca_file, cert_file=cert_file, key_file=key_file,
+            session_expiry=session_expiry, sub_mode=sub_mode,
+            qos_policy=qos_policy, reactor=reactor, hosts=hosts, loop=loop)
 
     @property
     def group_id(self) -> str:
         return self._group_id
 
+    @property
+    def request_stats(self) -> dict:
+        """In-flight request count, age percentiles and timeouts."""
+        return self._requests.stats()
+
+    @property
+    def degraded(self) -> bool:
+        """True if the last liveness probe timed out and no reply was
+        received since. Requests should be routed elsewhere."""
+        return self._degraded
+
     def log_debug(self, msg, *args, **kwargs) -> None:
         if self._logger:
             self._logger.debug(f'{self._home_name}, '+msg, *args, **kwargs)
@@ -1148,7 +2047,7 @@ class MipsLocalClient(_MipsClient):
     @final
     def disconnect(self) -> None:
         super().disconnect()
-        self._request_map = {}
+        self._degraded = False
         self._msg_matcher = MIoTMatcher()
 
     @final
@@ -1164,7 +2063,7 @@ class MipsLocalClient(_MipsClient):
             f'appMsg/notify/iot/{did}/property/'
             f'{"#" if siid is None or piid is None else f"{siid}.{piid}"}')
 
-        def on_prop_msg(topic: str, payload: str, ctx: Any):
+        def decode_prop_msg(topic: str, payload: str) -> Optional[dict]:
             msg: dict = json.loads(payload)
             if (
                 msg is None
@@ -1174,12 +2073,12 @@ class MipsLocalClient(_MipsClient):
                 or 'value' not in msg
             ):
                 # self.log_error(f'on_prop_msg, recv unknown msg, {payload}')
-                return
-            if handler:
-                self.log_debug('local, on properties_changed, %s', payload)
-                handler(msg, ctx)
+                return None
+            self.log_debug('local, on properties_changed, %s', payload)
+            return msg
         return self.__reg_broadcast_external(
-            topic=topic, handler=on_prop_msg, handler_ctx=handler_ctx)
+            topic=topic, decoder=decode_prop_msg, handler=handler,
+            handler_ctx=handler_ctx)
 
     @final
     def unsub_prop(
@@ -1206,7 +2105,7 @@ class MipsLocalClient(_MipsClient):
             f'appMsg/notify/iot/{did}/event/'
             f'{"#" if siid is None or eiid is None else f"{siid}.{eiid}"}')
 
-        def on_event_msg(topic: str, payload: str, ctx: Any):
+        def decode_event_msg(topic: str, payload: str) -> Optional[dict]:
             msg: dict = json.loads(payload)
             if (
                 msg is None
@@ -1216,14 +2115,14 @@ class MipsLocalClient(_MipsClient):
                 # or 'arguments' not in msg
             ):
                 # self.log_error(f'on_event_msg, recv unknown msg, {payload}')
-                return
+                return None
             if 'arguments' not in msg:
                 msg['arguments'] = []
-            if handler:
-                self.log_debug('local, on event_occurred, %s', payload)
-                handler(msg, ctx)
+            self.log_debug('local, on event_occurred, %s', payload)
+            return msg
         return self.__reg_broadcast_external(
-            topic=topic, handler=on_event_msg, handler_ctx=handler_ctx)
+            topic=topic, decoder=decode_event_msg, handler=handler,
+            handler_ctx=handler_ctx)
 
     @final
     def unsub_event(
@@ -1244,21 +2143,44 @@ class MipsLocalClient(_MipsClient):
         self._get_prop_queue.setdefault(did, [])
         fut: asyncio.Future = self.main_loop.create_future()
         self._get_prop_queue[did].append({
-            'param': json.dumps({
-                'did': did,
-                'siid': siid,
-                'piid': piid
-            }),
+            'siid': siid,
+            'piid': piid,
             'fut': fut,
             'timeout_ms': timeout_ms
         })
         if self._get_prop_timer is None:
             self._get_prop_timer = self.main_loop.call_later(
-                0.1,
-                self.main_loop.create_task,
-                self.__get_prop_timer_handle())
+                self._get_prop_interval,
+                lambda: self.main_loop.create_task(
+                    self.__get_prop_timer_handle()))
         return await fut
 
+    @final
+    async def get_props_async(
+        self, params: list, timeout_ms: int = 10000
+    ) -> list:
+        """
+        params = [{"did": "xxxx", "siid": 2, "piid": 1},
+                    {"did": "xxxxxx", "siid": 2, "piid": 2}]
+        One get_properties rpc is sent for each device, concurrently.
+        Results of invalid replies are omitted.
+        """
+        params_by_did: dict[str, list] = {}
+        for param in params:
+            params_by_did.setdefault(param['did'], []).append({
+                'did': param['did'],
+                'siid': param['siid'],
+                'piid': param['piid']})
+        results = await asyncio.gather(*[
+            self.__get_device_props_async(
+                did=did, params=did_params, timeout_ms=timeout_ms)
+            for did, did_params in params_by_did.items()],
+            return_exceptions=True)
+        return [
+            result for did_results in results
+            if isinstance(did_results, list)
+            for result in did_results]
+
     @final
     async def get_prop_async(
         self, did: str, siid: int, piid: int, timeout_ms: int = 10000
@@ -1312,6 +2234,47 @@ class MipsLocalClient(_MipsClient):
             'code': MIoTErrorCode.CODE_INTERNAL_ERROR.value,
             'message': 'Invalid result'}
 
+    @final
+    async def set_props_async(
+        self, did: str, params: list, timeout_ms: int = 10000
+    ) -> list[dict]:
+        """
+        params = [{"siid": 2, "piid": 1, "value": False}, ...]
+        One set_properties rpc for all properties of the device. Returns
+        one result with a code for each param, in the same order.
+        """
+        payload_obj: dict = {
+            'did': did,
+            'rpc': {
+                'id': self.__gen_mips_id,
+                'method': 'set_properties',
+                'params': [{
+                    'did': did,
+                    'siid': param['siid'],
+                    'piid': param['piid'],
+                    'value': param['value']
+                } for param in params]
+            }
+        }
+        result_obj = await self.__request_async(
+            topic='proxy/rpcReq',
+            payload=json.dumps(payload_obj),
+            timeout_ms=timeout_ms)
+        if result_obj:
+            if (
+                isinstance(result_obj.get('result', None), list)
+                and len(result_obj['result']) == len(params)
+                and all(
+                    isinstance(item, dict) and 'code' in item
+                    for item in result_obj['result'])
+            ):
+                return result_obj['result']
+            if 'error' in result_obj:
+                return [result_obj['error']]*len(params)
+        return [{
+            'code': MIoTErrorCode.CODE_INTERNAL_ERROR.value,
+            'message': 'Invalid result'}]*len(params)
+
     @final
     async def action_async(
         self, did: str, siid: int, aiid: int, in_list: list,
@@ -1423,45 +2386,85 @@ class MipsLocalClient(_MipsClient):
 
     def __request(
             self, topic: str, payload: str,
-            on_reply: Callable[[str, Any], None],
+            on_reply: Optional[Callable[[str, Any], None]],
             on_reply_ctx: Any = None, timeout_ms: int = 10000
-    ) -> None:
+    ) -> int:
         req = _MipsRequest(
             mid=self.__gen_mips_id,
             on_reply=on_reply,
             on_reply_ctx=on_reply_ctx,
-            timer=None)
-        pub_topic: str = f'master/{topic}'
+            topic=f'master/{topic}')
         result = self.__mips_publish(
-            topic=pub_topic, payload=payload, mid=req.mid,
+            topic=req.topic, payload=payload, mid=req.mid,
             ret_topic=self._reply_topic)
         self.log_debug(
-            f'mips local call api, {result}, {req.mid}, {pub_topic}, '
+            f'mips local call api, {result}, {req.mid}, {req.topic}, '
             f'{payload}')
-
-        def on_request_timeout(req: _MipsRequest):
-            self.log_error(
-                f'on mips request timeout, {req.mid}, {pub_topic}'
-                f', {payload}')
-            self._request_map.pop(str(req.mid), None)
+        self._requests.add(
+            req_id=req.mid, data=req, timeout_s=timeout_ms/1000)
+        return req.mid
+
+    def __on_request_timeout(self, mid: int, req: _MipsRequest) -> None:
+        self.log_error(f'on mips request timeout, {mid}, {req.topic}')
+        if mid == self._probe_mid:
+            self._probe_mid = None
+            self.__set_degraded(True)
+        elif self._probe_interval and self._probe_mid is None:
+            # Check the link now instead of waiting for the keepalive
+            self.__probe_start(delay=0)
+        if req.on_reply:
             req.on_reply(
                 '{"error":{"code":-10006, "message":"timeout"}}',
                 req.on_reply_ctx)
-        req.timer = self._internal_loop.call_later(
-            timeout_ms/1000, on_request_timeout, req)
-        self._request_map[str(req.mid)] = req
+
+    def __set_degraded(self, degraded: bool) -> None:
+        if degraded == self._degraded:
+            return
+        self._degraded = degraded
+        (self.log_error if degraded else self.log_info)(
+            'mips local degraded, %s', degraded)
+
+    def __probe_start(self, delay: float) -> None:
+        if self._probe_timer:
+            self._probe_timer.cancel()
+        self._probe_timer = self._internal_loop.call_later(
+            delay, self.__probe_handler)
+
+    def __probe_stop(self) -> None:
+        if self._probe_timer:
+            self._probe_timer.cancel()
+            self._probe_timer = None
+        self._probe_mid = None
+
+    def __probe_handler(self) -> None:
+        self._probe_timer = None
+        if not self.mips_state:
+            return
+        if self._probe_mid is None and (
+            self._degraded
+            or time.monotonic()-self._last_reply_ts >= self._probe_interval
+            or self._requests
+        ):
+            # Any reply proves the link, an empty filter keeps it small
+            self._probe_mid = self.__request(
+                topic='proxy/getDevList',
+                payload=json.dumps({'filter': {'did': []}}),
+                on_reply=None, timeout_ms=self.PROBE_TIMEOUT_MS)
+        self.__probe_start(
+            delay=self.PROBE_INTERVAL_DEGRADED if self._degraded
+            else self._probe_interval)
 
     def __reg_broadcast(
-        self, topic: str, handler: Callable[[str, str, Any], None],
-        handler_ctx: Any
+        self, topic: str, decoder: Callable[[str, str], Any],
+        handler: Callable[[Any, Any], None], handler_ctx: Any
     ) -> None:
         sub_topic: str = f'{self._did}/{topic}'
         if not self._msg_matcher.get(sub_topic):
             sub_bc: _MipsBroadcast = _MipsBroadcast(
-                topic=sub_topic, handler=handler,
+                topic=sub_topic, decoder=decoder, handler=handler,
                 handler_ctx=handler_ctx)
             self._msg_matcher[sub_topic] = sub_bc
-            self._mips_sub_internal(topic=f'master/{topic}')
+            self._mips_sub_ref(topic=f'master/{topic}')
         else:
             self.log_debug(f'mips re-reg broadcast, {sub_topic}')
 
@@ -1470,9 +2473,37 @@ class MipsLocalClient(_MipsClient):
         unsub_topic: str = f'{self._did}/{topic}'
         if self._msg_matcher.get(unsub_topic):
             del self._msg_matcher[unsub_topic]
-            self._mips_unsub_internal(
+            self._mips_unsub_ref(
                 topic=re.sub(f'^{self._did}', 'master', unsub_topic))
 
+    def _mips_sub_topic(self, topic: str) -> str:
+        if (
+            self._sub_mode == MipsSubMode.TOPIC
+            or not topic.startswith(self.MIPS_NOTIFY_TOPIC_PREFIX)
+        ):
+            return topic
+        if self._sub_mode == MipsSubMode.GATEWAY:
+            return f'{self.MIPS_NOTIFY_TOPIC_PREFIX}#'
+        # master/appMsg/notify/iot/{did}/...
+        did: str = topic[len(self.MIPS_NOTIFY_TOPIC_PREFIX):].split('/', 1)[0]
+        return f'{self.MIPS_NOTIFY_TOPIC_PREFIX}{did}/#'
+
+    def _mips_topic_classes(self, topic: str) -> list[str]:
+        if topic.startswith(self.MIPS_NOTIFY_TOPIC_PREFIX):
+            # master/appMsg/notify/iot/{did}/property|event/...
+            levels = topic[len(self.MIPS_NOTIFY_TOPIC_PREFIX):].split('/', 2)
+            if len(levels) < 2 or '#' in levels[:2]:
+                return ['prop', 'event']
+            if levels[1] == 'property':
+                return ['prop']
+            if levels[1] == 'event':
+                return ['event']
+            return []
+        if topic.startswith('master/proxy/') or topic == f'{self._did}/#':
+            # Requests and the reply topic
+            return ['request']
+        return []
+
     @final
     def _on_mips_connect(self, rc: int, props: dict) -> None:
         self.log_debug('__on_mips_connect_handler')
@@ -1483,13 +2514,20 @@ class MipsLocalClient(_MipsClient):
         # Do not need to subscribe api topics, for they are covered by did/#
         # Sub api topic.
         # Sub broadcast topic
-        for topic, _ in list(self._msg_matcher.iter_all_nodes()):
-            self._mips_sub_internal(
-                topic=re.sub(f'^{self._did}', 'master', topic))
+        self._mips_sub_refs_internal()
+        self.__set_degraded(False)
+        if self._probe_interval:
+            self.__probe_start(delay=self._probe_interval)
 
     @final
     def _on_mips_disconnect(self, rc: int, props: dict) -> None:
-        pass
+        self.__probe_stop()
+
+    @final
+    def _on_mips_release(self) -> None:
+        # The request and probe timers belong to the internal loop
+        self._requests.clear()
+        self.__probe_stop()
 
     @final
     def _on_mips_message(self, topic: str, payload: bytes) -> None:
@@ -1499,12 +2537,12 @@ class MipsLocalClient(_MipsClient):
         # Reply
         if topic == self._reply_topic:
             self.log_debug(f'on request reply, {mips_msg}')
-            req: Optional[_MipsRequest] = self._request_map.pop(
-                str(mips_msg.mid), None)
+            req: Optional[_MipsRequest] = self._requests.pop(mips_msg.mid)
+            self._last_reply_ts = time.monotonic()
+            if mips_msg.mid == self._probe_mid:
+                self._probe_mid = None
+            self.__set_degraded(False)
             if req:
-                # Cancel timer
-                if req.timer:
-                    req.timer.cancel()
                 if req.on_reply:
                     self.main_loop.call_soon_threadsafe(
                         req.on_reply, mips_msg.payload or '{}',
@@ -1515,12 +2553,9 @@ class MipsLocalClient(_MipsClient):
             topic=topic))
         if bc_list:
             self.log_debug(f'on broadcast, {topic}, {mips_msg}')
-            for item in bc_list or []:
-                if item.handler is None:
-                    continue
-                self.main_loop.call_soon_threadsafe(
-                    item.handler, topic[topic.find('/')+1:],
-                    mips_msg.payload or '{}', item.handler_ctx)
+            self._mips_broadcast_internal(
+                bc_list=bc_list, topic=topic[topic.find('/')+1:],
+                payload=mips_msg.payload or '{}')
             return
         # Device list change
         if topic == self._dev_list_change_topic:
@@ -1576,12 +2611,12 @@ class MipsLocalClient(_MipsClient):
         return True
 
     def __reg_broadcast_external(
-        self, topic: str, handler: Callable[[str, str, Any], None],
-        handler_ctx: Any
+        self, topic: str, decoder: Callable[[str, str], Any],
+        handler: Callable[[Any, Any], None], handler_ctx: Any
     ) -> bool:
         self._internal_loop.call_soon_threadsafe(
             self.__reg_broadcast,
-            topic, handler, handler_ctx)
+            topic, decoder, handler, handler_ctx)
         return True
 
     def __unreg_broadcast_external(self, topic) -> bool:
@@ -1616,25 +2651,103 @@ class MipsLocalClient(_MipsClient):
                 'code': MIoTErrorCode.CODE_MIPS_INVALID_RESULT.value,
                 'message': f'Error: {result}'}
 
+    async def __get_device_props_async(
+        self, did: str, params: list, timeout_ms: int = 10000
+    ) -> Optional[list]:
+        """Return None if the reply is invalid, raise on timeout."""
+        result_obj = await self.__request_async(
+            topic='proxy/rpcReq',
+            payload=json.dumps({
+                'did': did,
+                'rpc': {
+                    'id': self.__gen_mips_id,
+                    'method': 'get_properties',
+                    'params': params
+                }
+            }),
+            timeout_ms=timeout_ms)
+        if (
+            isinstance(result_obj, dict)
+            and isinstance(result_obj.get('result', None), list)
+        ):
+            return result_obj['result']
+        self.log_error(f'get device props error, {did}, {result_obj}')
+        if (
+            isinstance(result_obj, dict)
+            and isinstance(result_obj.get('error', None), dict)
+            and result_obj['error'].get('code', None)
+            == MIoTErrorCode.CODE_TIMEOUT.value
+        ):
+            raise MIoTMipsError(
+                'get device props timeout', MIoTErrorCode.CODE_TIMEOUT)
+        return None
+
     async def __get_prop_timer_handle(self) -> None:
-        for did in list(self._get_prop_queue.keys()):
-            item = self._get_prop_queue[did].pop()
-            _LOGGER.debug('get prop, %s, %s', did, item)
-            result_obj = await self.__request_async(
-                topic='proxy/get',
-                payload=item['param'],
-                timeout_ms=item['timeout_ms'])
-            if result_obj is None or 'value' not in result_obj:
-                item['fut'].set_result(None)
+        # Send one batch for every device concurrently
+        batches: list[Coroutine] = []
+        batch_items: list[list] = []
+        try:
+            for did in list(self._get_prop_queue.keys()):
+                items = self._get_prop_queue[did][:self._get_prop_batch_max]
+                del self._get_prop_queue[did][:len(items)]
+                if not self._get_prop_queue[did]:
+                    self._get_prop_queue.pop(did, None)
+                _LOGGER.debug('get props, %s, %s', did, len(items))
+                batches.append(
+                    self.__get_prop_batch_async(did=did, items=items))
+                batch_items.append(items)
+            results = await asyncio.gather(*batches, return_exceptions=True)
+            for items, result in zip(batch_items, results):
+                if not isinstance(result, BaseException):
+                    continue
+                self.log_error(f'get props batch error, {result}')
+                # Fail only the requests of this batch
+                for item in items:
+                    if not item['fut'].done():
+                        item['fut'].set_result(None)
+        finally:
+            if self._get_prop_queue:
+                self._get_prop_timer = self.main_loop.call_later(
+                    self._get_prop_interval,
+                    lambda: self.main_loop.create_task(
+                        self.__get_prop_timer_handle()))
             else:
-                item['fut'].set_result(result_obj['value'])
+                self._get_prop_timer = None
 
-            if not self._get_prop_queue[did]:
-                self._get_prop_queue.pop(did, None)
+    async def __get_prop_batch_async(self, did: str, items: list) -> None:
+        def set_result(fut: asyncio.Future, value: Any) -> None:
+            if not fut.done():
+                fut.set_result(value)
 
-        if self._get_prop_queue:
-            self._get_prop_timer = self.main_loop.call_later(
-                0.1, lambda: self.main_loop.create_task(
-                    self.__get_prop_timer_handle()))
-        else:
-            self._get_prop_timer = None
+        if len(items) > 1:
+            try:
+                results = await self.__get_device_props_async(
+                    did=did,
+                    params=[{
+                        'did': did, 'siid': item['siid'],
+                        'piid': item['piid']} for item in items],
+                    timeout_ms=max(item['timeout_ms'] for item in items))
+            except MIoTMipsError:
+                # Device not responding, do not retry one by one
+                for item in items:
+                    set_result(item['fut'], None)
+                return
+            if results is not None:
+                values: dict[tuple, dict] = {
+                    (result.get('siid', None), result.get('piid', None)):
+                    result for result in results if isinstance(result, dict)}
+                pending: list = []
+                for item in items:
+                    result = values.get((item['siid'], item['piid']), None)
+                    if result is None:
+                        pending.append(item)
+                    elif result.get('code', 0) != 0 or 'value' not in result:
+                        set_result(item['fut'], None)
+                    else:
+                        set_result(item['fut'], result['value'])
+                items = pending
+        # Single property, or not covered by the batch reply
+        for item in items:
+            set_result(item['fut'], await self.get_prop_async(
+                did=did, siid=item['siid'], piid=item['piid'],
+                timeout_ms=item['timeout_ms']))
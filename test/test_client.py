@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Unit test for miot_client.py."""
+import asyncio
+from types import SimpleNamespace
+import pytest
+
+# pylint: disable=import-outside-toplevel, protected-access
+
+
+class _FakeRefreshRoute:
+    """Property reads of one route, counting the concurrent requests."""
+
+    def __init__(self, fail_dids: tuple = ()) -> None:
+        self.fail_dids = fail_dids
+        self.running = 0
+        self.max_running = 0
+        self.degraded = False
+
+    async def get_props_async(
+        self, params: list, did: str = '', timeout_ms: int = 0
+    ) -> list:
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+        return [
+            {**param, 'value': 1} for param in params
+            if param['did'] not in self.fail_dids]
+
+
+@pytest.mark.asyncio
+async def test_client_refresh_props():
+    """Pending refreshes are split by the best route of each device, run
+    with bounded concurrency, and what failed is requeued."""
+    pytest.importorskip('homeassistant')
+    from miot.common import MIoTRouteStats
+    from miot.miot_client import (
+        MIoTClient, CtrlMode, REFRESH_PROPS_CLOUD_BATCH,
+        REFRESH_PROPS_CLOUD_CONCURRENCY, REFRESH_PROPS_LAN_CONCURRENCY)
+
+    client = object.__new__(MIoTClient)
+    client._main_loop = asyncio.get_running_loop()
+    client._ctrl_mode = CtrlMode.AUTO
+    client._route_stats = MIoTRouteStats()
+    client._network = SimpleNamespace(network_status=True)
+    client._http = _FakeRefreshRoute()
+    client._miot_lan = _FakeRefreshRoute(fail_dids=('lan_fail',))
+    gw = _FakeRefreshRoute()
+    client._mips_local = {'group1': gw}
+    client._device_list_cloud = {'cloud': {'online': True}}
+    client._device_list_gateway = {'gw': {
+        'online': True, 'specv2_access': True, 'group_id': 'group1'}}
+    lan_dids = [f'lan{index}' for index in range(20)] + ['lan_fail']
+    client._device_list_lan = {did: {'online': True} for did in lan_dids}
+    client._refresh_props_timer = None
+    client._refresh_props_retry_count = 0
+    received: dict[str, str] = {}
+    client._MIoTClient__on_prop_msg = lambda params, ctx: received.update(
+        {params['did']: ctx})
+
+    def request(did: str, count: int) -> None:
+        for piid in range(count):
+            client._refresh_props_list[f'{did}|2|{piid}'] = {
+                'did': did, 'siid': 2, 'piid': piid}
+
+    client._refresh_props_list = {}
+    request(did='cloud', count=REFRESH_PROPS_CLOUD_BATCH*6)
+    request(did='gw', count=3)
+    for did in lan_dids:
+        request(did=did, count=2)
+    await client._MIoTClient__refresh_props_handler()
+    assert received == {
+        'cloud': 'cloud', 'gw': 'gateway',
+        **{did: 'lan' for did in lan_dids if did != 'lan_fail'}}
+    assert client._http.max_running == REFRESH_PROPS_CLOUD_CONCURRENCY
+    assert client._miot_lan.max_running == REFRESH_PROPS_LAN_CONCURRENCY
+    # Partly failed, requeued and retried soon
+    assert list(client._refresh_props_list) == ['lan_fail|2|0', 'lan_fail|2|1']
+    assert client._refresh_props_retry_count == 0
+    client._refresh_props_timer.cancel()
+
+    # No route while the network is down, retried later, three times
+    client._network.network_status = False
+    client._refresh_props_list = {}
+    request(did='cloud', count=2)
+    for retry_count in range(1, 4):
+        await client._MIoTClient__refresh_props_handler()
+        assert list(client._refresh_props_list) == [
+            'cloud|2|0', 'cloud|2|1']
+        assert client._refresh_props_retry_count == retry_count
+        client._refresh_props_timer.cancel()
+    await client._MIoTClient__refresh_props_handler()
+    assert not client._refresh_props_list
+    assert client._refresh_props_timer is None
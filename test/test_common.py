@@ -30,3 +30,128 @@ def test_miot_matcher():
     match_result: list[str] = list(matcher.iter_match(topic='test/1/1'))
     assert len(match_result) == 2
     assert set(match_result) == set(['test/+/1', 'test/1/#'])
+
+
+@pytest.mark.github
+@pytest.mark.asyncio
+async def test_miot_request_tracker():
+    import asyncio
+    from miot.common import MIoTRequestTracker
+
+    expired: list[int] = []
+    tracker = MIoTRequestTracker(
+        on_timeout=lambda req_id, data: expired.append(req_id))
+    # Added out of deadline order
+    tracker.add(req_id=1, data='1', timeout_s=0.3)
+    tracker.add(req_id=2, data='2', timeout_s=0.1)
+    tracker.add(req_id=3, data='3', timeout_s=0.2)
+    tracker.add(req_id=4, data='4', timeout_s=0.15)
+    tracker.add(req_id=5, data='5')
+    assert len(tracker) == 5
+    assert tracker.pop(4) == '4'
+    assert tracker.pop(4) is None
+    stats = tracker.stats()
+    assert stats['in_flight'] == 4
+    assert stats['age_max'] >= stats['age_p50'] >= 0
+    await asyncio.sleep(0.4)
+    assert expired == [2, 3, 1]
+    assert len(tracker) == 1
+    assert tracker.stats()['timeouts'] == 3
+    assert tracker.clear() == ['5']
+    assert len(tracker) == 0
+
+
+@pytest.mark.github
+def test_miot_reactor():
+    import threading
+    from miot.common import MIoTReactor
+
+    reactor = MIoTReactor(name='test_reactor')
+    loop1 = reactor.acquire()
+    loop2 = reactor.acquire()
+    assert loop1 is loop2
+    assert reactor.ref_count == 2
+    thread = reactor.thread
+    assert thread and thread.is_alive()
+    assert reactor.call(
+        lambda: threading.current_thread()).result(1) is thread
+    reactor.release()
+    assert thread.is_alive()
+    reactor.release()
+    assert not thread.is_alive()
+    assert reactor.thread is None
+    # Restart after the last release
+    assert reactor.acquire() is not loop1
+    reactor.release()
+
+
+@pytest.mark.github
+def test_miot_route_stats():
+    from miot.common import MIoTRouteStats
+
+    stats = MIoTRouteStats()
+    routes = ['gateway', 'lan', 'cloud']
+    # No samples, the default order
+    assert stats.rank('1', routes) == routes
+    # A slightly faster later route does not displace the preferred one
+    for _ in range(5):
+        stats.record('1', 'gateway', True, 0.1)
+        stats.record('1', 'cloud', True, 0.08)
+    assert stats.rank('1', routes) == ['gateway', 'cloud', 'lan']
+    # A clearly faster one does
+    for _ in range(5):
+        stats.record('1', 'lan', True, 0.01)
+    assert stats.rank('1', routes)[0] == 'lan'
+    # Unhealthy routes go last
+    for _ in range(20):
+        stats.record('1', 'lan', False, 2)
+    assert stats.rank('1', routes) == ['gateway', 'cloud', 'lan']
+    assert stats.rank('1', ['cloud']) == ['cloud']
+    result = stats.stats()
+    assert result['1']['last_route'] == 'lan'
+    assert not result['1']['routes']['lan']['healthy']
+    assert result['1']['routes']['gateway']['success_rate'] == 1
+    assert result['1']['routes']['gateway']['p90'] == 0.1
+    # Latency budget before hedging, clamped p90
+    assert stats.latency_budget('1', 'gateway') == stats.BUDGET_MIN_S
+    assert stats.latency_budget('2', 'gateway') == stats.BUDGET_DEFAULT_S
+    # Expired samples are dropped
+    stats.TTL_S = 0
+    assert stats.rank('1', routes) == routes
+    stats.remove('1')
+    assert stats.stats() == {}
+
+
+@pytest.mark.github
+def test_miot_prop_shadow():
+    import time
+    from miot.common import MIoTPropShadow
+
+    shadow = MIoTPropShadow()
+    assert shadow.get('1', 2, 1, max_age=10) is None
+    shadow.update('1', 2, 1, value=True, source='cloud')
+    shadow.update('1', 2, 2, value=50, source='lan', ts=time.time()-60)
+    shadow.update('2', 2, 1, value=False, source='gateway')
+    value, _, source = shadow.get('1', 2, 1, max_age=10)
+    assert value is True and source == 'cloud'
+    # Too old for the budget
+    assert shadow.get('1', 2, 2, max_age=10) is None
+    assert shadow.get('1', 2, 2, max_age=120)[0] == 50
+    assert shadow.keys() == [('1', 2, 1), ('1', 2, 2), ('2', 2, 1)]
+    shadow.remove('1', 2, 2)
+    assert shadow.keys() == [('1', 2, 1), ('2', 2, 1)]
+    shadow.remove('1')
+    assert len(shadow) == 1
+    assert shadow.stats() == {'size': 1, 'hits': 2, 'misses': 2}
+
+    # Persist and restore
+    shadow.update('3', 2, 1, value=20, source='lan', ts=time.time()-7200)
+    data = shadow.to_dict()
+    assert data['2|2|1'][0] is False
+    restored = MIoTPropShadow()
+    restored.update('2', 2, 1, value=True, source='cloud')
+    assert restored.load(data, max_age=3600) == 0
+    assert restored.get('2', 2, 1, max_age=10)[0] is True
+    assert restored.get('3', 2, 1, max_age=86400) is None
+    assert restored.load(data, max_age=86400) == 1
+    assert restored.get('3', 2, 1, max_age=86400)[0] == 20
@@ -154,3 +154,115 @@ async def test_lan_async(test_devices: dict):
     await miot_lan.deinit_async()
     await mips_service.deinit_async()
     await miot_network.deinit_async()
+
+
+class _FakeSubDevice:
+    """Lan device stub recording the subscribe calls."""
+
+    def __init__(self, did: str, fail: bool = False) -> None:
+        self.did = did
+        self.online = True
+        self.fail = fail
+        self.sub_cnt = 0
+
+    def subscribe(self) -> None:
+        self.sub_cnt += 1
+        if self.fail:
+            raise OSError('send failed')
+
+
+class _FakeSubLan:
+    """MIoTLan stub for the subscribe manager."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.internal_loop = loop
+        self.devices: dict[str, _FakeSubDevice] = {}
+
+    def get_device(self, did: str) -> Any:
+        return self.devices.get(did, None)
+
+
+@pytest.mark.github
+@pytest.mark.asyncio
+async def test_lan_sub_manager_batch():
+    """Sub requests are sent in rate-limited batches."""
+    from miot.miot_lan import _MIoTLanSubscribeManager
+
+    lan = _FakeSubLan(loop=asyncio.get_running_loop())
+    sub_manager = _MIoTLanSubscribeManager(manager=lan)  # type: ignore
+    sub_manager.SUB_BATCH_SIZE = 4
+    sub_manager.SUB_BATCH_INTERVAL = 0.2
+    for index in range(10):
+        did = f'1000{index}'
+        lan.devices[did] = _FakeSubDevice(did=did)
+        sub_manager.request(did=did)
+    await asyncio.sleep(0.1)
+    assert sum(dev.sub_cnt for dev in lan.devices.values()) == 4
+    await asyncio.sleep(0.2)
+    assert sum(dev.sub_cnt for dev in lan.devices.values()) == 8
+    await asyncio.sleep(0.2)
+    assert sum(dev.sub_cnt for dev in lan.devices.values()) == 10
+    # In flight requests are not sent twice
+    for did in lan.devices:
+        sub_manager.request(did=did)
+    await asyncio.sleep(0.3)
+    assert all(dev.sub_cnt == 1 for dev in lan.devices.values())
+    sub_manager.clear()
+
+
+@pytest.mark.github
+@pytest.mark.asyncio
+async def test_lan_sub_manager_retry():
+    """Failed subscriptions back off exponentially, capped."""
+    from miot.miot_lan import _MIoTLanSubscribeManager
+
+    loop = asyncio.get_running_loop()
+    lan = _FakeSubLan(loop=loop)
+    sub_manager = _MIoTLanSubscribeManager(manager=lan)  # type: ignore
+    lan.devices['10000'] = _FakeSubDevice(did='10000', fail=True)
+    sub_manager.request(did='10000')
+    await asyncio.sleep(0.05)
+    # The send error is reported as a failure
+    item = sub_manager._items['10000']
+    assert lan.devices['10000'].sub_cnt == 1
+    assert not item.pending and item.retry_cnt == 1
+    for retry_cnt in range(2, 10):
+        now = loop.time()
+        sub_manager.on_subscribe_result(did='10000', success=False)
+        interval = min(
+            sub_manager.SUB_RETRY_INTERVAL_MIN * 2 ** (retry_cnt-1),
+            sub_manager.SUB_RETRY_INTERVAL_MAX)
+        assert item.retry_cnt == retry_cnt
+        assert interval*0.7 <= item.due-now <= interval*1.3+0.1
+    # Success resets the backoff and schedules the renew
+    now = loop.time()
+    sub_manager.on_subscribe_result(did='10000', success=True)
+    assert item.retry_cnt == 0 and item.renew
+    assert item.due-now >= sub_manager.SUB_RENEW_INTERVAL*0.9
+    sub_manager.clear()
+
+
+@pytest.mark.github
+@pytest.mark.asyncio
+async def test_lan_sub_manager_network_changed():
+    """A network change spreads the resubscribe of all devices."""
+    from miot.miot_lan import _MIoTLanSubscribeManager
+
+    loop = asyncio.get_running_loop()
+    lan = _FakeSubLan(loop=loop)
+    sub_manager = _MIoTLanSubscribeManager(manager=lan)  # type: ignore
+    for index in range(40):
+        did = f'1000{index}'
+        lan.devices[did] = _FakeSubDevice(did=did)
+        sub_manager.request(did=did, delay=60)
+        sub_manager.on_subscribe_result(did=did, success=bool(index % 2))
+    now = loop.time()
+    sub_manager.on_network_changed()
+    window = max(
+        sub_manager.SUB_SPREAD_WINDOW_MIN,
+        40/sub_manager.SUB_BATCH_SIZE*sub_manager.SUB_BATCH_INTERVAL)
+    for item in sub_manager._items.values():
+        assert now <= item.due <= now+window+0.1
+        assert not item.renew and not item.pending and item.retry_cnt == 0
+    assert len({item.due for item in sub_manager._items.values()}) > 1
+    sub_manager.clear()
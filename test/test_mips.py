@@ -262,3 +262,249 @@ async def test_mips_cloud_async(
     await mips_cloud.disconnect_async()
     await mips_cloud.deinit_async()
     await miot_http.deinit_async()
+
+
+@pytest.mark.github
+def test_mips_message_codec():
+    """Round-trip random messages through the MIPS message codec."""
+    import random
+    from miot.miot_mips import _MipsMessage
+
+    rand = random.Random(20241218)
+    charset = 'abcXYZ019/{}":,. 中文é\U0001f600'
+
+    def rand_str(max_len: int) -> str:
+        return ''.join(
+            rand.choice(charset) for _ in range(rand.randint(1, max_len)))
+
+    for _ in range(2000):
+        mid = rand.randint(0, 0xFFFFFFFF)
+        payload = rand_str(256)
+        msg_from = rand.choice([None, rand_str(16)])
+        ret_topic = rand.choice([None, rand_str(64)])
+        data = _MipsMessage.pack(
+            mid=mid, payload=payload, msg_from=msg_from, ret_topic=ret_topic)
+        msg = _MipsMessage.unpack(data)
+        assert msg.mid == mid
+        assert msg.payload == payload
+        assert msg.msg_from == msg_from
+        assert msg.ret_topic == ret_topic
+        # Also accept bytearray and memoryview
+        assert _MipsMessage.unpack(bytearray(data)).payload == payload
+        assert _MipsMessage.unpack(memoryview(data)).payload == payload
+    # Unknown types are skipped, redundant \x00 are stripped
+    data = (
+        b'\x02\x00\x00\x00\x09\xff\xff'
+        + _MipsMessage.pack(mid=1, payload='{}')
+        + b'\x04\x00\x00\x00\x03\x00ha\x00')
+    msg = _MipsMessage.unpack(data)
+    assert msg.mid == 1
+    assert msg.payload == '{}'
+    assert msg.msg_from == 'ha'
+
+
+@pytest.mark.github
+def test_mips_message_codec_benchmark():
+    """Microbenchmark of the MIPS message codec over a random corpus,
+    every message must survive the round trip."""
+    import json
+    import random
+    import time
+    from miot.miot_mips import _MipsMessage, _MIPS_TLV_HEADER
+
+    rand = random.Random(20241219)
+    corpus = [{
+        'mid': rand.randint(0, 0xFFFFFFFF),
+        'payload': json.dumps({
+            'did': str(rand.randint(1, 10**9)), 'siid': 2, 'piid': 1,
+            'value': 'x中' * rand.randint(0, 200)}),
+        'msg_from': rand.choice([None, 'local']),
+        'ret_topic': rand.choice([None, 'master/proxy/get'])}
+        for _ in range(2000)]
+    start = time.perf_counter()
+    packed = [_MipsMessage.pack(**item) for item in corpus]
+    pack_s = time.perf_counter() - start
+    start = time.perf_counter()
+    msgs = [_MipsMessage.unpack(data) for data in packed]
+    unpack_s = time.perf_counter() - start
+    _LOGGER.info(
+        'mips codec, pack %.2fus/msg, unpack %.2fus/msg',
+        pack_s * 1e6 / len(corpus), unpack_s * 1e6 / len(corpus))
+    for item, data, msg in zip(corpus, packed, msgs):
+        assert (msg.mid, msg.payload, msg.msg_from, msg.ret_topic) == (
+            item['mid'], item['payload'], item['msg_from'],
+            item['ret_topic'])
+        # Exactly sized, no trailing bytes
+        assert len(data) == _MIPS_TLV_HEADER.size+4 + sum(
+            _MIPS_TLV_HEADER.size+len(value.encode('utf-8'))+1
+            for value in (
+                item['msg_from'], item['ret_topic'], item['payload'])
+            if value)
+
+
+@pytest.mark.github
+def test_mips_race_connect():
+    """Connection racing falls back past refused addresses."""
+    import socket
+    from miot.miot_mips import _mips_race_connect
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    port = server.getsockname()[1]
+    try:
+        # Nothing listens on 127.0.0.2
+        sock, host = _mips_race_connect(
+            hosts=['127.0.0.2', '127.0.0.1'], port=port, timeout=5,
+            delay=0.25)
+        assert host == '127.0.0.1'
+        assert sock.getpeername()[1] == port
+        sock.close()
+        with pytest.raises(OSError):
+            _mips_race_connect(
+                hosts=['127.0.0.2'], port=port, timeout=5, delay=0.25)
+    finally:
+        server.close()
+
+
+@pytest.mark.github
+@pytest.mark.asyncio
+async def test_mips_broadcast_batch():
+    """Broadcasts are decoded in the mips thread, handled in batches."""
+    import json
+    import threading
+    from miot.miot_mips import MipsCloudClient, _MipsBroadcast
+
+    client = MipsCloudClient(
+        uuid='test', cloud_server='cn', app_id='test', token='test')
+    main_thread = threading.current_thread()
+    decode_threads: set = set()
+    records: list = []
+
+    def decoder(topic: str, payload: str):
+        decode_threads.add(threading.current_thread())
+        msg = json.loads(payload)
+        return msg if msg.get('valid', False) else None
+
+    def handler(record: dict, ctx: Any):
+        assert threading.current_thread() is main_thread
+        records.append((record['seq'], ctx))
+
+    bc_list = [_MipsBroadcast(
+        topic='test/#', decoder=decoder, handler=handler, handler_ctx='ctx')]
+
+    def mips_thread():
+        for seq in range(100):
+            client._mips_broadcast_internal(
+                bc_list=bc_list, topic='test/1',
+                payload=json.dumps({'seq': seq, 'valid': seq % 10 != 0}))
+    thread = threading.Thread(target=mips_thread)
+    thread.start()
+    thread.join()
+    await asyncio.sleep(0.1)
+    assert main_thread not in decode_threads
+    assert [seq for seq, _ in records] == [
+        seq for seq in range(100) if seq % 10 != 0]
+    assert all(ctx == 'ctx' for _, ctx in records)
+
+
+@pytest.mark.github
+@pytest.mark.asyncio
+async def test_mips_cloud_sharded_client():
+    """Devices are hashed across the cloud shards, stable by did."""
+    from miot.miot_error import MIoTMipsError
+    from miot.miot_mips import MipsCloudShardedClient
+
+    with pytest.raises(MIoTMipsError):
+        MipsCloudShardedClient(
+            uuid='test', cloud_server='cn', app_id='test', token='test',
+            shards=0)
+    single = MipsCloudShardedClient(
+        uuid='test', cloud_server='cn', app_id='test', token='test')
+    assert len(single.shards) == 1
+    assert single.shard_id('123456') == 'ha.test'
+
+    sharded = MipsCloudShardedClient(
+        uuid='test', cloud_server='cn', app_id='test', token='test',
+        shards=4)
+    client_ids = [shard.client_id for shard in sharded.shards]
+    # Shard 0 keeps the client id of the unsharded client
+    assert client_ids[0] == 'ha.test'
+    assert len(set(client_ids)) == 4
+    dids = [str(did) for did in range(100000, 101000)]
+    counts = {client_id: 0 for client_id in client_ids}
+    for did in dids:
+        assert sharded.get_shard(did).client_id == sharded.shard_id(did)
+        counts[sharded.shard_id(did)] += 1
+    assert all(count > 150 for count in counts.values())
+    again = MipsCloudShardedClient(
+        uuid='test', cloud_server='cn', app_id='test', token='test',
+        shards=4)
+    assert all(sharded.shard_id(did) == again.shard_id(did) for did in dids)
+    assert not sharded.mips_state
+
+
+@pytest.mark.parametrize('broker', [('127.0.0.1', 1883)])
+@pytest.mark.parametrize('qos', [0, 1, 2])
+def test_mips_qos_benchmark(broker: Tuple[str, int], qos: int):
+    """
+    Compare the throughput and CPU cost of a telemetry topic by QoS level.
+    NOTICE: A local mqtt broker is required, such as mosquitto.
+    """
+    import json
+    import socket
+    import threading
+    import time
+    from paho.mqtt.client import Client, MQTTv5
+
+    host, port = broker
+    try:
+        socket.create_connection((host, port), timeout=1).close()
+    except OSError:
+        pytest.skip(f'no local mqtt broker, {host}:{port}')
+
+    count = 5000
+    topic = 'device/123456/up/properties_changed/2/1'
+    payload = json.dumps({
+        'params': {'did': '123456', 'siid': 2, 'piid': 1, 'value': 25.5}})
+    received = threading.Event()
+    recv_count = 0
+
+    def on_message(client, user_data, msg):
+        nonlocal recv_count
+        recv_count += 1
+        if recv_count >= count:
+            received.set()
+
+    sub = Client(client_id=f'mips-bench-sub-{qos}', protocol=MQTTv5)
+    sub.on_message = on_message
+    sub.connect(host, port)
+    sub.subscribe(topic, qos=qos)
+    sub.loop_start()
+    pub = Client(client_id=f'mips-bench-pub-{qos}', protocol=MQTTv5)
+    # Avoid dropping QoS 0 messages while the queue is full
+    pub.max_queued_messages_set(0)
+    pub.max_inflight_messages_set(100)
+    pub.connect(host, port)
+    pub.loop_start()
+    time.sleep(0.5)
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for _ in range(count):
+        pub.publish(topic, payload, qos=qos)
+    received.wait(timeout=60)
+    wall_s = time.perf_counter() - wall_start
+    cpu_s = time.process_time() - cpu_start
+
+    pub.loop_stop()
+    pub.disconnect()
+    sub.loop_stop()
+    sub.disconnect()
+    _LOGGER.info(
+        'qos %s, %s/%s msgs, %.0f msg/s, cpu %.2fms/1k msgs',
+        qos, recv_count, count, recv_count / wall_s,
+        cpu_s * 1e6 / max(recv_count, 1))
+    assert recv_count > 0
+    if qos > 0:
+        assert recv_count == count